@@ -1,6 +1,21 @@
 # Copyright 2014 Donny Viszneki.
-import bpy, bmesh
-from mathutils import Color
+import bpy, bmesh, importlib, sys
+from mathutils import Color, Matrix
+from os.path import dirname
+
+# The bpy-independent parts of Escher Tools live in escher_*.py beside this file
+if dirname(__file__) not in sys.path:
+  sys.path.append(dirname(__file__))
+from escher_livelink import (DEFAULT_ADDRESS, ENCODING_ESC6, ENCODING_ESCB, LiveLinkServer,
+  formatAddress, parseAddress)
+from escher_realize import realizeTree
+from escher_registry import SpaceRegistry
+
+# Spaces, remotes and children of every object; see escher_registry.py
+registry = SpaceRegistry()
+
+def spaceRegistry():
+  return registry.update(bpy.data.objects)
 
 bl_info = {
 	"name": "Escher Tools",
@@ -15,7 +30,7 @@ bl_info = {
 }
 
 def selectedFaces(bm):
-  return filter(lambda fa: fa.select, bm.faces)
+  return [fa for fa in bm.faces if fa.select]
 
 def getEditMesh(cx):
   if cx.mode == 'EDIT_MESH':
@@ -24,6 +39,22 @@ def getEditMesh(cx):
         return bmesh.from_edit_mesh(ob.data)
   return None
 
+def hasSelectedFaces(cx):
+  '''Whether the edit mesh has selected faces. In edit mode
+  Mesh.total_face_sel is the count BMesh keeps up to date as faces are
+  selected, so unlike scanning the faces this takes constant time, which
+  matters for polls run on every redraw of the panel.'''
+  if cx.mode == 'EDIT_MESH':
+    ob = cx.object
+    return bool(ob and ob.type == 'MESH' and ob.select and ob.data.total_face_sel)
+  return False
+
+def portalMaterialSlots(me):
+  '''Maps the index of each of the mesh's portal material slots to its
+  material's name.'''
+  return {i: mat.name for i, mat in enumerate(me.materials)
+      if mat is not None and isPortalMaterialName(mat.name)}
+
 def getPortalMaterial(n):
   matName = 'EscherPortalMaterial%03d' % n
   if matName in bpy.data.materials:
@@ -68,35 +99,26 @@ class ESCHER_OT_Portalize_Face(bpy.types.Operator):
     bm = getEditMesh(cx)
     if bm:
       me = cx.object.data
-      matName = None
-      for fa in selectedFaces(bm):
-        mat = me.materials[fa.material_index]
-        if isPortalMaterialName(mat.name):
-          matName = mat.name
+      faces = selectedFaces(bm)
+      portalSlots = portalMaterialSlots(me)
+      remoteIndex = 0
+      for fa in faces:
+        if fa.material_index in portalSlots:
+          numRemotes = len(spaceRegistry().remotesOf(cx.object))
+          remoteIndex = (portalMaterialName2remoteIndex(portalSlots[fa.material_index]) + 1) % \
+              max(numRemotes, 1)
           break
-      if matName:
-        numRemotes = 0
-        for ob in cx.object.children:
-          if objectIsRemote(ob):
-            numRemotes += 1
-        remoteIndex = (portalMaterialName2remoteIndex(matName) + 1) % numRemotes
-      else:
-        remoteIndex = 0
       mat = getPortalMaterial(remoteIndex)
       imat = getMeshMaterialByMaterial(me, mat)
-      for fa in selectedFaces(bm):
+      for fa in faces:
         fa.material_index = imat
+      bmesh.update_edit_mesh(me, False, False)
       self.report({'INFO'}, 'Portalized face materials!')
     return {'FINISHED'}
   
   @classmethod
   def poll(cls, cx):
-    me = getEditMesh(cx)
-    if me:
-      fa = list(selectedFaces(me))
-      if len(fa):
-        return True
-    return False
+    return hasSelectedFaces(cx)
 
 class ESCHER_OT_LinkRemote(bpy.types.Operator):
   '''Links a remote space to this one'''
@@ -115,6 +137,7 @@ class ESCHER_OT_LinkRemote(bpy.types.Operator):
     eo['escher_remote_space_name'] = '*none*'
     eo['escher_portal_index'] = findUnusedPortalIndexInPSO(pso)
     eo.parent = pso
+    registry.invalidate()
     bpy.ops.object.select_all(action='DESELECT')
     eo.select = True
     bpy.ops.transform.translate()
@@ -138,7 +161,7 @@ class ESCHER_OT_RealizeRemote(bpy.types.Operator):
 
   def execute(self, cx):
     eo = cx.object
-    for child in eo.children:
+    for child in spaceRegistry().childrenOf(eo):
       if child.name.startswith('EscherSSO_'):
         showGraph(child)
         return {'FINISHED'}
@@ -146,9 +169,74 @@ class ESCHER_OT_RealizeRemote(bpy.types.Operator):
     sso = makeSSO(remoteSpaceName)
     cx.scene.objects.link(sso)
     sso.parent = eo
+    registry.invalidate()
     # TODO lock all transforms of the SSO
     return {'FINISHED'}
 
+def remoteGraph():
+  '''The remotes of every PSO, for escher_realize.realizeTree().'''
+  return spaceRegistry().remoteGraph(lambda eo: tuple(c for row in eo.matrix_local for c in row))
+
+def removeRealizedTree(pso, sc):
+  '''Removes the SSOs ESCHER_OT_RealizeRemotesDeep made for pso.'''
+  for o in [o for o in spaceRegistry().childrenOf(pso) if o.get('escher_realized_by') == pso.name]:
+    sc.objects.unlink(o)
+    bpy.data.objects.remove(o)
+  registry.invalidate()
+
+class ESCHER_OT_RealizeRemotesDeep(bpy.types.Operator):
+  '''Realizes every remote reachable from the active PSO, up to a chosen depth.
+
+  One SSO is made for each distinct (space, transform) reached, sharing the space's
+  mesh, and parented to the PSO at the composed transform of the remotes leading to
+  it. Any SSOs made for the PSO by an earlier use are removed first.'''
+
+  bl_idname = 'escher.realize_remotes_deep'
+  bl_label = 'Realize Remotes Deep'
+  bl_options = {'REGISTER', 'UNDO'}
+
+  depth = bpy.props.IntProperty(name='Depth', description='How many remotes deep to realize',
+      default=2, min=1, max=16)
+  max_objects = bpy.props.IntProperty(name='Max Objects', description='Most SSOs to create',
+      default=256, min=1)
+
+  @classmethod
+  def poll(cls, cx):
+    return cx.mode == 'OBJECT' and cx.object and cx.object.name.startswith('EscherPSO_')
+
+  def execute(self, cx):
+    pso = cx.object
+    removeRealizedTree(pso, cx.scene)
+    nodes, truncated = realizeTree(remoteGraph(), psoName2spaceName(pso.name), self.depth,
+        self.max_objects)
+    for node in nodes:
+      sso = makeSSO(node.space)
+      sso['escher_realized_by'] = pso.name
+      cx.scene.objects.link(sso)
+      sso.parent = pso
+      sso.matrix_basis = Matrix([node.transform[4*i:4*i+4] for i in range(4)])
+      lockAllTransforms(sso)
+    registry.invalidate()
+    if truncated:
+      self.report({'WARNING'}, 'Stopped at %d SSOs' % len(nodes))
+    else:
+      self.report({'INFO'}, 'Realized %d SSOs' % len(nodes))
+    return {'FINISHED'}
+
+class ESCHER_OT_UnrealizeRemotesDeep(bpy.types.Operator):
+  '''Removes the SSOs made by Realize Remotes Deep for the active PSO'''
+  bl_idname = 'escher.unrealize_remotes_deep'
+  bl_label = 'Unrealize Remotes Deep'
+  bl_options = {'REGISTER', 'UNDO'}
+
+  @classmethod
+  def poll(cls, cx):
+    return cx.mode == 'OBJECT' and cx.object and cx.object.name.startswith('EscherPSO_')
+
+  def execute(self, cx):
+    removeRealizedTree(cx.object, cx.scene)
+    return {'FINISHED'}
+
 class EscherSelectRemote(bpy.types.Operator):
   """Select a remote space to be linked"""
   bl_idname = "escher.select_remote"
@@ -176,13 +264,13 @@ class EscherSelectRemote(bpy.types.Operator):
     remoteSpaceName = psoName2spaceName(remotePsoName)
     removeSsosFromRemoteEmpty(cx.object, cx)
     cx.object['escher_remote_space_name'] = remoteSpaceName
+    registry.invalidate()
     return {'FINISHED'}
 
   def invoke(self, context, event):
     self.choices.clear()
-    for ob in bpy.data.objects:
-      if ob.name.startswith('EscherPSO_'):
-        self.choices.add().name = ob.name
+    for name in spaceRegistry().psoNames():
+      self.choices.add().name = name
     context.window_manager.invoke_search_popup(self)
     return {'FINISHED'}
 
@@ -200,6 +288,7 @@ class EscherNewSpace(bpy.types.Operator):
   def execute(self, cx):
     pso = makePSO(self.newSpaceName)
     cx.scene.objects.link(pso)
+    registry.invalidate()
     self.report({'INFO'}, 'Created new Space, mesh, and PSO')
     return {'FINISHED'}
     
@@ -207,7 +296,7 @@ class EscherNewSpace(bpy.types.Operator):
     return cx.window_manager.invoke_props_dialog(self) 
 
 def removeSsosFromRemoteEmpty(eo, cx):
-  for o in eo.children:
+  for o in spaceRegistry().childrenOf(eo):
     if isSsoName(o.name):
       cx.scene.unlink(o)
 
@@ -272,24 +361,7 @@ def findUnusedPortalIndexInPSO(PSO):
   remote index, which corresponds to a particular EscherPortalMaterial.
   This function is used to find which EscherPortalMaterial should be
   assigned to a new Remote Object given the PSO it is intended for.'''
-  mats = list()
-  for ob in PSO.children:
-    if ob.type == 'EMPTY' and 'escher_remote_space_name' in ob:
-      if 'escher_portal_index' not in ob:
-        raise KeyError("Escher Remote Object should have an 'escher_portal_index' property!")
-      n = ob['escher_portal_index']
-      if type(n) is not int:
-        raise TypeError("Escher Remote Object property 'escher_portal_index' is not an int!")
-      if n in mats:
-        raise KeyError("Found duplicate 'escher_portal_index' property among PSO's Remote Objects!")
-      mats.append(n)
-  n = 0
-  mats.sort()
-  for mat in mats:
-    if n != mat:
-      return n
-    n += 1
-  return n
+  return spaceRegistry().unusedPortalIndex(PSO)
 
 def portalMaterialName2remoteIndex(matName):
   if not isPortalMaterialName(matName):
@@ -360,19 +432,16 @@ class EscherFocusSpace(bpy.types.Operator):
     else:
       psoName = self.enumprop
 
-    for ob in cx.scene.objects:
-      if ob.type == 'MESH':
-        hideGraph(ob)
-
     pso = bpy.data.objects[psoName]
-    showGraph(pso)
+    # Only touch the objects whose visibility changes
+    for ob, hide in spaceRegistry().focusChanges(cx.scene.objects, pso):
+      ob.hide = hide
     return {'FINISHED'}
 
   def invoke(self, context, event):
     self.choices.clear()
-    for ob in bpy.data.objects:
-      if ob.name.startswith('EscherPSO_'):
-        self.choices.add().name = ob.name
+    for name in spaceRegistry().psoNames():
+      self.choices.add().name = name
     context.window_manager.invoke_search_popup(self)
     return {'FINISHED'}
 
@@ -390,6 +459,7 @@ class EscherDeepCopy(bpy.types.Operator):
 
   def execute(self, cx):
     o = cloneGraph(cx.object, cx.scene)
+    registry.invalidate()
     bpy.ops.object.select_all(action='DESELECT')
     graphWalk(o, selectObject)
     return {'FINISHED'}
@@ -401,16 +471,69 @@ class EscherDeselectPortalFaces(bpy.types.Operator):
 
   @classmethod
   def poll(cls, cx):
-    return cx.mode == 'EDIT_MESH' and cx.object.type == 'MESH'
+    return hasSelectedFaces(cx)
 
   def execute(self, cx):
     me = cx.object.data
-    em = getEditMesh(cx)
-    for f in em.faces:
-      if isPortalMaterialName(me.materials[f.material_index].name):
-        f.select = False
+    portalSlots = portalMaterialSlots(me)
+    if portalSlots:
+      for f in selectedFaces(getEditMesh(cx)):
+        if f.material_index in portalSlots:
+          f.select = False
+      bmesh.update_edit_mesh(me, False, False)
     return {'FINISHED'}
 
+# The running live link, and whether the scene changed since it last published
+liveLink = {'server': None, 'dirty': False}
+
+class EscherLiveLink(bpy.types.Operator):
+  '''Streams the spaces changed by each edit to a running game; see escher_livelink.py'''
+  bl_idname = 'escher.live_link'
+  bl_label = 'Live Link'
+
+  address = bpy.props.StringProperty(name='Address', default=formatAddress(DEFAULT_ADDRESS))
+  binary = bpy.props.BoolProperty(name='Binary', description='Send spaces as .escb sections')
+  interval = bpy.props.FloatProperty(name='Interval', default=0.25, min=0.05)
+
+  def execute(self, cx):
+    if liveLink['server'] is not None:
+      # Pressed again: the running operator stops at its next tick
+      liveLink['server'].close()
+      liveLink['server'] = None
+      return {'FINISHED'}
+    try:
+      server = LiveLinkServer(parseAddress(self.address), ENCODING_ESCB if self.binary else ENCODING_ESC6)
+    except OSError as e:
+      self.report({'ERROR'}, 'Live link could not listen on %s: %s' % (self.address, e))
+      return {'CANCELLED'}
+    liveLink['server'] = self.server = server
+    liveLink['dirty'] = True
+    self.timer = cx.window_manager.event_timer_add(self.interval, cx.window)
+    cx.window_manager.modal_handler_add(self)
+    self.report({'INFO'}, 'Live link on %s' % formatAddress(server.address))
+    return {'RUNNING_MODAL'}
+
+  def modal(self, cx, event):
+    if liveLink['server'] is not self.server:
+      cx.window_manager.event_timer_remove(self.timer)
+      return {'FINISHED'}
+    if event.type == 'TIMER':
+      self.server.poll()
+      if liveLink['dirty']:
+        liveLink['dirty'] = False
+        if cx.edit_object is not None:
+          cx.edit_object.update_from_editmode()
+        exporter = importlib.import_module('export-escher')
+        # A scene caught half edited must not end the live link
+        try:
+          escherMap = exporter.buildMap(self, bpy.data.materials, bpy.data.objects, cx.scene)
+        except Exception as e:
+          self.report({'WARNING'}, 'Live link could not build the map: %s' % e)
+        else:
+          self.server.publish(escherMap)
+          self.server.poll()
+    return {'PASS_THROUGH'}
+
 def showGraph(ob):
   hideGraph(ob, False)
 
@@ -429,21 +552,57 @@ class NPanel(bpy.types.Panel):
     layout.operator('escher.portalize_face')
     layout.operator('escher.link_remote')
     layout.operator('escher.realize_remote')
+    layout.operator('escher.realize_remotes_deep')
+    layout.operator('escher.unrealize_remotes_deep')
     layout.operator('mesh.flip_normals', text='Flip Normals')
     layout.operator('escher.select_remote')
     layout.operator('escher.new_space')
     layout.operator('escher.focus_space')
     layout.operator('escher.deep_copy')
     layout.operator('escher.deselect_portals')
+    layout.operator('escher.live_link', text='Stop Live Link' if liveLink['server'] else 'Live Link')
+
+@bpy.app.handlers.persistent
+def invalidateRegistry(dummy):
+  registry.invalidate()
+
+@bpy.app.handlers.persistent
+def invalidateRegistryOnUpdate(scene):
+  # Objects renamed, reparented or with changed properties
+  if bpy.data.objects.is_updated:
+    registry.invalidate()
+
+@bpy.app.handlers.persistent
+def markLiveLinkDirty(scene):
+  data = bpy.data
+  if data.objects.is_updated or data.meshes.is_updated or data.materials.is_updated:
+    liveLink['dirty'] = True
+
+appHandlers = (
+  (bpy.app.handlers.load_post, invalidateRegistry),
+  (bpy.app.handlers.undo_post, invalidateRegistry),
+  (bpy.app.handlers.redo_post, invalidateRegistry),
+  (bpy.app.handlers.scene_update_post, invalidateRegistryOnUpdate),
+  (bpy.app.handlers.scene_update_post, markLiveLinkDirty),
+)
 
 def register():
   #bpy.types.Object.escher_space_name = bpy.props.EnumProperty(items=escher_space_names)
   bpy.types.Object
   bpy.utils.register_module(__name__)
+  for handlers, fn in appHandlers:
+    handlers.append(fn)
 
 def unregister():
   #del bpy.types.Object.escher_space_name
   bpy.utils.unregister_module(__name__)
+  for handlers, fn in appHandlers:
+    if fn in handlers:
+      handlers.remove(fn)
+  registry.invalidate()
+  if liveLink['server'] is not None:
+    liveLink['server'].close()
+    liveLink['server'] = None
 
 if __name__ == '__main__':
   register()
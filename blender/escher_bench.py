@@ -0,0 +1,160 @@
+# Copyright 2014 Don Viszneki
+# Export and parse benchmarks on synthetic Escher maps.
+
+"""
+Generates maps with escher_synth and times every stage a map goes
+through, in each format:
+
+  write esc6    writing the whole .esc6 file, formatting included
+  format        formatting every space's .esc6 block, without writing
+  validate      escher_reader.validate() on the .esc6 file
+  parse esc6    escher_reader.readEsc6() on the .esc6 file
+  write escb    escher_binary.writeEscb()
+  read escb     opening the .escb and converting every space back
+
+Each stage is timed on its own (best of --repeat runs), then run once
+more under tracemalloc for the peak memory of this process. Results,
+with throughput in MB/s of the file written or read and in faces/s, are
+printed and saved as JSON, so runs of different versions can be compared
+with --compare.
+
+Usage: python escher_bench.py [--maps NAME ...] [--repeat N] [--out FILE.json]
+                              [--compare OLD.json] [--workers N]
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from escher_binary import EscbFile, writeEscb
+from escher_map import formatSpaces, writeEsc6
+from escher_reader import readEsc6, validate
+from escher_synth import generators, mapCounts
+
+# name: (generator, keyword arguments)
+MAPS = {
+  'tunnel-small': ('tunnel', {'numSpaces': 16}),
+  'tunnel-large': ('tunnel', {'numSpaces': 256, 'sides': 32, 'rings': 32}),
+  'grid-small': ('grid', {'rows': 4, 'cols': 4}),
+  'grid-large': ('grid', {'rows': 32, 'cols': 32, 'subdivisions': 8, 'numSpawns': 4}),
+  'ngon-small': ('ngon', {'numSpaces': 2, 'numFaces': 2000}),
+  'ngon-large': ('ngon', {'numSpaces': 8, 'numFaces': 50000, 'sides': 12, 'numUVLayers': 2}),
+}
+DEFAULT_MAPS = ('tunnel-small', 'grid-small', 'ngon-small')
+
+def stages(escherMap, workdir, workers):
+  '''(name, file the stage writes or reads, function) for every stage.
+  Throughput of the format stage is measured against the .esc6 file.'''
+  esc6 = os.path.join(workdir, 'bench.esc6')
+  escb = os.path.join(workdir, 'bench.escb')
+
+  def writeEsc6File():
+    with open(esc6, 'w') as out:
+      writeEsc6(escherMap, out, formatSpaces(escherMap, workers=workers))
+
+  def parseEsc6():
+    with open(esc6, 'rb') as f:
+      readEsc6(f)
+
+  def writeEscbFile():
+    with open(escb, 'wb') as out:
+      writeEscb(escherMap, out)
+
+  def readEscb():
+    with EscbFile(escb) as f:
+      f.toMap()
+
+  return [
+    ('write esc6', esc6, writeEsc6File),
+    ('format', esc6, lambda: formatSpaces(escherMap, workers=workers)),
+    ('validate', esc6, lambda: validate(esc6)),
+    ('parse esc6', esc6, parseEsc6),
+    ('write escb', escb, writeEscbFile),
+    ('read escb', escb, readEscb),
+  ]
+
+def runStage(fn, repeat):
+  '''Returns the best time of repeat runs of fn, and its peak traced
+  memory in bytes on one more run.'''
+  best = None
+  for i in range(repeat):
+    t0 = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - t0
+    best = seconds if best is None else min(best, seconds)
+  tracemalloc.start()
+  try:
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+  finally:
+    tracemalloc.stop()
+  return best, peak
+
+def benchMap(name, repeat=3, workers=1):
+  generator, params = MAPS[name]
+  t0 = time.perf_counter()
+  escherMap = generators[generator](**params)
+  counts = mapCounts(escherMap)
+  result = {'map': name, 'generator': generator, 'params': params, 'counts': counts,
+    'generateSeconds': time.perf_counter() - t0, 'stages': {}}
+  workdir = tempfile.mkdtemp(prefix='escher-bench-')
+  try:
+    for stage, filename, fn in stages(escherMap, workdir, workers):
+      seconds, peak = runStage(fn, repeat)
+      size = os.path.getsize(filename)
+      result['stages'][stage] = {
+        'seconds': seconds,
+        'bytes': size,
+        'mbPerSecond': size / seconds / 1e6 if seconds else None,
+        'facesPerSecond': counts['faces'] / seconds if seconds else None,
+        'peakBytes': peak,
+      }
+  finally:
+    shutil.rmtree(workdir)
+  return result
+
+def printResult(result, old=None):
+  counts = result['counts']
+  print('%s: %d spaces, %d verts, %d faces' % (result['map'], counts['spaces'], counts['verts'],
+    counts['faces']))
+  for stage, r in result['stages'].items():
+    line = '  %-10s %9.4fs %8.1f MB/s %11.0f faces/s %8.1f MB peak' % (stage, r['seconds'],
+      r['mbPerSecond'] or 0, r['facesPerSecond'] or 0, r['peakBytes'] / 1e6)
+    if old is not None and stage in old['stages'] and r['seconds']:
+      line += '  %5.2fx' % (old['stages'][stage]['seconds'] / r['seconds'])
+    print(line)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark exporting and parsing synthetic maps.')
+  parser.add_argument('--maps', nargs='+', choices=sorted(MAPS), default=DEFAULT_MAPS)
+  parser.add_argument('--repeat', type=int, default=3)
+  parser.add_argument('--workers', type=int, default=1,
+    help='processes formatting spaces; 0 uses one per CPU')
+  parser.add_argument('--out', help='write the results to this JSON file')
+  parser.add_argument('--compare', help='print speedups relative to this earlier JSON file')
+  args = parser.parse_args()
+
+  previous = {}
+  if args.compare:
+    with open(args.compare) as f:
+      previous = {r['map']: r for r in json.load(f)['results']}
+  results = []
+  for name in args.maps:
+    result = benchMap(name, args.repeat, args.workers)
+    printResult(result, previous.get(name))
+    results.append(result)
+  if args.out:
+    report = {
+      'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+      'python': sys.version.split()[0],
+      'platform': platform.platform(),
+      'repeat': args.repeat,
+      'workers': args.workers,
+      'results': results,
+    }
+    with open(args.out, 'w') as f:
+      json.dump(report, f, indent=2, sort_keys=True)
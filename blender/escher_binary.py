@@ -0,0 +1,432 @@
+# Copyright 2014 Don Viszneki
+# Binary, memory-mappable Escher map format (.escb).
+
+"""
+.escb holds the same data as .esc6, laid out so that a loader can map the
+file into memory and use its arrays in place instead of parsing text.
+
+Everything is little-endian, and every section starts on an 8 byte
+boundary. A file is a HEADER, followed by the material table, then each
+space's sections, then each space's section directory, and finally the
+space table (one SPACE_ENTRY per space) pointing at those directories.
+
+A section directory is a list of SECTION entries (tag, item count, file
+offset, size in bytes). Readers skip tags they do not know about, so more
+per-space data can be added later without breaking old readers. The core
+tags are:
+
+  HEAD  numVerts numFaces numLoops numUVLayers numRemotes numSpawns (u32)
+  VERT  xyz per vertex (real)
+  FTOT  loops per face (u32); each face's loops are stored consecutively
+  FKND  FACE_MAT or FACE_REMOTE per face (u8)
+  FIDS  material or remote index per face (i32)
+  LVRT  vertex index per loop (u32)
+  LUV   uv pair per loop, for each UV layer in turn (real)
+  LNRM  xyz normal per loop (real)
+  RSPC  remote space index per remote (i32)
+  RXFM  translation xyz and orientation xyz per remote (f64)
+  SPWN  spawns, see packSpawns()
+  FSRC  source face index per face (i32), only if the space has them
+
+In spaces written with a Quantization, VERT, LUV and LNRM are replaced
+by the quantized sections described in escher_quantize.py. EscbSpace
+decodes them, so its verts, uvs and loopNormals are the same either way.
+
+"real" is f32 or f64, as given by the header's realSize. Maps exported from
+Blender use f32, which is what Blender stores. Maps converted from .esc6
+use f64, so that converting back to .esc6 reproduces the original file.
+
+Usage: python escher_binary.py IN.esc6 OUT.escb
+       python escher_binary.py IN.escb OUT.esc6
+"""
+import mmap
+import struct
+import sys
+from array import array
+from escher_mesh import MeshArrays
+from escher_map import EscherMap, Material, Remote, Spawn, Space, writeEsc6
+from escher_reader import readEsc6
+from escher_quantize import QUANT_POS, dequantizeNormals, dequantizeUVs, dequantizeVerts, \
+    positionTypecode
+
+MAGIC = b'ESCB'
+VERSION = 1
+
+# magic, version, realSize, numMaterials, numSpaces, reserved,
+# material table offset, space table offset
+HEADER = struct.Struct('<4sIIIIIQQ')
+# section directory offset, number of sections, reserved
+SPACE_ENTRY = struct.Struct('<QII')
+# tag, item count, offset, size in bytes
+SECTION = struct.Struct('<4sIQQ')
+SPACE_HEAD = struct.Struct('<6I')
+# translation, orientation, len(type), has path, path length in reals
+SPAWN = struct.Struct('<6dIII')
+
+realTypecodes = {4: 'f', 8: 'd'}
+
+def leBytes(a, typecode):
+  '''The little-endian bytes of array a converted to typecode.'''
+  if a.typecode != typecode or sys.byteorder != 'little':
+    a = array(typecode, a)
+  if sys.byteorder != 'little':
+    a.byteswap()
+  return a.tobytes()
+
+def copyArray(a, typecode):
+  '''Copies a view returned by EscbSpace.view() into a new array.'''
+  if isinstance(a, memoryview):
+    r = array(typecode)
+    r.frombytes(a.cast('B'))
+    return r
+  return array(typecode, a)
+
+def pad8(b):
+  return b + bytes(-len(b) % 8)
+
+def packString(s):
+  b = s.encode('utf-8')
+  return struct.pack('<I', len(b)) + b
+
+def unpackString(buf, offset):
+  n, = struct.unpack_from('<I', buf, offset)
+  offset += 4
+  return bytes(buf[offset:offset+n]).decode('utf-8'), offset + n
+
+def packMaterials(materials):
+  '''For each material: its name, u32 number of textures, and then the map
+  type and file name of each texture. Strings are a u32 byte length
+  followed by UTF-8.'''
+  parts = []
+  for mat in materials:
+    parts.append(packString(mat.name))
+    parts.append(struct.pack('<I', len(mat.textures)))
+    for texMapType, textureFileName in mat.textures:
+      parts.append(packString(texMapType))
+      parts.append(packString(textureFileName))
+  return b''.join(parts)
+
+def unpackMaterials(buf, offset, numMaterials):
+  materials = []
+  for i in range(numMaterials):
+    name, offset = unpackString(buf, offset)
+    numTex, = struct.unpack_from('<I', buf, offset)
+    offset += 4
+    textures = []
+    for j in range(numTex):
+      texMapType, offset = unpackString(buf, offset)
+      textureFileName, offset = unpackString(buf, offset)
+      textures.append((texMapType, textureFileName))
+    materials.append(Material(name, textures))
+  return materials
+
+def packSpawns(spawns):
+  '''For each spawn: a SPAWN record, its type padded to 8 bytes, then its
+  path as f64 xyz triples.'''
+  parts = []
+  for spawn in spawns:
+    typeBytes = spawn.type.encode('utf-8')
+    path = spawn.path if spawn.path is not None else array('d')
+    parts.append(SPAWN.pack(*(spawn.translation + spawn.orientation +
+      (len(typeBytes), spawn.path is not None, len(path)))))
+    parts.append(pad8(typeBytes))
+    parts.append(leBytes(path, 'd'))
+  return b''.join(parts)
+
+def unpackSpawns(buf, count):
+  spawns = []
+  offset = 0
+  for i in range(count):
+    fields = SPAWN.unpack_from(buf, offset)
+    typeLen, hasPath, pathLen = fields[6:]
+    offset += SPAWN.size
+    spawnType = bytes(buf[offset:offset+typeLen]).decode('utf-8')
+    offset += typeLen + (-typeLen % 8)
+    path = None
+    if hasPath:
+      path = array('d', bytes(buf[offset:offset+8*pathLen]))
+      if sys.byteorder != 'little':
+        path.byteswap()
+    offset += 8 * pathLen
+    spawns.append(Spawn(spawnType, fields[0:3], fields[3:6], path))
+  return spawns
+
+def compactLoops(mesh):
+  '''Returns loopVerts, uvLayers and loopNormals with each face's loops
+  stored consecutively in face order, as .escb requires.'''
+  start = 0
+  for loopStart, total in zip(mesh.loopStarts, mesh.loopTotals):
+    if loopStart != start:
+      break
+    start += total
+  else:
+    return mesh.loopVerts, mesh.uvLayers, mesh.loopNormals
+  order = [li for s, n in zip(mesh.loopStarts, mesh.loopTotals) for li in range(s, s + n)]
+  loopVerts = array(mesh.loopVerts.typecode, (mesh.loopVerts[li] for li in order))
+  uvLayers = []
+  for uvs in mesh.uvLayers:
+    uvLayers.append(array(uvs.typecode, (uvs[2*li+k] for li in order for k in (0, 1))))
+  normals = mesh.loopNormals
+  loopNormals = array(normals.typecode, (normals[3*li+k] for li in order for k in (0, 1, 2)))
+  return loopVerts, uvLayers, loopNormals
+
+def quantizedSections(q, numLoops, real):
+  '''The (tag, count, bytes) sections of an escher_quantize.QuantizedSpace.'''
+  uvRanges = array('d')
+  for r in q.uvRanges:
+    uvRanges.extend(r)
+  return [
+    (b'QPOS', 1, QUANT_POS.pack(*(q.origin + q.step + (q.bits, len(q.exactVerts))))),
+    (b'QVRT', len(q.positions) // 3, leBytes(q.positions, positionTypecode(q.bits))),
+    (b'QEXV', len(q.exactVerts), leBytes(q.exactVerts, 'I')),
+    (b'QEXP', len(q.exactVerts), leBytes(q.exactCo, real)),
+    (b'QUVR', len(q.uvRanges), leBytes(uvRanges, 'd')),
+    (b'QUV ', numLoops * len(q.uvRanges), leBytes(q.uvs, 'H')),
+    (b'QNRM', numLoops, leBytes(q.normals, 'h')),
+  ]
+
+def spaceSections(space, real, quantization=None):
+  '''The (tag, count, bytes) core sections of a space, with quantized
+  attributes if quantization, an escher_quantize.Quantization, is given.'''
+  mesh = space.mesh
+  loopVerts, uvLayers, loopNormals = compactLoops(mesh)
+  numLoops = len(loopVerts)
+  xfms = array('d')
+  for remote in space.remotes:
+    xfms.extend(remote.translation + remote.orientation)
+  if quantization is None:
+    attributes = [
+      (b'VERT', mesh.numVerts, leBytes(mesh.verts, real)),
+      (b'LUV ', numLoops * len(uvLayers), b''.join(leBytes(uvs, real) for uvs in uvLayers)),
+      (b'LNRM', numLoops, leBytes(loopNormals, real)),
+    ]
+  else:
+    q = quantization.quantize(space, uvLayers, loopNormals, real)
+    attributes = quantizedSections(q, numLoops, real)
+  return [
+    (b'HEAD', 1, SPACE_HEAD.pack(mesh.numVerts, mesh.numFaces, numLoops,
+      len(uvLayers), len(space.remotes), len(space.spawns))),
+    (b'FTOT', mesh.numFaces, leBytes(mesh.loopTotals, 'I')),
+    (b'FKND', mesh.numFaces, leBytes(space.faceKinds, 'B')),
+    (b'FIDS', mesh.numFaces, leBytes(space.faceIds, 'i')),
+    (b'LVRT', numLoops, leBytes(loopVerts, 'I')),
+  ] + attributes + [
+    (b'RSPC', len(space.remotes), leBytes(array('i', (r.space for r in space.remotes)), 'i')),
+    (b'RXFM', len(space.remotes), leBytes(xfms, 'd')),
+    (b'SPWN', len(space.spawns), packSpawns(space.spawns)),
+  ] + ([] if space.sourceFaces is None else
+    [(b'FSRC', mesh.numFaces, leBytes(space.sourceFaces, 'i'))])
+
+def writeEscb(escherMap, out, realSize=None, extraSections=None, quantization=None):
+  '''Writes escherMap in .escb format to the binary file object out.
+
+  realSize defaults to 8 if the map's geometry is held in f64 arrays, and
+  4 otherwise. extraSections, if given, is called as
+  extraSections(iSpace, space) and returns more (tag, count, bytes)
+  sections to store with the space. quantization, if given, is an
+  escher_quantize.Quantization to quantize every space with.'''
+  if realSize is None:
+    realSize = 8 if escherMap.spaces and escherMap.spaces[0].mesh.verts.itemsize == 8 else 4
+  real = realTypecodes[realSize]
+
+  def write(b):
+    out.write(b)
+    out.write(bytes(-len(b) % 8))
+
+  out.write(bytes(HEADER.size))
+  materialsOffset = out.tell()
+  write(packMaterials(escherMap.materials))
+
+  spaceEntries = []
+  for iSpace, space in enumerate(escherMap.spaces):
+    sections = spaceSections(space, real, quantization)
+    if extraSections is not None:
+      sections += extraSections(iSpace, space)
+    directory = []
+    for tag, count, data in sections:
+      directory.append(SECTION.pack(tag, count, out.tell(), len(data)))
+      write(data)
+    spaceEntries.append(SPACE_ENTRY.pack(out.tell(), len(directory), 0))
+    write(b''.join(directory))
+
+  spaceTableOffset = out.tell()
+  write(b''.join(spaceEntries))
+  out.seek(0)
+  out.write(HEADER.pack(MAGIC, VERSION, realSize, len(escherMap.materials),
+    len(escherMap.spaces), 0, materialsOffset, spaceTableOffset))
+
+class EscbSpace:
+  '''One space of an EscbFile. Arrays are views straight into the mapped
+  file; nothing is copied until toSpace() is called.'''
+
+  def __init__(self, escb, offset, numSections):
+    self.escb = escb
+    self.sections = {}
+    for i in range(numSections):
+      tag, count, dataOffset, size = SECTION.unpack_from(escb.buf, offset + i * SECTION.size)
+      self.sections[tag] = (count, dataOffset, size)
+    (self.numVerts, self.numFaces, self.numLoops, self.numUVLayers,
+      self.numRemotes, self.numSpawns) = SPACE_HEAD.unpack(self.raw(b'HEAD'))
+
+  def raw(self, tag):
+    '''The bytes of a section as a memoryview, or None if the space has no
+    such section.'''
+    if tag not in self.sections:
+      return None
+    count, offset, size = self.sections[tag]
+    return self.escb.buf[offset:offset+size]
+
+  def view(self, tag, typecode):
+    '''A section as a flat sequence of typecode items. On little-endian
+    machines this is a memoryview of the mapped file.'''
+    buf = self.raw(tag)
+    if sys.byteorder == 'little':
+      return buf.cast(typecode)
+    a = array(typecode, buf.tobytes())
+    a.byteswap()
+    return a
+
+  @property
+  def quantized(self):
+    return b'QPOS' in self.sections
+
+  @property
+  def verts(self):
+    if self.quantized:
+      fields = QUANT_POS.unpack(self.raw(b'QPOS'))
+      return dequantizeVerts(self.view(b'QVRT', positionTypecode(fields[6])), fields[0:3],
+        fields[3:6], self.view(b'QEXV', 'I'), self.view(b'QEXP', self.escb.real), self.escb.real)
+    return self.view(b'VERT', self.escb.real)
+
+  @property
+  def loopTotals(self):
+    return self.view(b'FTOT', 'I')
+
+  @property
+  def faceKinds(self):
+    return self.view(b'FKND', 'B')
+
+  @property
+  def faceIds(self):
+    return self.view(b'FIDS', 'i')
+
+  @property
+  def loopVerts(self):
+    return self.view(b'LVRT', 'I')
+
+  @property
+  def uvs(self):
+    '''All UV layers; layer n is uvs[2*n*numLoops:2*(n+1)*numLoops].'''
+    if self.quantized:
+      ranges = self.view(b'QUVR', 'd')
+      uvRanges = [tuple(ranges[4*i:4*i+4]) for i in range(self.numUVLayers)]
+      uvs = array(self.escb.real)
+      for layer in dequantizeUVs(self.view(b'QUV ', 'H'), uvRanges, self.escb.real):
+        uvs.extend(layer)
+      return uvs
+    return self.view(b'LUV ', self.escb.real)
+
+  @property
+  def loopNormals(self):
+    if self.quantized:
+      return dequantizeNormals(self.view(b'QNRM', 'h'), self.escb.real)
+    return self.view(b'LNRM', self.escb.real)
+
+  @property
+  def remoteSpaces(self):
+    return self.view(b'RSPC', 'i')
+
+  @property
+  def remoteTransforms(self):
+    return self.view(b'RXFM', 'd')
+
+  def toSpace(self):
+    '''Copies this space into an escher_map.Space.'''
+    real = self.escb.real
+    loopTotals = copyArray(self.loopTotals, 'I')
+    loopStarts = array('i', bytes(4 * len(loopTotals)))
+    start = 0
+    for i, n in enumerate(loopTotals):
+      loopStarts[i] = start
+      start += n
+    uvs = self.uvs
+    n = 2 * self.numLoops
+    mesh = MeshArrays(copyArray(self.verts, real), loopStarts, loopTotals,
+      copyArray(self.loopVerts, 'I'),
+      [copyArray(uvs[i*n:(i+1)*n], real) for i in range(self.numUVLayers)],
+      copyArray(self.loopNormals, real), None)
+    xfms = self.remoteTransforms
+    remotes = [Remote(s, xfms[6*i:6*i+3], xfms[6*i+3:6*i+6]) for i, s in enumerate(self.remoteSpaces)]
+    spawns = unpackSpawns(self.raw(b'SPWN'), self.numSpawns)
+    sourceFaces = None
+    if b'FSRC' in self.sections:
+      sourceFaces = copyArray(self.view(b'FSRC', 'i'), 'i')
+    return Space(None, mesh, copyArray(self.faceKinds, 'B'), copyArray(self.faceIds, 'i'),
+      remotes, spawns, sourceFaces)
+
+class EscbFile:
+  '''A memory-mapped .escb map. Close it (or use it as a context manager)
+  only once all views taken from it have been released.'''
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.file = open(filename, 'rb')
+    self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+    self.buf = memoryview(self.mm)
+    (magic, version, realSize, numMaterials, numSpaces, reserved,
+      materialsOffset, spaceTableOffset) = HEADER.unpack_from(self.buf)
+    if magic != MAGIC:
+      raise ValueError('"%s" is not an Escher binary map' % filename)
+    if version != VERSION:
+      raise ValueError('unsupported Escher binary map version %d' % version)
+    self.real = realTypecodes[realSize]
+    self.materials = unpackMaterials(self.buf, materialsOffset, numMaterials)
+    self.spaceEntries = [SPACE_ENTRY.unpack_from(self.buf, spaceTableOffset + i * SPACE_ENTRY.size)
+      for i in range(numSpaces)]
+
+  def __len__(self):
+    return len(self.spaceEntries)
+
+  def space(self, i):
+    offset, numSections, reserved = self.spaceEntries[i]
+    return EscbSpace(self, offset, numSections)
+
+  def toMap(self):
+    '''Copies the whole map into an escher_map.EscherMap.'''
+    escherMap = EscherMap()
+    for mat in self.materials:
+      escherMap.addMaterial(mat)
+    for i in range(len(self)):
+      escherMap.addSpace(self.space(i).toSpace())
+    return escherMap
+
+  def close(self):
+    self.buf.release()
+    self.mm.close()
+    self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+def esc6ToEscb(inFilename, outFilename):
+  with open(inFilename, 'rb') as f:
+    escherMap = readEsc6(f)
+  with open(outFilename, 'wb') as out:
+    writeEscb(escherMap, out, realSize=8)
+
+def escbToEsc6(inFilename, outFilename):
+  with EscbFile(inFilename) as escb:
+    escherMap = escb.toMap()
+  with open(outFilename, 'w') as out:
+    writeEsc6(escherMap, out)
+
+if __name__ == '__main__':
+  if len(sys.argv) != 3:
+    sys.exit(__doc__.split('Usage: ')[1])
+  if sys.argv[1].endswith('.escb'):
+    escbToEsc6(sys.argv[1], sys.argv[2])
+  else:
+    esc6ToEscb(sys.argv[1], sys.argv[2])
@@ -0,0 +1,298 @@
+# Copyright 2014 Don Viszneki
+# Per-space bounding volume hierarchies for Escher spaces.
+
+"""
+The camera collision code in src/ants/escher.d tests each movement
+against every face of the current space with rayTriangleIntersect(). This
+module builds, at export time, a bounding volume hierarchy over the
+triangles of each space's collidable faces (faces are fan triangulated
+as the game does), split with a binned surface area heuristic, so a
+movement only has to be tested against the triangles in the boxes it
+passes through.
+
+The hierarchy is stored depth first, so an interior node's first child
+directly follows it, in .escb as these optional sections:
+
+  BNOD  per node: for a leaf, its first triangle and triangle count; for
+        an interior node, the index of its second child and 0 (i32 x 2)
+  BBOX  per node: min xyz, max xyz (f64 x 6)
+  BTRI  per triangle: vertex indices (u32 x 3)
+  BFAC  per triangle: the face it was cut from (u32)
+
+Usage: python escher_bvh.py MAP.esc6 [NUMQUERIES]
+Times rayQuery() against rayQueryBruteForce() on random movements.
+"""
+import sys
+import time
+from array import array
+from escher_binary import leBytes
+from escher_collision import collidableFaces, randomMovements
+from escher_map import FACE_MAT
+
+NUM_BINS = 16
+MAX_LEAF_SIZE = 4
+# Cost of visiting a node relative to testing a triangle
+TRAVERSAL_COST = 1.0
+
+class BVH:
+  '''A flat bounding volume hierarchy; see the module docstring.'''
+  __slots__ = ('nodes', 'bounds', 'triVerts', 'triFaces')
+
+  def __init__(self, nodes, bounds, triVerts, triFaces):
+    self.nodes = nodes
+    self.bounds = bounds
+    self.triVerts = triVerts
+    self.triFaces = triFaces
+
+  def __len__(self):
+    return len(self.nodes) // 2
+
+  def sections(self):
+    '''The .escb (tag, count, bytes) sections of this hierarchy.'''
+    return [
+      (b'BNOD', len(self), leBytes(self.nodes, 'i')),
+      (b'BBOX', len(self), leBytes(self.bounds, 'd')),
+      (b'BTRI', len(self.triFaces), leBytes(self.triVerts, 'I')),
+      (b'BFAC', len(self.triFaces), leBytes(self.triFaces, 'I')),
+    ]
+
+  @classmethod
+  def fromEscb(cls, escbSpace):
+    '''The hierarchy stored in an escher_binary.EscbSpace, viewed in place,
+    or None if the space has none.'''
+    if b'BNOD' not in escbSpace.sections:
+      return None
+    return cls(escbSpace.view(b'BNOD', 'i'), escbSpace.view(b'BBOX', 'd'),
+      escbSpace.view(b'BTRI', 'I'), escbSpace.view(b'BFAC', 'I'))
+
+def spaceTriangles(space, kinds=(FACE_MAT,)):
+  '''(face, vertex, vertex, vertex) for the fan triangles of every face of
+  space whose kind is in kinds.'''
+  mesh = space.mesh
+  tris = []
+  for iFace in collidableFaces(space, kinds):
+    start = mesh.loopStarts[iFace]
+    loopVerts = mesh.loopVerts[start:start + mesh.loopTotals[iFace]]
+    for n in range(2, len(loopVerts)):
+      tris.append((iFace, loopVerts[0], loopVerts[n-1], loopVerts[n]))
+  return tris
+
+def surfaceArea(lo, hi):
+  dx, dy, dz = hi[0] - lo[0], hi[1] - lo[1], hi[2] - lo[2]
+  return 2 * (dx*dy + dy*dz + dz*dx)
+
+def growBox(box, lo, hi):
+  if box is None:
+    return list(lo), list(hi)
+  blo, bhi = box
+  return [min(blo[k], lo[k]) for k in range(3)], [max(bhi[k], hi[k]) for k in range(3)]
+
+def buildBVH(space, kinds=(FACE_MAT,)):
+  '''Builds a BVH over the triangles of the faces of space whose kind is
+  in kinds.'''
+  verts = space.mesh.verts
+  tris = spaceTriangles(space, kinds)
+  triLo = []
+  triHi = []
+  centroids = []
+  for iFace, a, b, c in tris:
+    points = [verts[3*vi:3*vi+3] for vi in (a, b, c)]
+    triLo.append([min(p[k] for p in points) for k in range(3)])
+    triHi.append([max(p[k] for p in points) for k in range(3)])
+    centroids.append([sum(p[k] for p in points) / 3 for k in range(3)])
+
+  order = list(range(len(tris)))
+  nodes = array('i')
+  bounds = array('d')
+
+  def split(first, count):
+    '''Returns the index in order[first:first+count] to split the range at,
+    after reordering it, or None to make a leaf.'''
+    if count <= MAX_LEAF_SIZE:
+      return None
+    indices = order[first:first+count]
+    clo = [min(centroids[i][k] for i in indices) for k in range(3)]
+    chi = [max(centroids[i][k] for i in indices) for k in range(3)]
+    axis = max(range(3), key=lambda k: chi[k] - clo[k])
+    extent = chi[axis] - clo[axis]
+    if extent <= 0:
+      return None
+    scale = NUM_BINS / extent
+    def binOf(i):
+      return min(int((centroids[i][axis] - clo[axis]) * scale), NUM_BINS - 1)
+    binCounts = [0] * NUM_BINS
+    binBoxes = [None] * NUM_BINS
+    for i in indices:
+      b = binOf(i)
+      binCounts[b] += 1
+      binBoxes[b] = growBox(binBoxes[b], triLo[i], triHi[i])
+    # Sweep from the right, then from the left, to cost every bin boundary
+    rightCosts = [0.0] * NUM_BINS
+    box = None
+    n = 0
+    for b in range(NUM_BINS - 1, 0, -1):
+      if binBoxes[b] is not None:
+        box = growBox(box, *binBoxes[b])
+      n += binCounts[b]
+      rightCosts[b] = surfaceArea(*box) * n if n else 0.0
+    best = None
+    box = None
+    n = 0
+    for b in range(NUM_BINS - 1):
+      if binBoxes[b] is not None:
+        box = growBox(box, *binBoxes[b])
+      n += binCounts[b]
+      if n == 0 or n == count:
+        continue
+      cost = surfaceArea(*box) * n + rightCosts[b+1]
+      if best is None or cost < best[0]:
+        best = (cost, b)
+    lo = [min(triLo[i][k] for i in indices) for k in range(3)]
+    hi = [max(triHi[i][k] for i in indices) for k in range(3)]
+    area = surfaceArea(lo, hi)
+    if best is None:
+      return None
+    # Small ranges are only split if that is expected to be cheaper
+    if count <= 4 * MAX_LEAF_SIZE and area > 0 and TRAVERSAL_COST + best[0] / area >= count:
+      return None
+    left = [i for i in indices if binOf(i) <= best[1]]
+    right = [i for i in indices if binOf(i) > best[1]]
+    order[first:first+count] = left + right
+    return first + len(left)
+
+  def build(first, count):
+    iNode = len(nodes) // 2
+    indices = order[first:first+count]
+    bounds.extend([min(triLo[i][k] for i in indices) for k in range(3)])
+    bounds.extend([max(triHi[i][k] for i in indices) for k in range(3)])
+    nodes.extend((first, count))
+    middle = split(first, count)
+    if middle is not None:
+      build(first, middle - first)
+      nodes[2*iNode] = len(nodes) // 2
+      nodes[2*iNode+1] = 0
+      build(middle, first + count - middle)
+
+  if tris:
+    build(0, len(tris))
+  triVerts = array('I', [v for i in order for v in tris[i][1:]])
+  triFaces = array('I', [tris[i][0] for i in order])
+  return BVH(nodes, bounds, triVerts, triFaces)
+
+def segmentTriangle(start, movement, p0, p1, p2, epsilon=0.000001):
+  '''Like rayTriangleIntersect() in the game: returns the fraction of
+  movement from start at which it crosses the triangle, from either side,
+  or None.'''
+  e1 = (p1[0] - p0[0], p1[1] - p0[1], p1[2] - p0[2])
+  e2 = (p2[0] - p0[0], p2[1] - p0[1], p2[2] - p0[2])
+  dx, dy, dz = movement
+  px, py, pz = dy*e2[2] - dz*e2[1], dz*e2[0] - dx*e2[2], dx*e2[1] - dy*e2[0]
+  det = e1[0]*px + e1[1]*py + e1[2]*pz
+  if -epsilon < det < epsilon:
+    return None
+  inv = 1.0 / det
+  tx, ty, tz = start[0] - p0[0], start[1] - p0[1], start[2] - p0[2]
+  u = (tx*px + ty*py + tz*pz) * inv
+  if u < 0.0 or u > 1.0:
+    return None
+  qx, qy, qz = ty*e1[2] - tz*e1[1], tz*e1[0] - tx*e1[2], tx*e1[1] - ty*e1[0]
+  v = (dx*qx + dy*qy + dz*qz) * inv
+  if v < 0.0 or u + v > 1.0:
+    return None
+  t = (e2[0]*qx + e2[1]*qy + e2[2]*qz) * inv
+  return t if 0.0 <= t <= 1.0 else None
+
+def segmentBox(start, inverse, lo, hi, tMax):
+  '''Whether the segment start + t * movement, 0 <= t <= tMax, touches the
+  box; inverse holds 1 / movement per axis.'''
+  t0, t1 = 0.0, tMax
+  for k in range(3):
+    if inverse[k] is None:
+      if start[k] < lo[k] or start[k] > hi[k]:
+        return False
+      continue
+    ta = (lo[k] - start[k]) * inverse[k]
+    tb = (hi[k] - start[k]) * inverse[k]
+    if ta > tb:
+      ta, tb = tb, ta
+    t0 = max(t0, ta)
+    t1 = min(t1, tb)
+    if t0 > t1:
+      return False
+  return True
+
+def rayQuery(bvh, space, start, end):
+  '''Returns (t, iFace) for the first triangle of bvh that the movement
+  from start to end passes through, t being the fraction of the movement
+  made before the hit, or None if it hits nothing.'''
+  if not len(bvh):
+    return None
+  verts = space.mesh.verts
+  nodes = bvh.nodes
+  bounds = bvh.bounds
+  triVerts = bvh.triVerts
+  movement = (end[0] - start[0], end[1] - start[1], end[2] - start[2])
+  inverse = [1.0 / m if m else None for m in movement]
+  best = None
+  stack = [0]
+  while stack:
+    iNode = stack.pop()
+    tMax = best[0] if best is not None else 1.0
+    if not segmentBox(start, inverse, bounds[6*iNode:6*iNode+3], bounds[6*iNode+3:6*iNode+6], tMax):
+      continue
+    first, count = nodes[2*iNode], nodes[2*iNode+1]
+    if count == 0:
+      stack.append(first)
+      stack.append(iNode + 1)
+      continue
+    for iTri in range(first, first + count):
+      a, b, c = triVerts[3*iTri:3*iTri+3]
+      t = segmentTriangle(start, movement, verts[3*a:3*a+3], verts[3*b:3*b+3], verts[3*c:3*c+3])
+      if t is not None and (best is None or t < best[0]):
+        best = (t, bvh.triFaces[iTri])
+  return best
+
+def rayQueryBruteForce(space, start, end, kinds=(FACE_MAT,)):
+  '''Like rayQuery(), but tests the movement against every triangle, as
+  the game does today.'''
+  verts = space.mesh.verts
+  movement = (end[0] - start[0], end[1] - start[1], end[2] - start[2])
+  best = None
+  for iFace, a, b, c in spaceTriangles(space, kinds):
+    t = segmentTriangle(start, movement, verts[3*a:3*a+3], verts[3*b:3*b+3], verts[3*c:3*c+3])
+    if t is not None and (best is None or t < best[0]):
+      best = (t, iFace)
+  return best
+
+def benchmark(escherMap, numQueries=1000):
+  '''Times rayQuery() and rayQueryBruteForce() on the same random
+  movements in every space. Returns a list of (space index, triangles,
+  nodes, build seconds, brute force seconds, BVH seconds, disagreements).'''
+  results = []
+  for iSpace, space in enumerate(escherMap.spaces):
+    if not space.numVerts:
+      continue
+    t0 = time.perf_counter()
+    bvh = buildBVH(space)
+    t1 = time.perf_counter()
+    movements = randomMovements(space, numQueries, seed=iSpace)
+    expected = [rayQueryBruteForce(space, s, e) for s, e in movements]
+    t2 = time.perf_counter()
+    got = [rayQuery(bvh, space, s, e) for s, e in movements]
+    t3 = time.perf_counter()
+    disagreements = sum((a is None) != (b is None) or (a is not None and a[0] != b[0])
+      for a, b in zip(expected, got))
+    results.append((iSpace, len(bvh.triFaces), len(bvh), t1 - t0, t2 - t1, t3 - t2, disagreements))
+  return results
+
+if __name__ == '__main__':
+  from escher_reader import readEsc6
+  if len(sys.argv) not in (2, 3):
+    sys.exit(__doc__.split('Usage: ')[1])
+  with open(sys.argv[1], 'rb') as f:
+    escherMap = readEsc6(f)
+  numQueries = int(sys.argv[2]) if len(sys.argv) == 3 else 1000
+  print('space triangles  nodes      build  brute force          BVH  speedup  disagreements')
+  for iSpace, numTris, numNodes, build, brute, bvh, disagreements in benchmark(escherMap, numQueries):
+    print('%5d %9d %6d %9.4fs %11.4fs %11.4fs %7.1fx %14d' % (iSpace, numTris, numNodes, build,
+      brute, bvh, brute / bvh if bvh else 0, disagreements))
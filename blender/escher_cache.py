@@ -0,0 +1,110 @@
+# Copyright 2014 Don Viszneki
+# Incremental export cache for the Escher map exporter.
+
+"""
+Keeps each space's serialized .esc6 block on disk, keyed by a hash of
+everything that goes into the block, so an export only has to format the
+spaces which changed since the last one.
+
+A space's key covers its extracted mesh arrays (vertices, loops, UVs and
+normals), its faces' resolved material and remote indices, its remotes and
+spawns, its own index, and the map's material and space tables. Anything
+that would change the space's block changes its key, so spliced output is
+always identical to a full export.
+"""
+import hashlib
+import os
+from escher_map import formatSpaces
+from escher_profile import NULL_PROFILE, profiledSpaceBlocks
+
+# Bump this whenever formatSpace()'s output changes, to invalidate old caches
+CACHE_VERSION = 1
+
+CACHE_SUFFIX = '.esc6part'
+
+def mapDigest(escherMap):
+  '''Hash of the global tables every space's key depends on.'''
+  h = hashlib.sha1(b'escher cache %d\0' % CACHE_VERSION)
+  for mat in escherMap.materials:
+    h.update(repr((mat.name, mat.textures)).encode('utf-8') + b'\0')
+  h.update(b'\1')
+  for space in escherMap.spaces:
+    h.update(repr(space.name).encode('utf-8') + b'\0')
+  return h.digest()
+
+def spaceKey(space, iSpace, digest):
+  '''The cache key of space, which is space number iSpace of a map with
+  mapDigest() digest.'''
+  h = hashlib.sha1(digest)
+  mesh = space.mesh
+  h.update(b'%d %d %d\0' % (iSpace, len(mesh.uvLayers), mesh.verts.itemsize))
+  arrays = [mesh.verts, mesh.loopStarts, mesh.loopTotals, mesh.loopVerts,
+      mesh.loopNormals, space.faceKinds, space.faceIds] + mesh.uvLayers
+  if space.sourceFaces is not None:
+    arrays.append(space.sourceFaces)
+  h.update(b'%d\0' % len(arrays))
+  for a in arrays:
+    h.update(b'%d\0' % len(a))
+    h.update(a.tobytes())
+  for remote in space.remotes:
+    h.update(repr((remote.space, remote.translation, remote.orientation)).encode('utf-8'))
+  h.update(b'\1')
+  for spawn in space.spawns:
+    path = tuple(spawn.path) if spawn.path is not None else None
+    h.update(repr((spawn.type, spawn.translation, spawn.orientation, path)).encode('utf-8'))
+  return h.hexdigest()
+
+class SpaceCache:
+  '''A directory of serialized space blocks, one file per key.'''
+
+  def __init__(self, directory):
+    self.directory = directory
+    os.makedirs(directory, exist_ok=True)
+
+  def path(self, key):
+    return os.path.join(self.directory, key + CACHE_SUFFIX)
+
+  def get(self, key):
+    try:
+      with open(self.path(key), 'r', newline='') as f:
+        return f.read()
+    except FileNotFoundError:
+      return None
+
+  def put(self, key, block):
+    # Write to a temporary file first so an interrupted export can't leave
+    # a truncated block behind under a valid key
+    tmp = self.path(key) + '.tmp'
+    with open(tmp, 'w', newline='') as f:
+      f.write(block)
+    os.replace(tmp, self.path(key))
+
+  def prune(self, keep):
+    '''Deletes every cached block whose key is not in keep.'''
+    for fileName in os.listdir(self.directory):
+      if fileName.endswith(CACHE_SUFFIX) and fileName[:-len(CACHE_SUFFIX)] not in keep:
+        os.remove(os.path.join(self.directory, fileName))
+
+def cachedSpaceBlocks(escherMap, cache, workers=1, profile=NULL_PROFILE):
+  '''Returns the .esc6 block of every space, and the indices of the spaces
+  which were not in the cache and had to be formatted. workers is passed
+  on to escher_map.formatSpaces(). With one worker, the spaces formatted
+  are timed in profile as profiledSpaceBlocks() times them.'''
+  with profile.phase('cache lookup'):
+    digest = mapDigest(escherMap)
+    keys = [spaceKey(space, iSpace, digest) for iSpace, space in enumerate(escherMap.spaces)]
+    blocks = list(map(cache.get, keys))
+  rebuilt = [iSpace for iSpace, block in enumerate(blocks) if block is None]
+  profile.count('cache hits', len(blocks) - len(rebuilt))
+  profile.count('rebuilt spaces', len(rebuilt))
+  if profile.enabled and workers == 1:
+    formatted = profiledSpaceBlocks(escherMap, profile, rebuilt)
+  else:
+    with profile.phase('space formatting', hot=True):
+      formatted = formatSpaces(escherMap, rebuilt, workers)
+  with profile.phase('cache writing'):
+    for iSpace, block in zip(rebuilt, formatted):
+      cache.put(keys[iSpace], block)
+      blocks[iSpace] = block
+    cache.prune(set(keys))
+  return blocks, rebuilt
@@ -0,0 +1,270 @@
+# Copyright 2014 Don Viszneki
+# Chunked, compressed Escher maps (.escz) for loading spaces on demand.
+
+"""
+A player only ever needs the space they are in and the spaces within a
+few portals of it, but .esc6 and .escb maps have to be read whole, or at
+least kept mapped whole. An .escz map compresses each space on its own,
+so a loader can decompress just the spaces it needs, and more as the
+player crosses remotes.
+
+Everything is little-endian. A file is a HEADER, then the material table
+(as in .escb, uncompressed), then one compressed chunk per space, then
+the remote space index of every remote of every space (i32), and finally
+the table of contents: one TOC_ENTRY per space. The remote spaces are
+kept outside the chunks so that a loader can find which spaces lie
+within any number of portals without decompressing anything.
+
+A chunk decompresses to a space in the layout of .escb: a directory of
+SECTION entries, with offsets relative to the start of the chunk, then
+the sections themselves, 8 byte aligned. The same tags are used, and the
+same optional per-space sections may be added.
+
+EsczFile reads spaces as they are asked for and keeps the decompressed
+spaces most recently used in an LRU cache, dropping the least recently
+used once their total size goes over a memory budget.
+
+Usage: python escher_chunks.py IN.esc6|IN.escb OUT.escz [zlib|lzma|none] [LEVEL]
+       python escher_chunks.py IN.escz OUT.esc6
+"""
+import mmap
+import struct
+import sys
+import zlib
+from array import array
+from collections import OrderedDict
+from os.path import getsize
+from escher_binary import (EscbFile, EscbSpace, SECTION, leBytes, packMaterials, pad8,
+  realTypecodes, spaceSections, unpackMaterials)
+from escher_map import EscherMap, writeEsc6
+from escher_reader import readEsc6
+try:
+  import lzma
+except ImportError:
+  lzma = None
+
+MAGIC = b'ESCZ'
+VERSION = 1
+
+# magic, version, realSize, codec, numMaterials, numSpaces, material table
+# offset, remote spaces offset, table of contents offset
+HEADER = struct.Struct('<4sIIIIIQQQ')
+# chunk offset, compressed size, decompressed size, crc32 of the
+# decompressed chunk, number of sections, first remote, number of remotes
+TOC_ENTRY = struct.Struct('<QIIIIII')
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+
+codecNames = {'none': CODEC_NONE, 'zlib': CODEC_ZLIB, 'lzma': CODEC_LZMA}
+
+DEFAULT_MEMORY_BUDGET = 64 << 20
+
+def compress(codec, data, level=None):
+  if codec == CODEC_ZLIB:
+    return zlib.compress(data, 6 if level is None else level)
+  if codec == CODEC_LZMA:
+    if lzma is None:
+      raise ValueError('this Python has no lzma module')
+    return lzma.compress(data, preset=6 if level is None else level)
+  return data
+
+def decompress(codec, data):
+  if codec == CODEC_ZLIB:
+    return zlib.decompress(data)
+  if codec == CODEC_LZMA:
+    if lzma is None:
+      raise ValueError('this Python has no lzma module')
+    return lzma.decompress(data)
+  return bytes(data)
+
+def packChunk(sections):
+  '''The uncompressed chunk of a space's (tag, count, bytes) sections.'''
+  offset = len(sections) * SECTION.size
+  directory = []
+  for tag, count, data in sections:
+    directory.append(SECTION.pack(tag, count, offset, len(data)))
+    offset += len(data) + (-len(data) % 8)
+  return b''.join(directory) + b''.join(pad8(data) for tag, count, data in sections)
+
+def writeEscz(escherMap, out, codec=CODEC_ZLIB, level=None, realSize=None, extraSections=None,
+    quantization=None):
+  '''Writes escherMap in .escz format to the binary file object out.
+  realSize, extraSections and quantization are as for
+  escher_binary.writeEscb().'''
+  if realSize is None:
+    realSize = 8 if escherMap.spaces and escherMap.spaces[0].mesh.verts.itemsize == 8 else 4
+  real = realTypecodes[realSize]
+
+  def write(b):
+    out.write(b)
+    out.write(bytes(-len(b) % 8))
+
+  out.write(bytes(HEADER.size))
+  materialsOffset = out.tell()
+  write(packMaterials(escherMap.materials))
+
+  toc = []
+  remoteSpaces = array('i')
+  for iSpace, space in enumerate(escherMap.spaces):
+    sections = spaceSections(space, real, quantization)
+    if extraSections is not None:
+      sections += extraSections(iSpace, space)
+    chunk = packChunk(sections)
+    packed = compress(codec, chunk, level)
+    toc.append(TOC_ENTRY.pack(out.tell(), len(packed), len(chunk), zlib.crc32(chunk),
+      len(sections), len(remoteSpaces), len(space.remotes)))
+    remoteSpaces.extend(remote.space for remote in space.remotes)
+    write(packed)
+
+  remotesOffset = out.tell()
+  write(leBytes(remoteSpaces, 'i'))
+  tocOffset = out.tell()
+  write(b''.join(toc))
+  out.seek(0)
+  out.write(HEADER.pack(MAGIC, VERSION, realSize, codec, len(escherMap.materials),
+    len(escherMap.spaces), materialsOffset, remotesOffset, tocOffset))
+
+class Chunk:
+  '''A decompressed chunk, standing in for the EscbFile of an EscbSpace.'''
+  __slots__ = ('buf', 'real')
+
+  def __init__(self, data, real):
+    self.buf = memoryview(data)
+    self.real = real
+
+class EsczFile:
+  '''A .escz map, read one space at a time. space() returns an
+  escher_binary.EscbSpace whose views point into the decompressed chunk;
+  they stay valid after the chunk leaves the cache. memoryBudget is the
+  most bytes of decompressed chunks to keep, or None for no limit; the
+  last space asked for is always kept.'''
+
+  def __init__(self, filename, memoryBudget=DEFAULT_MEMORY_BUDGET):
+    self.filename = filename
+    self.file = open(filename, 'rb')
+    self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+    (magic, version, realSize, self.codec, numMaterials, numSpaces, materialsOffset,
+      remotesOffset, tocOffset) = HEADER.unpack_from(self.mm)
+    if magic != MAGIC:
+      raise ValueError('"%s" is not a chunked Escher map' % filename)
+    if version != VERSION:
+      raise ValueError('unsupported chunked Escher map version %d' % version)
+    self.real = realTypecodes[realSize]
+    self.materials = unpackMaterials(self.mm, materialsOffset, numMaterials)
+    self.toc = [TOC_ENTRY.unpack_from(self.mm, tocOffset + i * TOC_ENTRY.size)
+      for i in range(numSpaces)]
+    numRemotes = sum(entry[6] for entry in self.toc)
+    self.remoteSpaces = array('i', self.mm[remotesOffset:remotesOffset + 4 * numRemotes])
+    if sys.byteorder != 'little':
+      self.remoteSpaces.byteswap()
+    self.memoryBudget = memoryBudget
+    self.cache = OrderedDict()
+    self.cachedBytes = 0
+    self.hits = self.misses = self.evictions = 0
+
+  def __len__(self):
+    return len(self.toc)
+
+  def remotes(self, i):
+    '''The remote space index of each remote of space i.'''
+    first, count = self.toc[i][5:7]
+    return self.remoteSpaces[first:first+count]
+
+  def spacesWithin(self, i, depth):
+    '''The spaces reachable from space i through up to depth remotes,
+    nearest first, space i included.'''
+    found = [i]
+    seen = {i}
+    level = [i]
+    for d in range(depth):
+      nextLevel = []
+      for j in level:
+        for k in self.remotes(j):
+          if k >= 0 and k not in seen:
+            seen.add(k)
+            nextLevel.append(k)
+      found += nextLevel
+      level = nextLevel
+    return found
+
+  def chunk(self, i):
+    '''The decompressed chunk of space i, from the cache if it is there.'''
+    data = self.cache.get(i)
+    if data is not None:
+      self.cache.move_to_end(i)
+      self.hits += 1
+      return data
+    self.misses += 1
+    offset, packedSize, size, crc, numSections, first, count = self.toc[i]
+    data = decompress(self.codec, self.mm[offset:offset+packedSize])
+    if len(data) != size or zlib.crc32(data) != crc:
+      raise ValueError('space %d of "%s" is corrupt' % (i, self.filename))
+    self.cache[i] = data
+    self.cachedBytes += len(data)
+    while self.memoryBudget is not None and self.cachedBytes > self.memoryBudget and len(self.cache) > 1:
+      j, evicted = self.cache.popitem(last=False)
+      self.cachedBytes -= len(evicted)
+      self.evictions += 1
+    return data
+
+  def space(self, i):
+    return EscbSpace(Chunk(self.chunk(i), self.real), 0, self.toc[i][4])
+
+  def prefetch(self, i, depth):
+    '''Loads the spaces within depth remotes of space i, farthest first, so
+    that those nearest are the last to be evicted. Returns their indices.'''
+    spaces = self.spacesWithin(i, depth)
+    for j in reversed(spaces):
+      self.chunk(j)
+    return spaces
+
+  def toMap(self):
+    '''Copies the whole map into an escher_map.EscherMap.'''
+    escherMap = EscherMap()
+    for mat in self.materials:
+      escherMap.addMaterial(mat)
+    for i in range(len(self)):
+      escherMap.addSpace(self.space(i).toSpace())
+    return escherMap
+
+  def close(self):
+    self.cache.clear()
+    self.cachedBytes = 0
+    self.mm.close()
+    self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+def toEscz(inFilename, outFilename, codec=CODEC_ZLIB, level=None):
+  '''Converts a .esc6 or .escb map to .escz.'''
+  if inFilename.endswith('.escb'):
+    with EscbFile(inFilename) as escb:
+      escherMap = escb.toMap()
+  else:
+    with open(inFilename, 'rb') as f:
+      escherMap = readEsc6(f)
+  with open(outFilename, 'wb') as out:
+    writeEscz(escherMap, out, codec, level)
+
+def esczToEsc6(inFilename, outFilename):
+  with EsczFile(inFilename, None) as escz:
+    escherMap = escz.toMap()
+  with open(outFilename, 'w') as out:
+    writeEsc6(escherMap, out)
+
+if __name__ == '__main__':
+  if len(sys.argv) not in (3, 4, 5) or len(sys.argv) > 3 and sys.argv[3] not in codecNames:
+    sys.exit(__doc__.split('Usage: ')[1])
+  if sys.argv[1].endswith('.escz'):
+    esczToEsc6(sys.argv[1], sys.argv[2])
+  else:
+    codec = codecNames[sys.argv[3]] if len(sys.argv) > 3 else CODEC_ZLIB
+    level = int(sys.argv[4]) if len(sys.argv) > 4 else None
+    toEscz(sys.argv[1], sys.argv[2], codec, level)
+    print('%d bytes -> %d bytes' % (getsize(sys.argv[1]), getsize(sys.argv[2])))
@@ -0,0 +1,267 @@
+# Copyright 2014 Don Viszneki
+# Planar collision tables for Escher spaces (TODO item 7).
+
+"""
+Groups the collidable faces of a space by the plane they lie in: first by
+plane normal, then, for each normal, by the plane's distance d from the
+origin (n . p = d), so a moving point only has to be tested against the
+faces of the planes it actually crosses:
+
+  For each planar normal n:
+    project the movement onto n
+    for each d the movement passes through:
+      for each face in that plane:
+        use the even/odd rule to see if the movement hits the face
+
+Normals closer than normalTolerance radians, and planes of the same normal
+closer than distanceTolerance, are merged.
+
+The tables are stored in .escb as these optional sections:
+
+  CNRM  unit xyz per normal (f64)
+  CNPL  numNormals+1 offsets into the planes, per normal (u32)
+  CPLD  d per plane, ascending within each normal (f64)
+  CPLF  numPlanes+1 offsets into CFAC, per plane (u32)
+  CFAC  face indices (u32)
+
+Usage: python escher_collision.py MAP.esc6 [NUMQUERIES]
+Times collide() against collideBruteForce() on random movements.
+"""
+import math
+import random
+import sys
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from escher_binary import leBytes
+from escher_map import FACE_MAT
+from escher_triangulate import newellNormal
+
+def facePoints(space, iFace):
+  mesh = space.mesh
+  verts = mesh.verts
+  start = mesh.loopStarts[iFace]
+  return [tuple(verts[3*vi:3*vi+3]) for vi in mesh.loopVerts[start:start+mesh.loopTotals[iFace]]]
+
+def unitNormal(points):
+  nx, ny, nz = newellNormal(points)
+  length = math.sqrt(nx*nx + ny*ny + nz*nz)
+  if length == 0:
+    return None
+  return nx / length, ny / length, nz / length
+
+def dot(a, b):
+  return a[0]*b[0] + a[1]*b[1] + a[2]*b[2]
+
+def collidableFaces(space, kinds=(FACE_MAT,)):
+  return [iFace for iFace, kind in enumerate(space.faceKinds) if kind in kinds]
+
+class PlaneTable:
+  '''The collision planes of one space, stored as flat arrays. The planes
+  of normal i are normalPlanes[i] up to normalPlanes[i+1], and the faces of
+  plane j are faces[planeFaces[j]:planeFaces[j+1]].'''
+  __slots__ = ('normals', 'normalPlanes', 'planeDs', 'planeFaces', 'faces')
+
+  def __init__(self, normals, normalPlanes, planeDs, planeFaces, faces):
+    self.normals = normals
+    self.normalPlanes = normalPlanes
+    self.planeDs = planeDs
+    self.planeFaces = planeFaces
+    self.faces = faces
+
+  def __len__(self):
+    return len(self.normalPlanes) - 1
+
+  def sections(self):
+    '''The .escb (tag, count, bytes) sections of this table.'''
+    return [
+      (b'CNRM', len(self), leBytes(self.normals, 'd')),
+      (b'CNPL', len(self) + 1, leBytes(self.normalPlanes, 'I')),
+      (b'CPLD', len(self.planeDs), leBytes(self.planeDs, 'd')),
+      (b'CPLF', len(self.planeDs) + 1, leBytes(self.planeFaces, 'I')),
+      (b'CFAC', len(self.faces), leBytes(self.faces, 'I')),
+    ]
+
+  @classmethod
+  def fromEscb(cls, escbSpace):
+    '''The table stored in an escher_binary.EscbSpace, viewed in place, or
+    None if the space has none.'''
+    if b'CNRM' not in escbSpace.sections:
+      return None
+    return cls(escbSpace.view(b'CNRM', 'd'), escbSpace.view(b'CNPL', 'I'),
+      escbSpace.view(b'CPLD', 'd'), escbSpace.view(b'CPLF', 'I'), escbSpace.view(b'CFAC', 'I'))
+
+def neighbourCells(key):
+  x, y, z = key
+  return [(x+dx, y+dy, z+dz) for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)]
+
+def buildPlaneTable(space, normalTolerance=1e-3, distanceTolerance=1e-4, kinds=(FACE_MAT,)):
+  '''Groups the faces of space whose kind is in kinds into a PlaneTable.
+  Degenerate faces, which have no normal, are left out.'''
+  # Cluster normals. Unit normals are hashed on a grid with cells as wide as
+  # the tolerance, so only neighbouring cells need to be searched.
+  cell = 2 * math.sin(normalTolerance / 2)
+  cosTolerance = math.cos(normalTolerance)
+  grid = {}
+  groups = []  # [representative normal, [(iFace, normal, points)]]
+  for iFace in collidableFaces(space, kinds):
+    points = facePoints(space, iFace)
+    n = unitNormal(points)
+    if n is None:
+      continue
+    key = tuple(int(math.floor(c / cell)) for c in n)
+    group = next((g for neighbour in neighbourCells(key) for g in grid.get(neighbour, ())
+      if dot(groups[g][0], n) >= cosTolerance), None)
+    if group is None:
+      group = len(groups)
+      groups.append([n, []])
+      grid.setdefault(key, []).append(group)
+    groups[group][1].append((iFace, n, points))
+
+  normals = array('d')
+  normalPlanes = array('I', [0])
+  planeDs = array('d')
+  planeFaces = array('I', [0])
+  faces = array('I')
+  for rep, members in groups:
+    # Average the group's normals, then split it into planes along d
+    sx = sum(m[1][0] for m in members)
+    sy = sum(m[1][1] for m in members)
+    sz = sum(m[1][2] for m in members)
+    length = math.sqrt(sx*sx + sy*sy + sz*sz)
+    n = (sx / length, sy / length, sz / length)
+    normals.extend(n)
+    byD = sorted((sum(dot(n, p) for p in points) / len(points), iFace)
+      for iFace, faceNormal, points in members)
+    plane = [byD[0]]
+    for d, iFace in byD[1:] + [(math.inf, None)]:
+      if d - plane[-1][0] > distanceTolerance:
+        planeDs.append(sum(pd for pd, pf in plane) / len(plane))
+        faces.extend(sorted(pf for pd, pf in plane))
+        planeFaces.append(len(faces))
+        plane = []
+      plane.append((d, iFace))
+    normalPlanes.append(len(planeDs))
+  return PlaneTable(normals, normalPlanes, planeDs, planeFaces, faces)
+
+def projectAxes(n):
+  '''The two axes to keep when flattening a polygon with normal n.'''
+  ax, ay, az = abs(n[0]), abs(n[1]), abs(n[2])
+  if az >= ax and az >= ay:
+    return 0, 1
+  if ay >= ax:
+    return 2, 0
+  return 1, 2
+
+def pointInPolygon(p, points, n):
+  '''Even/odd rule test of whether p, which lies in the plane of points,
+  is inside the polygon.'''
+  i, j = projectAxes(n)
+  x, y = p[i], p[j]
+  inside = False
+  x0, y0 = points[-1][i], points[-1][j]
+  for q in points:
+    x1, y1 = q[i], q[j]
+    if (y1 > y) != (y0 > y) and x < (x0 - x1) * (y - y1) / (y0 - y1) + x1:
+      inside = not inside
+    x0, y0 = x1, y1
+  return inside
+
+def collide(table, space, start, end):
+  '''Returns (t, iFace) for the first face of table that the movement from
+  start to end passes through, t being the fraction of the movement made
+  before the hit, or None if it hits nothing.'''
+  best = None
+  movement = (end[0] - start[0], end[1] - start[1], end[2] - start[2])
+  normals = table.normals
+  planeDs = table.planeDs
+  for iNormal in range(len(table)):
+    n = normals[3*iNormal:3*iNormal+3]
+    s = dot(n, start)
+    e = dot(n, end)
+    if s == e:
+      continue
+    # Only the planes whose d lies between s and e can be crossed
+    first, last = table.normalPlanes[iNormal], table.normalPlanes[iNormal+1]
+    lo = bisect_left(planeDs, min(s, e), first, last)
+    hi = bisect_right(planeDs, max(s, e), lo, last)
+    for iPlane in range(lo, hi):
+      t = (planeDs[iPlane] - s) / (e - s)
+      if best is not None and t >= best[0]:
+        continue
+      p = (start[0] + t * movement[0], start[1] + t * movement[1], start[2] + t * movement[2])
+      for iFace in table.faces[table.planeFaces[iPlane]:table.planeFaces[iPlane+1]]:
+        if pointInPolygon(p, facePoints(space, iFace), n):
+          best = (t, iFace)
+          break
+  return best
+
+def collideBruteForce(space, start, end, kinds=(FACE_MAT,)):
+  '''Like collide(), but tests the movement against every face, as the
+  game does today.'''
+  best = None
+  movement = (end[0] - start[0], end[1] - start[1], end[2] - start[2])
+  for iFace in collidableFaces(space, kinds):
+    points = facePoints(space, iFace)
+    n = unitNormal(points)
+    if n is None:
+      continue
+    d = sum(dot(n, p) for p in points) / len(points)
+    s = dot(n, start)
+    e = dot(n, end)
+    if s == e or not min(s, e) <= d <= max(s, e):
+      continue
+    t = (d - s) / (e - s)
+    if best is not None and t >= best[0]:
+      continue
+    p = (start[0] + t * movement[0], start[1] + t * movement[1], start[2] + t * movement[2])
+    if pointInPolygon(p, points, n):
+      best = (t, iFace)
+  return best
+
+def randomMovements(space, count, length=1.0, seed=0):
+  '''count random (start, end) pairs inside the bounds of space.'''
+  rng = random.Random(seed)
+  verts = space.mesh.verts
+  lo = [min(verts[i::3]) for i in range(3)]
+  hi = [max(verts[i::3]) for i in range(3)]
+  movements = []
+  for i in range(count):
+    start = tuple(rng.uniform(lo[k], hi[k]) for k in range(3))
+    direction = tuple(rng.gauss(0, 1) for k in range(3))
+    scale = length / (math.sqrt(dot(direction, direction)) or 1)
+    movements.append((start, tuple(start[k] + direction[k] * scale for k in range(3))))
+  return movements
+
+def benchmark(escherMap, numQueries=1000):
+  '''Times collide() and collideBruteForce() on the same random movements
+  in every space. Returns a list of (space index, faces, planes, brute
+  force seconds, table seconds, disagreements); the two can only disagree
+  on movements ending within the tables' tolerances of a plane.'''
+  results = []
+  for iSpace, space in enumerate(escherMap.spaces):
+    if not space.numVerts:
+      continue
+    table = buildPlaneTable(space)
+    movements = randomMovements(space, numQueries, seed=iSpace)
+    t0 = time.perf_counter()
+    expected = [collideBruteForce(space, s, e) for s, e in movements]
+    t1 = time.perf_counter()
+    got = [collide(table, space, s, e) for s, e in movements]
+    t2 = time.perf_counter()
+    disagreements = sum((a is None) != (b is None) or (a is not None and abs(a[0] - b[0]) > 1e-6)
+      for a, b in zip(expected, got))
+    results.append((iSpace, space.numFaces, len(table.planeDs), t1 - t0, t2 - t1, disagreements))
+  return results
+
+if __name__ == '__main__':
+  from escher_reader import readEsc6
+  if len(sys.argv) not in (2, 3):
+    sys.exit(__doc__.split('Usage: ')[1])
+  with open(sys.argv[1], 'rb') as f:
+    escherMap = readEsc6(f)
+  numQueries = int(sys.argv[2]) if len(sys.argv) == 3 else 1000
+  print('space  faces planes  brute force   plane table  speedup  disagreements')
+  for iSpace, numFaces, numPlanes, brute, table, disagreements in benchmark(escherMap, numQueries):
+    print('%5d %6d %6d %11.4fs %12.4fs %7.1fx %14d' % (iSpace, numFaces, numPlanes, brute, table,
+      brute / table if table else 0, disagreements))
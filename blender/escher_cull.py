@@ -0,0 +1,395 @@
+# Copyright 2014 Don Viszneki
+# Portal planes and bounding volumes of each remote, for culling remotes.
+
+"""
+Each frame drawFace() and the Polygon4 and ClipPlane4 clipping code in
+src/ants/escher.d work out planes and clip data from the corners of
+every visible portal face, and drawSpace() draws the stencil of every
+face of a remote. This module works out at export time, for each remote
+of a space with portal faces:
+
+  its polygons: its portal faces of the same plane merged into their
+    outlines, without the corners on straight edges
+  the plane of each polygon, n . p = d, n facing the side it is seen from
+  a bounding sphere and box of its portal faces
+  the convex hull of its polygons, if they share one plane
+
+so the renderer can reject a remote with a back-face test and a frustum
+test before touching any face: rejectRemote() is the reference. It only
+rejects what testing each portal face would; faces each outside a
+different plane of the frustum are the only thing it may keep which that
+would reject.
+
+The volumes are stored in .escb as these optional sections of each
+space:
+
+  RBIX  per remote with portal faces: remote id, first polygon, number
+        of polygons, first hull corner, number of hull corners (u32 x 5)
+  RBVL  per remote: sphere centre xyz, radius, box min xyz, max xyz
+        (f64 x 10)
+  RBPG  per polygon: first corner, number of corners (u32 x 2)
+  RBPL  per polygon: plane normal xyz, d (f64 x 4)
+  RBPT  the corners of the polygons, then those of the hulls (f64 x 3)
+
+Usage: python escher_cull.py MAP.esc6 [NUMVIEWS]
+Times rejectRemote() against testing each portal face from random views
+in every space; escher_synth.py generates maps to try it on.
+"""
+import math
+import random
+import sys
+import time
+from array import array
+from escher_binary import leBytes
+from escher_collision import dot, facePoints, unitNormal
+from escher_map import FACE_REMOTE
+from escher_portals import planeOf, roundedKey
+
+# Planes of portal faces within these of each other are merged
+NORMAL_TOLERANCE = 1e-4
+DISTANCE_TOLERANCE = 1e-4
+
+NOT_REJECTED = None
+BACK_FACING = 'back'
+OUTSIDE_FRUSTUM = 'frustum'
+
+def cross(a, b):
+  return (a[1] * b[2] - a[2] * b[1], a[2] * b[0] - a[0] * b[2], a[0] * b[1] - a[1] * b[0])
+
+def sub(a, b):
+  return (a[0] - b[0], a[1] - b[1], a[2] - b[2])
+
+def outlines(faces):
+  '''The outlines of the faces, given as lists of vert indices: each loop
+  of the edges which only one face has, wound as the faces are.'''
+  edges = set()
+  for corners in faces:
+    for i, a in enumerate(corners):
+      edges.add((a, corners[(i + 1) % len(corners)]))
+  following = {}
+  for a, b in edges:
+    if (b, a) not in edges:
+      following.setdefault(a, []).append(b)
+  loops = []
+  for start in sorted(following):
+    while following[start]:
+      loop = [start]
+      v = following[start].pop()
+      while v != start and following.get(v):
+        loop.append(v)
+        v = following[v].pop()
+      loops.append(loop)
+  return loops
+
+def dropStraightCorners(points, tolerance):
+  '''points without the corners on a straight line between their
+  neighbours.'''
+  kept = list(points)
+  i = 0
+  while len(kept) > 3 and i < len(kept):
+    prev, p, next = kept[i - 1], kept[i], kept[(i + 1) % len(kept)]
+    a, b = sub(p, prev), sub(next, p)
+    c = cross(a, b)
+    if dot(c, c) <= (tolerance * tolerance) * dot(a, a) * dot(b, b) and dot(a, b) > 0:
+      del kept[i]
+    else:
+      i += 1
+  return kept
+
+def convexHull(points, n):
+  '''The convex hull of points on a plane of normal n, counterclockwise
+  about n.'''
+  axis = max(range(3), key=lambda k: abs(n[k]))
+  u = cross(n, (1.0, 0.0, 0.0) if axis != 0 else (0.0, 1.0, 0.0))
+  v = cross(n, u)
+  projected = sorted(set((dot(p, u), dot(p, v), p) for p in points))
+  if len(projected) < 3:
+    return [p for x, y, p in projected]
+  def turn(o, a, b):
+    return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+  lower, upper = [], []
+  for q in projected:
+    while len(lower) >= 2 and turn(lower[-2], lower[-1], q) <= 0:
+      lower.pop()
+    lower.append(q)
+  for q in reversed(projected):
+    while len(upper) >= 2 and turn(upper[-2], upper[-1], q) <= 0:
+      upper.pop()
+    upper.append(q)
+  # u x v points along n, so counterclockwise in (u, v) is about n too
+  return [p for x, y, p in lower[:-1] + upper[:-1]]
+
+def boundingSphere(points):
+  '''Ritter's bounding sphere of points: (centre, radius).'''
+  p = points[0]
+  q = max(points, key=lambda r: dot(sub(r, p), sub(r, p)))
+  r = max(points, key=lambda s: dot(sub(s, q), sub(s, q)))
+  centre = tuple((q[k] + r[k]) / 2 for k in range(3))
+  radius = math.sqrt(dot(sub(r, q), sub(r, q))) / 2
+  for p in points:
+    d = math.sqrt(dot(sub(p, centre), sub(p, centre)))
+    if d > radius:
+      radius = (radius + d) / 2
+      centre = tuple(centre[k] + (p[k] - centre[k]) * (d - radius) / d for k in range(3))
+  return centre, radius
+
+class RemoteVolume:
+  '''The polygons, planes and bounding volumes of one remote's portal
+  faces; hull is [] unless its polygons share one plane.'''
+  __slots__ = ('remote', 'polygons', 'planes', 'centre', 'radius', 'lo', 'hi', 'hull')
+
+  def __init__(self, remote, polygons, planes, centre, radius, lo, hi, hull):
+    self.remote = remote
+    self.polygons = polygons
+    self.planes = planes
+    self.centre = centre
+    self.radius = radius
+    self.lo = lo
+    self.hi = hi
+    self.hull = hull
+
+class RemoteBounds:
+  '''The RemoteVolume of each remote of one space with portal faces.'''
+  __slots__ = ('volumes',)
+
+  def __init__(self, volumes):
+    self.volumes = volumes
+
+  def sections(self):
+    '''The .escb (tag, count, bytes) sections of these volumes, or none if
+    the space has no portal faces.'''
+    if not self.volumes:
+      return []
+    index = array('I')
+    bounds = array('d')
+    polygons = array('I')
+    planes = array('d')
+    corners = [p for volume in self.volumes for polygon in volume.polygons for p in polygon]
+    numPolygons = 0
+    numCorners = 0
+    numHullCorners = 0
+    for volume in self.volumes:
+      index.extend((volume.remote, numPolygons, len(volume.polygons),
+        len(corners) + numHullCorners, len(volume.hull)))
+      bounds.extend(volume.centre + (volume.radius,) + volume.lo + volume.hi)
+      for polygon, (n, d) in zip(volume.polygons, volume.planes):
+        polygons.extend((numCorners, len(polygon)))
+        planes.extend(n + (d,))
+        numCorners += len(polygon)
+      numPolygons += len(volume.polygons)
+      numHullCorners += len(volume.hull)
+    corners.extend(p for volume in self.volumes for p in volume.hull)
+    points = array('d', [c for p in corners for c in p])
+    return [
+      (b'RBIX', len(self.volumes), leBytes(index, 'I')),
+      (b'RBVL', len(self.volumes), leBytes(bounds, 'd')),
+      (b'RBPG', numPolygons, leBytes(polygons, 'I')),
+      (b'RBPL', numPolygons, leBytes(planes, 'd')),
+      (b'RBPT', len(corners), leBytes(points, 'd')),
+    ]
+
+  @classmethod
+  def fromEscb(cls, escbSpace):
+    '''The volumes stored in an escher_binary.EscbSpace, or None if the
+    space has none.'''
+    if b'RBIX' not in escbSpace.sections:
+      return None
+    index = escbSpace.view(b'RBIX', 'I')
+    bounds = escbSpace.view(b'RBVL', 'd')
+    polygons = escbSpace.view(b'RBPG', 'I')
+    planes = escbSpace.view(b'RBPL', 'd')
+    points = escbSpace.view(b'RBPT', 'd')
+    corner = lambda i: tuple(points[3*i:3*i+3])
+    volumes = []
+    for i in range(len(index) // 5):
+      remote, firstPolygon, numPolygons, firstHull, numHull = index[5*i:5*i+5]
+      b = bounds[10*i:10*i+10]
+      volumePolygons = []
+      volumePlanes = []
+      for j in range(firstPolygon, firstPolygon + numPolygons):
+        first, count = polygons[2*j:2*j+2]
+        volumePolygons.append([corner(k) for k in range(first, first + count)])
+        volumePlanes.append((tuple(planes[4*j:4*j+3]), planes[4*j+3]))
+      volumes.append(RemoteVolume(remote, volumePolygons, volumePlanes, tuple(b[0:3]), b[3],
+        tuple(b[4:7]), tuple(b[7:10]), [corner(k) for k in range(firstHull, firstHull + numHull)]))
+    return cls(volumes)
+
+def buildRemoteBounds(space, normalTolerance=NORMAL_TOLERANCE, distanceTolerance=DISTANCE_TOLERANCE):
+  '''The RemoteBounds of space.'''
+  mesh = space.mesh
+  verts = mesh.verts
+  point = lambda vi: tuple(verts[3*vi:3*vi+3])
+  byRemote = {}
+  for iFace, (kind, faceId) in enumerate(zip(space.faceKinds, space.faceIds)):
+    if kind == FACE_REMOTE and faceId >= 0:
+      byRemote.setdefault(faceId, []).append(iFace)
+  volumes = []
+  for remote in sorted(byRemote):
+    byPlane = {}
+    corners = set()
+    for iFace in byRemote[remote]:
+      start = mesh.loopStarts[iFace]
+      faceCorners = list(mesh.loopVerts[start:start+mesh.loopTotals[iFace]])
+      plane = planeOf([point(vi) for vi in faceCorners])
+      if plane is None:
+        continue
+      n, d = plane
+      key = roundedKey(n, normalTolerance) + roundedKey((d,), distanceTolerance)
+      byPlane.setdefault(key, (plane, []))[1].append(faceCorners)
+      corners.update(faceCorners)
+    if not corners:
+      continue
+    polygons = []
+    planes = []
+    for key in sorted(byPlane):
+      plane, faces = byPlane[key]
+      for loop in outlines(faces):
+        polygon = dropStraightCorners([point(vi) for vi in loop], normalTolerance)
+        if len(polygon) >= 3:
+          polygons.append(polygon)
+          planes.append(plane)
+    points = [point(vi) for vi in sorted(corners)]
+    centre, radius = boundingSphere(points)
+    lo = tuple(min(p[k] for p in points) for k in range(3))
+    hi = tuple(max(p[k] for p in points) for k in range(3))
+    hull = []
+    if len(byPlane) == 1 and polygons:
+      hull = convexHull([p for polygon in polygons for p in polygon], planes[0][0])
+    volumes.append(RemoteVolume(remote, polygons, planes, centre, radius, lo, hi, hull))
+  return RemoteBounds(volumes)
+
+class Frustum:
+  '''A viewpoint and the planes bounding what it sees, each (n, d) with n
+  pointing inwards: a point p is inside if n . p >= d for every plane.'''
+  __slots__ = ('eye', 'planes')
+
+  def __init__(self, eye, planes):
+    self.eye = eye
+    self.planes = planes
+
+  @classmethod
+  def perspective(cls, eye, forward, up, fovY, aspect, near, far):
+    '''The frustum of a perspective projection from eye looking along
+    forward, fovY being the vertical field of view in radians.'''
+    f = forward
+    length = math.sqrt(dot(f, f))
+    f = tuple(c / length for c in f)
+    r = cross(f, up)
+    length = math.sqrt(dot(r, r))
+    r = tuple(c / length for c in r)
+    u = cross(r, f)
+    ty = math.tan(fovY / 2)
+    tx = ty * aspect
+    normals = [
+      f,
+      tuple(-c for c in f),
+      tuple(f[k] * tx + r[k] for k in range(3)),
+      tuple(f[k] * tx - r[k] for k in range(3)),
+      tuple(f[k] * ty + u[k] for k in range(3)),
+      tuple(f[k] * ty - u[k] for k in range(3)),
+    ]
+    normals = [tuple(c / math.sqrt(dot(n, n)) for c in n) for n in normals]
+    planes = [(normals[0], dot(f, eye) + near), (normals[1], -(dot(f, eye) + far))]
+    planes += [(n, dot(n, eye)) for n in normals[2:]]
+    return cls(eye, planes)
+
+  def outside(self, points):
+    '''Whether every one of points is outside the same plane.'''
+    for n, d in self.planes:
+      if all(dot(n, p) < d for p in points):
+        return True
+    return False
+
+def rejectRemote(volume, frustum):
+  '''Why a remote cannot be seen through any of its portal faces from
+  frustum: BACK_FACING, OUTSIDE_FRUSTUM, or NOT_REJECTED if it may be.'''
+  eye = frustum.eye
+  if all(dot(n, eye) <= d for n, d in volume.planes):
+    return BACK_FACING
+  for n, d in frustum.planes:
+    if dot(n, volume.centre) - d < -volume.radius:
+      return OUTSIDE_FRUSTUM
+  lo, hi = volume.lo, volume.hi
+  for n, d in frustum.planes:
+    # The corner of the box furthest along n
+    if (n[0] * (hi[0] if n[0] > 0 else lo[0]) + n[1] * (hi[1] if n[1] > 0 else lo[1]) +
+        n[2] * (hi[2] if n[2] > 0 else lo[2])) < d:
+      return OUTSIDE_FRUSTUM
+  if volume.hull:
+    return OUTSIDE_FRUSTUM if frustum.outside(volume.hull) else NOT_REJECTED
+  for polygon, (n, d) in zip(volume.polygons, volume.planes):
+    if dot(n, eye) > d and not frustum.outside(polygon):
+      return NOT_REJECTED
+  return OUTSIDE_FRUSTUM
+
+def rejectRemoteFaces(space, faces, frustum):
+  '''rejectRemote() the way the game has to without the volumes, working
+  out the plane of each portal face from its corners.'''
+  frontFacing = False
+  for iFace in faces:
+    points = facePoints(space, iFace)
+    n = unitNormal(points)
+    if n is None or dot(n, frustum.eye) <= dot(n, points[0]):
+      continue
+    frontFacing = True
+    if not frustum.outside(points):
+      return NOT_REJECTED
+  return OUTSIDE_FRUSTUM if frontFacing else BACK_FACING
+
+def randomViews(space, count, seed=0):
+  '''count random frustums from points inside the bounds of space.'''
+  rng = random.Random(seed)
+  verts = space.mesh.verts
+  lo = [min(verts[i::3]) for i in range(3)]
+  hi = [max(verts[i::3]) for i in range(3)]
+  views = []
+  for i in range(count):
+    eye = tuple(rng.uniform(lo[k], hi[k]) for k in range(3))
+    forward = (rng.gauss(0, 1), rng.gauss(0, 0.3), rng.gauss(0, 1))
+    views.append(Frustum.perspective(eye, forward, (0.0, 1.0, 0.0), math.radians(60), 4 / 3, 0.1, 1000.0))
+  return views
+
+def benchmark(escherMap, numViews=1000):
+  '''Times rejectRemote() and rejectRemoteFaces() from the same random
+  views in every space. Returns a list of (space index, remotes, build
+  seconds, per face seconds, volume seconds, rejected by faces, rejected
+  by volumes, wrongly rejected by volumes).'''
+  results = []
+  for iSpace, space in enumerate(escherMap.spaces):
+    if not space.numVerts:
+      continue
+    t0 = time.perf_counter()
+    bounds = buildRemoteBounds(space)
+    t1 = time.perf_counter()
+    if not bounds.volumes:
+      continue
+    faces = {}
+    for iFace, (kind, faceId) in enumerate(zip(space.faceKinds, space.faceIds)):
+      if kind == FACE_REMOTE:
+        faces.setdefault(faceId, []).append(iFace)
+    views = randomViews(space, numViews, seed=iSpace)
+    expected = [rejectRemoteFaces(space, faces[volume.remote], frustum)
+      for frustum in views for volume in bounds.volumes]
+    t2 = time.perf_counter()
+    got = [rejectRemote(volume, frustum) for frustum in views for volume in bounds.volumes]
+    t3 = time.perf_counter()
+    wrong = sum(a is NOT_REJECTED and b is not NOT_REJECTED for a, b in zip(expected, got))
+    results.append((iSpace, len(bounds.volumes), t1 - t0, t2 - t1, t3 - t2,
+      sum(a is not NOT_REJECTED for a in expected), sum(b is not NOT_REJECTED for b in got), wrong))
+  return results
+
+if __name__ == '__main__':
+  from escher_reader import readEsc6
+  if len(sys.argv) not in (2, 3):
+    sys.exit(__doc__.split('Usage: ')[1])
+  with open(sys.argv[1], 'rb') as f:
+    escherMap = readEsc6(f)
+  numViews = int(sys.argv[2]) if len(sys.argv) == 3 else 1000
+  print('space remotes      build    per face     volumes  speedup  rejected by faces  by volumes  wrongly')
+  totals = [0.0, 0.0]
+  for iSpace, numRemotes, build, faces, volumes, byFaces, byVolumes, wrong in benchmark(escherMap, numViews):
+    totals[0] += faces
+    totals[1] += volumes
+    print('%5d %7d %9.4fs %10.4fs %10.4fs %7.1fx %18d %11d %8d' % (iSpace, numRemotes, build, faces,
+      volumes, faces / volumes if volumes else 0, byFaces, byVolumes, wrong))
+  print('total %27.4fs %10.4fs %7.1fx' % (totals[0], totals[1], totals[0] / totals[1] if totals[1] else 0))
@@ -0,0 +1,185 @@
+# Copyright 2014 Don Viszneki
+# Pre-built GPU vertex/index buffers and draw batches for Escher spaces.
+
+"""
+Does at export time what Space.gpuSetUp() in src/ants/escher.d does every
+time a space is loaded: weld identical corners into unique vertices, fan
+triangulate every face into an index buffer, and batch the faces into
+draw ranges ordered as compareFacesByRenderType() orders them, i.e.
+material faces by material, then remote faces by remote.
+
+Vertices are interleaved as GPUVert is: position xyz, normal xyz, uv, all
+f32. Only the first UV layer is kept. Two corners are welded if all eight
+of their f32 values are equal.
+
+The buffers are stored in .escb as these optional sections:
+
+  GVTX  interleaved vertices (f32 x 8)
+  GIDX  vertex indices, three per triangle (u32)
+  GDRW  kind, material or remote id, first index, index count per draw
+        range (i32 x 4)
+
+Usage: python escher_gpu.py MAP.esc6|MAP.escb
+Builds the buffers of every space, or reads those stored in a .escb, and
+checks that they reproduce the map's faces.
+"""
+import struct
+import sys
+from array import array
+from escher_binary import EscbFile, leBytes
+from escher_map import faceKindNames
+
+GPU_VERT = struct.Struct('<8f')
+
+class GPUBuffers:
+  '''vertices holds 8 f32 per vertex, indices 3 u32 per triangle, and
+  drawRanges 4 i32 (kind, id, first index, index count) per range.'''
+  __slots__ = ('vertices', 'indices', 'drawRanges')
+
+  def __init__(self, vertices, indices, drawRanges):
+    self.vertices = vertices
+    self.indices = indices
+    self.drawRanges = drawRanges
+
+  def sections(self):
+    '''The .escb (tag, count, bytes) sections of these buffers.'''
+    return [
+      (b'GVTX', len(self.vertices) // 8, leBytes(self.vertices, 'f')),
+      (b'GIDX', len(self.indices), leBytes(self.indices, 'I')),
+      (b'GDRW', len(self.drawRanges) // 4, leBytes(self.drawRanges, 'i')),
+    ]
+
+  @classmethod
+  def fromEscb(cls, escbSpace):
+    '''The buffers stored in an escher_binary.EscbSpace, viewed in place,
+    or None if the space has none.'''
+    if b'GVTX' not in escbSpace.sections:
+      return None
+    return cls(escbSpace.view(b'GVTX', 'f'), escbSpace.view(b'GIDX', 'I'),
+      escbSpace.view(b'GDRW', 'i'))
+
+def gpuCorners(space):
+  '''The packed GPUVert bytes of every loop of space. Packing rounds to f32
+  exactly as the game does; adding 0.0 turns -0.0 into 0.0, which the game
+  compares as equal.'''
+  mesh = space.mesh
+  verts = mesh.verts
+  normals = mesh.loopNormals
+  uvs = mesh.uvLayers[0] if mesh.uvLayers else None
+  corners = []
+  for li, vi in enumerate(mesh.loopVerts):
+    uv = (uvs[2*li] + 0.0, uvs[2*li+1] + 0.0) if uvs is not None else (0.0, 0.0)
+    corners.append(GPU_VERT.pack(verts[3*vi] + 0.0, verts[3*vi+1] + 0.0, verts[3*vi+2] + 0.0,
+      normals[3*li] + 0.0, normals[3*li+1] + 0.0, normals[3*li+2] + 0.0, uv[0], uv[1]))
+  return corners
+
+def renderOrder(space):
+  '''Face indices of space in compareFacesByRenderType() order.'''
+  return sorted(range(space.numFaces), key=lambda i: (space.faceKinds[i], space.faceIds[i]))
+
+def buildGPUBuffers(space):
+  mesh = space.mesh
+  corners = gpuCorners(space)
+  unique = {}
+  vertexBytes = []
+  indices = array('I')
+  drawRanges = array('i')
+  lastClass = None
+  for iFace in renderOrder(space):
+    faceClass = (space.faceKinds[iFace], space.faceIds[iFace])
+    if faceClass != lastClass:
+      drawRanges.extend(faceClass + (len(indices), 0))
+      lastClass = faceClass
+    start = mesh.loopStarts[iFace]
+    faceIndices = []
+    for li in range(start, start + mesh.loopTotals[iFace]):
+      corner = corners[li]
+      index = unique.get(corner)
+      if index is None:
+        index = unique[corner] = len(vertexBytes)
+        vertexBytes.append(corner)
+      faceIndices.append(index)
+    # Fan triangulation, as in gpuSetUp()
+    for n in range(2, len(faceIndices)):
+      indices.extend((faceIndices[0], faceIndices[n-1], faceIndices[n]))
+    drawRanges[-1] = len(indices) - drawRanges[-2]
+  vertices = array('f')
+  vertices.frombytes(b''.join(vertexBytes))
+  if sys.byteorder != 'little':
+    vertices.byteswap()
+  return GPUBuffers(vertices, indices, drawRanges)
+
+def checkGPUBuffers(space, buffers):
+  '''Returns a list of the ways in which buffers fail to reproduce the
+  faces of space; an empty list means they are correct.'''
+  problems = []
+  vertices = buffers.vertices
+  indices = buffers.indices
+  numVerts = len(vertices) // 8
+  vertexBytes = [GPU_VERT.pack(*vertices[8*i:8*i+8]) for i in range(numVerts)]
+  if len(set(vertexBytes)) != numVerts:
+    problems.append('vertex buffer has duplicate vertices')
+
+  # The triangles each face class should produce...
+  corners = gpuCorners(space)
+  mesh = space.mesh
+  expected = {}
+  for iFace in range(space.numFaces):
+    start = mesh.loopStarts[iFace]
+    loops = range(start, start + mesh.loopTotals[iFace])
+    tris = expected.setdefault((space.faceKinds[iFace], space.faceIds[iFace]), [])
+    for n in range(2, len(loops)):
+      tris.append((corners[loops[0]], corners[loops[n-1]], corners[loops[n]]))
+
+  # ...and the triangles the draw ranges produce
+  got = {}
+  lastClass = None
+  nextIndex = 0
+  for i in range(0, len(buffers.drawRanges), 4):
+    kind, faceId, first, count = buffers.drawRanges[i:i+4]
+    faceClass = (kind, faceId)
+    if lastClass is not None and faceClass <= lastClass:
+      problems.append('draw range %d (%s %d) is out of order' % (i // 4, faceKindNames[kind], faceId))
+    if first != nextIndex or count % 3:
+      problems.append('draw range %d covers indices %d..%d' % (i // 4, first, first + count))
+    lastClass = faceClass
+    nextIndex = first + count
+    tris = got.setdefault(faceClass, [])
+    for j in range(first, first + count - 2, 3):
+      if max(indices[j:j+3]) >= numVerts:
+        problems.append('index out of range in draw range %d' % (i // 4))
+        break
+      tris.append(tuple(vertexBytes[vi] for vi in indices[j:j+3]))
+  if nextIndex != len(indices):
+    problems.append('draw ranges cover %d of %d indices' % (nextIndex, len(indices)))
+
+  for faceClass in sorted(set(expected) | set(got)):
+    if sorted(expected.get(faceClass, [])) != sorted(got.get(faceClass, [])):
+      problems.append('%s %d: draw range triangles differ from the faces' %
+        (faceKindNames[faceClass[0]], faceClass[1]))
+  return problems
+
+if __name__ == '__main__':
+  from escher_reader import readEsc6
+  if len(sys.argv) != 2:
+    sys.exit(__doc__.split('Usage: ')[1])
+  failed = False
+  if sys.argv[1].endswith('.escb'):
+    escb = EscbFile(sys.argv[1])
+    escherMap = escb.toMap()
+    spaceBuffers = [GPUBuffers.fromEscb(escb.space(i)) for i in range(len(escb))]
+  else:
+    with open(sys.argv[1], 'rb') as f:
+      escherMap = readEsc6(f)
+    spaceBuffers = [buildGPUBuffers(space) for space in escherMap.spaces]
+  for iSpace, (space, buffers) in enumerate(zip(escherMap.spaces, spaceBuffers)):
+    if buffers is None:
+      print('space %d: no GPU buffers' % iSpace)
+      failed = True
+      continue
+    problems = checkGPUBuffers(space, buffers)
+    print('space %d: %d corners welded into %d vertices, %d draw ranges%s' % (iSpace,
+      len(space.mesh.loopVerts), len(buffers.vertices) // 8, len(buffers.drawRanges) // 4,
+      ''.join('\n  ' + p for p in problems)))
+    failed = failed or bool(problems)
+  sys.exit(1 if failed else 0)
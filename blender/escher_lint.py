@@ -0,0 +1,221 @@
+# Copyright 2014 Don Viszneki
+# Checks maps for broken portals and remotes before the game sees them.
+
+"""
+Problems with the links between spaces otherwise only show up as asserts
+in the game's loader or as glitches at runtime. lintMap() sweeps each
+space of an EscherMap once and reports all of them. Errors are what the
+loader rejects; the rest are warnings:
+
+  errors
+    portal faces of a remote the space does not have
+    faces of a material the map does not have
+    remotes to spaces the map does not have
+  warnings
+    portal faces of a remote to no space, which the game ignores
+    portal faces which are not flat
+    degenerate faces: repeated corners, or no area
+    remotes to no space, or without any portal faces
+    spaces which cannot be reached from the player's space
+    no player spawn
+
+lintRemoteObjects() checks what the exporter reads from a PSO's remote
+empties before it builds the map: that each has a remote space, which
+exists, as the exporter needs, and a portal index, unique within the
+PSO.
+
+Problems are reported with the space, face and remote they concern.
+
+Usage: python escher_lint.py MAP.esc6 [MAP.esc6 ...]
+Exits with status 1 if any map has errors.
+"""
+import math
+import sys
+import time
+from collections import namedtuple, deque
+from escher_map import FACE_REMOTE
+
+ERROR = 'error'
+WARNING = 'warning'
+
+# space, face and remote are indices, or None when the problem is not about one
+Problem = namedtuple('Problem', 'severity space face remote message')
+
+def faceNormalArea(xs, ys, zs, corners):
+  '''The unit Newell normal of the face with corners, as vert indices,
+  and its area; the normal is None for faces without area.'''
+  nx = ny = nz = 0.0
+  prev = corners[-1]
+  for vi in corners:
+    nx += (ys[prev] - ys[vi]) * (zs[prev] + zs[vi])
+    ny += (zs[prev] - zs[vi]) * (xs[prev] + xs[vi])
+    nz += (xs[prev] - xs[vi]) * (ys[prev] + ys[vi])
+    prev = vi
+  length = math.sqrt(nx*nx + ny*ny + nz*nz)
+  if length == 0:
+    return None, 0.0
+  return (nx / length, ny / length, nz / length), length / 2
+
+def lintSpace(escherMap, iSpace, space, planarTolerance=1e-4, minArea=1e-12):
+  '''The problems of one space. A portal face is not flat if a corner is
+  further than planarTolerance times the square root of its area from the
+  plane through its first corner.'''
+  problems = []
+  numSpaces = len(escherMap.spaces)
+  numMaterials = len(escherMap.materials)
+  numRemotes = len(space.remotes)
+  mesh = space.mesh
+  verts = mesh.verts
+  xs, ys, zs = verts[0::3], verts[1::3], verts[2::3]
+  loopVerts = mesh.loopVerts
+  portalFaces = [0] * numRemotes
+
+  for iFace, (kind, faceId, start, total) in enumerate(zip(space.faceKinds, space.faceIds,
+      mesh.loopStarts, mesh.loopTotals)):
+    corners = loopVerts[start:start+total]
+    if kind == FACE_REMOTE:
+      if not 0 <= faceId < numRemotes:
+        problems.append(Problem(ERROR, iSpace, iFace, faceId,
+          'portal face of remote %d, but the space has %d remotes' % (faceId, numRemotes)))
+      else:
+        portalFaces[faceId] += 1
+    elif not 0 <= faceId < numMaterials:
+      problems.append(Problem(ERROR, iSpace, iFace, None,
+        'face of material %d, but the map has %d materials' % (faceId, numMaterials)))
+
+    if len(set(corners)) != total:
+      problems.append(Problem(WARNING, iSpace, iFace, None, 'face repeats a corner'))
+      continue
+    normal, area = faceNormalArea(xs, ys, zs, corners)
+    if area <= minArea:
+      problems.append(Problem(WARNING, iSpace, iFace, None, 'face has no area'))
+    elif kind == FACE_REMOTE and total > 3:
+      p = corners[0]
+      d = normal[0]*xs[p] + normal[1]*ys[p] + normal[2]*zs[p]
+      worst = max(abs(normal[0]*xs[vi] + normal[1]*ys[vi] + normal[2]*zs[vi] - d) for vi in corners)
+      if worst > planarTolerance * math.sqrt(area):
+        problems.append(Problem(WARNING, iSpace, iFace, faceId,
+          'portal face is not flat: a corner is %g off its plane' % worst))
+
+  for iRemote, remote in enumerate(space.remotes):
+    if remote.space >= numSpaces or remote.space < -1:
+      problems.append(Problem(ERROR, iSpace, None, iRemote,
+        'remote to space %d, but the map has %d spaces' % (remote.space, numSpaces)))
+    elif remote.space == -1:
+      if portalFaces[iRemote]:
+        problems.append(Problem(WARNING, iSpace, None, iRemote,
+          'remote to no space has %d portal faces' % portalFaces[iRemote]))
+      else:
+        problems.append(Problem(WARNING, iSpace, None, iRemote, 'remote to no space'))
+    elif not portalFaces[iRemote]:
+      problems.append(Problem(WARNING, iSpace, None, iRemote, 'remote has no portal faces'))
+  return problems
+
+def playerSpace(escherMap):
+  '''The space the game puts the player in: that of the last player
+  spawn, or None if there is none.'''
+  found = None
+  for iSpace, space in enumerate(escherMap.spaces):
+    if any(spawn.type == 'player' for spawn in space.spawns):
+      found = iSpace
+  return found
+
+def lintReachability(escherMap):
+  problems = []
+  spaces = escherMap.spaces
+  start = playerSpace(escherMap)
+  if start is None:
+    if spaces:
+      problems.append(Problem(WARNING, None, None, None, 'map has no player spawn'))
+    start = 0
+  if not spaces:
+    return problems
+  reached = [False] * len(spaces)
+  reached[start] = True
+  queue = deque([start])
+  while queue:
+    for remote in spaces[queue.popleft()].remotes:
+      if 0 <= remote.space < len(spaces) and not reached[remote.space]:
+        reached[remote.space] = True
+        queue.append(remote.space)
+  for iSpace, r in enumerate(reached):
+    if not r:
+      problems.append(Problem(WARNING, iSpace, None, None,
+        'space cannot be reached from space %d' % start))
+  return problems
+
+def lintMap(escherMap, planarTolerance=1e-4, minArea=1e-12):
+  '''Every problem of escherMap, space by space.'''
+  problems = []
+  for iSpace, space in enumerate(escherMap.spaces):
+    problems.extend(lintSpace(escherMap, iSpace, space, planarTolerance, minArea))
+  problems.extend(lintReachability(escherMap))
+  return problems
+
+def lintRemoteObjects(spaceName, remotes, spaceNames):
+  '''The problems of the remote empties of one PSO, given as (object name,
+  escher_portal_index, escher_remote_space_name) tuples in the order the
+  exporter writes them, with None for missing properties. spaceNames
+  holds the names of every space.'''
+  problems = []
+  portalIndices = {}
+  for iRemote, (name, portalIndex, remoteSpaceName) in enumerate(remotes):
+    def report(severity, message):
+      problems.append(Problem(severity, spaceName, None, iRemote, '%s: %s' % (name, message)))
+    if remoteSpaceName is None:
+      report(ERROR, "has no 'escher_remote_space_name'")
+    elif remoteSpaceName == '*none*':
+      report(WARNING, 'remote to no space')
+    elif remoteSpaceName not in spaceNames:
+      report(ERROR, 'remote to space "%s", which does not exist' % remoteSpaceName)
+    if portalIndex is None:
+      report(WARNING, "has no 'escher_portal_index'")
+    elif portalIndex in portalIndices:
+      report(WARNING, 'portal index %d is also used by %s' % (portalIndex, portalIndices[portalIndex]))
+    else:
+      portalIndices[portalIndex] = name
+      if portalIndex != iRemote:
+        report(WARNING, 'portal index %d, but exported as remote %d' % (portalIndex, iRemote))
+  return problems
+
+def errors(problems):
+  return [p for p in problems if p.severity == ERROR]
+
+def formatProblem(problem, spaceNames=None):
+  '''One line describing problem. spaceNames, if given, names spaces
+  given by index.'''
+  where = []
+  if problem.space is not None:
+    name = problem.space
+    if spaceNames is not None and type(name) is int and name < len(spaceNames):
+      name = spaceNames[name]
+    where.append('space %s' % name)
+  if problem.face is not None:
+    where.append('face %d' % problem.face)
+  if problem.remote is not None:
+    where.append('remote %d' % problem.remote)
+  return '%s: %s%s' % (problem.severity, ', '.join(where) + ': ' if where else '', problem.message)
+
+if __name__ == '__main__':
+  from escher_reader import MapError, readEsc6
+  if len(sys.argv) < 2:
+    sys.exit(__doc__.split('Usage: ')[1])
+  failed = False
+  for filename in sys.argv[1:]:
+    try:
+      with open(filename, 'rb') as f:
+        escherMap = readEsc6(f, strict=False)
+    except (MapError, OSError) as e:
+      print('%s: %s' % (filename, e))
+      failed = True
+      continue
+    t0 = time.perf_counter()
+    problems = lintMap(escherMap)
+    seconds = time.perf_counter() - t0
+    for problem in problems:
+      print('%s: %s' % (filename, formatProblem(problem)))
+    numErrors = len(errors(problems))
+    print('%s: %d errors, %d warnings in %d spaces (%.3fs)' % (filename, numErrors,
+      len(problems) - numErrors, len(escherMap.spaces), seconds))
+    failed = failed or numErrors > 0
+  sys.exit(1 if failed else 0)
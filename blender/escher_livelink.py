@@ -0,0 +1,440 @@
+# Copyright 2014 Don Viszneki
+# Streams changed spaces of a map to a running game as they are edited.
+
+"""
+A LiveLinkServer listens on a local TCP port or Unix socket. Each time a
+map is published to it, it sends its clients only the spaces which
+changed since the last publish, found by the keys escher_cache uses, so
+the game can swap them in without reloading the map. Escher Tools
+publishes the scene in live-link mode whenever objects, meshes or
+materials are edited.
+
+Everything is little-endian. A message is a FRAME header followed by its
+payload:
+
+  HELLO   server to client on connect: protocol version, space encoding
+  MAP     the whole map as .esc6 text; sent on connect, and whenever the
+          materials or the list of spaces change, as these renumber
+          what spaces refer to
+  SPACE   SPACE_HEAD, then one space: its .esc6 block ("space" to its
+          last "face" line), or with ENCODING_ESCB its .escb sections,
+          packed as a chunk of escher_chunks
+  RESYNC  client to server: asks for the whole map again
+
+Every publish which sends anything has the next sequence number, and
+all its messages carry it; a client which sees a number skipped asks to
+resync. A client too slow to keep up has its backlog of messages
+replaced by one MAP.
+
+LiveLinkClient is a reference client: it applies messages to the .esc6
+text of the map, and checks that against a full export.
+
+Usage: python escher_livelink.py serve MAP.esc6 [--address ADDRESS] [--binary]
+       python escher_livelink.py client [--address ADDRESS] [--check MAP.esc6]
+serve publishes MAP.esc6 again whenever the file changes; client prints
+what it receives, and with --check compares the map with MAP.esc6 after
+every publish. ADDRESS is HOST:PORT or the path of a Unix socket.
+"""
+import argparse
+import io
+import os
+import re
+import select
+import socket
+import struct
+import time
+import zlib
+from collections import deque
+from escher_binary import EscbSpace, realTypecodes, spaceSections
+from escher_cache import mapDigest, spaceKey
+from escher_chunks import Chunk, packChunk
+from escher_map import formatSpace, formatSpaces, writeEsc6
+from escher_reader import readEsc6
+
+MAGIC = b'ESLL'
+VERSION = 1
+
+# magic, message type, payload size, sequence number, crc32 of the payload
+FRAME = struct.Struct('<4sIIQI')
+# space index, encoding, number of .escb sections, real size
+SPACE_HEAD = struct.Struct('<IIII')
+HELLO = struct.Struct('<II')
+
+MSG_HELLO = 0
+MSG_MAP = 1
+MSG_SPACE = 2
+MSG_RESYNC = 3
+
+messageNames = ('hello', 'map', 'space', 'resync')
+
+ENCODING_ESC6 = 0
+ENCODING_ESCB = 1
+
+DEFAULT_ADDRESS = ('127.0.0.1', 27460)
+DEFAULT_MAX_BACKLOG = 64 << 20
+
+class LiveLinkError(Exception):
+  pass
+
+def parseAddress(text):
+  '''HOST:PORT as a TCP address, or anything else as a Unix socket path.'''
+  host, colon, port = text.rpartition(':')
+  if colon and port.isdigit() and '/' not in text:
+    return (host or DEFAULT_ADDRESS[0], int(port))
+  return text
+
+def formatAddress(address):
+  return address if isinstance(address, str) else '%s:%d' % address
+
+def makeSocket(address):
+  family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+  return socket.socket(family, socket.SOCK_STREAM)
+
+def packFrame(msgType, seq, payload=b''):
+  return FRAME.pack(MAGIC, msgType, len(payload), seq, zlib.crc32(payload)) + payload
+
+def formatHead(escherMap):
+  '''The .esc6 text of a map before its first space.'''
+  out = io.StringIO()
+  writeEsc6(escherMap, out, [])
+  return out.getvalue()
+
+def splitEsc6(text):
+  '''The head and the space blocks of the .esc6 text of a map.'''
+  starts = [m.start() for m in re.finditer(r'(?m)^space \d', text)]
+  if not starts:
+    return text, []
+  ends = starts[1:] + [len(text)]
+  return text[:starts[0]], [text[s:e] for s, e in zip(starts, ends)]
+
+class Connection:
+  '''A client of a LiveLinkServer: the frames waiting to be sent, how
+  much of the first has gone, and what it has sent us.'''
+  __slots__ = ('sock', 'frames', 'sent', 'backlog', 'incoming')
+
+  def __init__(self, sock):
+    self.sock = sock
+    self.frames = deque()
+    self.sent = 0
+    self.backlog = 0
+    self.incoming = bytearray()
+
+class LiveLinkServer:
+  '''Sends published maps to clients; see the module's description. Call
+  poll() often, e.g. from a timer, to accept clients and send.'''
+
+  def __init__(self, address=DEFAULT_ADDRESS, encoding=ENCODING_ESC6, maxBacklog=DEFAULT_MAX_BACKLOG):
+    self.encoding = encoding
+    self.maxBacklog = maxBacklog
+    self.listener = makeSocket(address)
+    if isinstance(address, str):
+      if os.path.exists(address):
+        os.remove(address)
+    else:
+      self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.listener.bind(address)
+    self.listener.listen(4)
+    self.listener.setblocking(False)
+    self.address = address if isinstance(address, str) else self.listener.getsockname()
+    self.connections = []
+    self.seq = 0
+    self.escherMap = None
+    self.digest = None
+    self.keys = []
+    self.head = None
+    self.blocks = []
+    self.mapFrame = None
+
+  def publish(self, escherMap):
+    '''Sends the spaces of escherMap which changed since the last publish,
+    or the whole map if its materials or spaces did. Returns the indices
+    of the spaces sent.'''
+    digest = mapDigest(escherMap)
+    keys = [spaceKey(space, i, digest) for i, space in enumerate(escherMap.spaces)]
+    if digest != self.digest:
+      changed = list(range(len(keys)))
+    else:
+      changed = [i for i, key in enumerate(keys) if key != self.keys[i]]
+    wholeMap = digest != self.digest
+    if not changed and not wholeMap:
+      return []
+    self.seq += 1
+    if wholeMap:
+      self.blocks = [None] * len(keys)
+    for i, block in zip(changed, formatSpaces(escherMap, changed)):
+      self.blocks[i] = block
+    self.escherMap = escherMap
+    self.digest = digest
+    self.keys = keys
+    self.mapFrame = None
+    if wholeMap:
+      self.head = formatHead(escherMap)
+      for conn in self.connections:
+        self.sendMap(conn)
+    else:
+      frames = [packFrame(MSG_SPACE, self.seq, self.spacePayload(i)) for i in changed]
+      for conn in self.connections:
+        for frame in frames:
+          self.send(conn, frame)
+    return changed
+
+  def spacePayload(self, i):
+    if self.encoding == ENCODING_ESCB:
+      space = self.escherMap.spaces[i]
+      realSize = space.mesh.verts.itemsize
+      sections = spaceSections(space, realTypecodes[realSize])
+      return SPACE_HEAD.pack(i, ENCODING_ESCB, len(sections), realSize) + packChunk(sections)
+    return SPACE_HEAD.pack(i, ENCODING_ESC6, 0, 0) + self.blocks[i].encode('utf-8')
+
+  def sendMap(self, conn):
+    '''Replaces everything conn has yet to receive with the whole map.'''
+    if self.mapFrame is None:
+      self.mapFrame = packFrame(MSG_MAP, self.seq, (self.head + ''.join(self.blocks)).encode('utf-8'))
+    # A frame partly sent has to be finished
+    while len(conn.frames) > (1 if conn.sent else 0):
+      conn.backlog -= len(conn.frames.pop())
+    conn.frames.append(self.mapFrame)
+    conn.backlog += len(self.mapFrame)
+
+  def send(self, conn, frame):
+    if conn.backlog + len(frame) > self.maxBacklog:
+      self.sendMap(conn)
+    else:
+      conn.frames.append(frame)
+      conn.backlog += len(frame)
+
+  def poll(self, timeout=0.0):
+    '''Accepts clients, reads their requests and sends what it can,
+    waiting up to timeout seconds for any of it.'''
+    socks = [conn.sock for conn in self.connections]
+    writable = [conn.sock for conn in self.connections if conn.frames]
+    readable, writable, broken = select.select([self.listener] + socks, writable, [], timeout)
+    for sock in readable:
+      if sock is self.listener:
+        self.accept()
+      else:
+        self.receive(self.connection(sock))
+    for sock in writable:
+      conn = self.connection(sock)
+      if conn is not None:
+        self.flush(conn)
+
+  def connection(self, sock):
+    for conn in self.connections:
+      if conn.sock is sock:
+        return conn
+    return None
+
+  def accept(self):
+    try:
+      sock, address = self.listener.accept()
+    except (BlockingIOError, InterruptedError):
+      return
+    sock.setblocking(False)
+    conn = Connection(sock)
+    self.connections.append(conn)
+    if self.head is not None:
+      self.sendMap(conn)
+    hello = packFrame(MSG_HELLO, self.seq, HELLO.pack(VERSION, self.encoding))
+    conn.frames.appendleft(hello)
+    conn.backlog += len(hello)
+
+  def receive(self, conn):
+    if conn is None:
+      return
+    try:
+      data = conn.sock.recv(65536)
+    except (BlockingIOError, InterruptedError):
+      return
+    except OSError:
+      data = b''
+    if not data:
+      self.drop(conn)
+      return
+    conn.incoming += data
+    while len(conn.incoming) >= FRAME.size:
+      magic, msgType, size, seq, crc = FRAME.unpack_from(conn.incoming)
+      if magic != MAGIC:
+        self.drop(conn)
+        return
+      if len(conn.incoming) < FRAME.size + size:
+        break
+      del conn.incoming[:FRAME.size + size]
+      if msgType == MSG_RESYNC and self.head is not None:
+        self.sendMap(conn)
+
+  def flush(self, conn):
+    while conn.frames:
+      frame = conn.frames[0]
+      try:
+        n = conn.sock.send(memoryview(frame)[conn.sent:])
+      except (BlockingIOError, InterruptedError):
+        return
+      except OSError:
+        self.drop(conn)
+        return
+      conn.sent += n
+      if conn.sent < len(frame):
+        return
+      conn.frames.popleft()
+      conn.backlog -= len(frame)
+      conn.sent = 0
+
+  def drop(self, conn):
+    conn.sock.close()
+    self.connections.remove(conn)
+
+  def close(self):
+    for conn in list(self.connections):
+      self.drop(conn)
+    self.listener.close()
+    if isinstance(self.address, str) and os.path.exists(self.address):
+      os.remove(self.address)
+
+class LiveLinkClient:
+  '''Applies what a LiveLinkServer sends to the .esc6 text of the map,
+  kept as its head and one block per space.'''
+
+  def __init__(self, address=DEFAULT_ADDRESS, timeout=None):
+    self.sock = makeSocket(address)
+    self.sock.settimeout(timeout)
+    self.sock.connect(address)
+    self.seq = None
+    self.encoding = None
+    self.head = None
+    self.blocks = []
+    self.resyncs = 0
+
+  def receiveExactly(self, n):
+    buf = bytearray()
+    while len(buf) < n:
+      data = self.sock.recv(n - len(buf))
+      if not data:
+        raise LiveLinkError('server closed the connection')
+      buf += data
+    return bytes(buf)
+
+  def receive(self):
+    '''Waits for the next message: (type, sequence number, payload).'''
+    magic, msgType, size, seq, crc = FRAME.unpack(self.receiveExactly(FRAME.size))
+    if magic != MAGIC:
+      raise LiveLinkError('not an Escher live link')
+    payload = self.receiveExactly(size)
+    if zlib.crc32(payload) != crc:
+      raise LiveLinkError('message %d is corrupt' % seq)
+    return msgType, seq, payload
+
+  def pending(self, timeout=0.0):
+    return bool(select.select([self.sock], [], [], timeout)[0])
+
+  def update(self, timeout=0.0, settle=0.05):
+    '''Waits up to timeout seconds (None for ever) for a message, then
+    applies it and every other which follows within settle seconds of the
+    last. Returns the (type, sequence number, space index or None) of
+    each.'''
+    applied = []
+    while self.pending(timeout):
+      msgType, seq, payload = self.receive()
+      applied.append((msgType, seq, self.apply(msgType, seq, payload)))
+      timeout = settle
+    return applied
+
+  def apply(self, msgType, seq, payload):
+    '''Applies one message, returning the index of the space it replaced,
+    if any.'''
+    if msgType == MSG_HELLO:
+      version, self.encoding = HELLO.unpack(payload)
+      if version != VERSION:
+        raise LiveLinkError('unsupported live link version %d' % version)
+    elif msgType == MSG_MAP:
+      self.head, self.blocks = splitEsc6(payload.decode('utf-8'))
+      self.seq = seq
+    elif msgType == MSG_SPACE:
+      i, encoding, numSections, realSize = SPACE_HEAD.unpack_from(payload)
+      if self.seq is None or seq > self.seq + 1 or i >= len(self.blocks):
+        self.resync()
+        return None
+      self.seq = seq
+      data = payload[SPACE_HEAD.size:]
+      if encoding == ENCODING_ESCB:
+        space = EscbSpace(Chunk(data, realTypecodes[realSize]), 0, numSections).toSpace()
+        self.blocks[i] = formatSpace(space, i)
+      else:
+        self.blocks[i] = data.decode('utf-8')
+      return i
+    return None
+
+  def resync(self):
+    self.resyncs += 1
+    self.sock.sendall(packFrame(MSG_RESYNC, self.seq or 0))
+
+  def text(self):
+    return (self.head or '') + ''.join(self.blocks)
+
+  def toMap(self):
+    return readEsc6(io.BytesIO(self.text().encode('utf-8')))
+
+  def check(self, expected):
+    '''The differences between the map received and expected, an
+    EscherMap or its .esc6 text: "head" and the indices of the spaces which
+    differ. Empty if they match.'''
+    if not isinstance(expected, str):
+      out = io.StringIO()
+      writeEsc6(expected, out)
+      expected = out.getvalue()
+    head, blocks = splitEsc6(expected)
+    differences = [] if head == self.head else ['head']
+    for i in range(max(len(blocks), len(self.blocks))):
+      if i >= len(blocks) or i >= len(self.blocks) or blocks[i] != self.blocks[i]:
+        differences.append(i)
+    return differences
+
+  def close(self):
+    self.sock.close()
+
+def serve(filename, address, encoding, interval=0.2):
+  server = LiveLinkServer(address, encoding)
+  print('serving %s on %s' % (filename, formatAddress(server.address)))
+  mtime = None
+  try:
+    while True:
+      if os.path.getmtime(filename) != mtime:
+        mtime = os.path.getmtime(filename)
+        with open(filename, 'rb') as f:
+          escherMap = readEsc6(f)
+        t0 = time.perf_counter()
+        changed = server.publish(escherMap)
+        print('publish %d: %d of %d spaces changed (%.3fs)' % (server.seq, len(changed),
+          len(escherMap.spaces), time.perf_counter() - t0))
+      server.poll(interval)
+  finally:
+    server.close()
+
+def runClient(address, checkFilename):
+  client = LiveLinkClient(address)
+  while True:
+    for msgType, seq, space in client.update(None):
+      print('%d %s%s' % (seq, messageNames[msgType], '' if space is None else ' %d' % space))
+    if checkFilename is not None and client.head is not None:
+      with open(checkFilename) as f:
+        differences = client.check(f.read())
+      print('check: %s' % ('matches' if not differences else 'differs in %s' %
+        ', '.join(map(str, differences))))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Escher live link server and reference client.')
+  parser.add_argument('mode', choices=('serve', 'client'))
+  parser.add_argument('map', nargs='?', metavar='MAP.esc6')
+  parser.add_argument('--address', type=parseAddress, default=DEFAULT_ADDRESS)
+  parser.add_argument('--binary', action='store_true', help='send spaces as .escb sections')
+  parser.add_argument('--check', metavar='MAP.esc6')
+  args = parser.parse_args()
+  try:
+    if args.mode == 'serve':
+      if args.map is None:
+        parser.error('serve needs a map')
+      serve(args.map, args.address, ENCODING_ESCB if args.binary else ENCODING_ESC6)
+    else:
+      runClient(args.address, args.check)
+  except KeyboardInterrupt:
+    pass
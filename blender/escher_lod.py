@@ -0,0 +1,446 @@
+# Copyright 2014 Don Viszneki
+# Decimated level-of-detail meshes of Escher spaces.
+
+"""
+World.drawSpace() draws a space seen through several portals with all of
+its geometry, though it may cover only a few pixels. buildLODs() makes
+coarser versions of a space by edge collapse, choosing the cheapest
+collapse by quadric error (Garland and Heckbert) each time, so a renderer
+can draw a coarser level the deeper it recurses; see lodForDepth().
+
+Material faces are triangulated and decimated. Portal faces are kept as
+they are, and so are the vertices of portal faces, vertices where faces
+of different materials meet, vertices on open edges or on edges of more
+than two triangles, and vertices on UV seams. Collapses which would flip
+a triangle or make the mesh non-manifold are skipped. The corners a
+collapse moves onto the kept vertex take the UVs its corners have on the
+collapsed edge, so on the same side of any seam through it; corners whose
+vertex had one normal keep it, and the others take the normal of their
+new triangle.
+
+Each level is decimated further from the one before, down to a fraction
+of the material triangles of the space, and records its error: the
+largest of the root mean square distances, over the area each collapse
+replaced, between the old surface and the vertex it kept. Once a level
+removes no triangles, as in spaces whose vertices are all kept, no
+further levels are made.
+
+Levels are stored in .escb and .escz as these optional sections, n being
+the level from 1 to 9, with reals in f32:
+
+  LnHD  numVerts numFaces numLoops numUVLayers (u32), error (f64)
+  LnVT  xyz per vertex
+  LnFT  loops per face (u32)
+  LnFK  FACE_MAT or FACE_REMOTE per face (u8)
+  LnFI  material or remote index per face (i32)
+  LnLV  vertex index per loop (u32)
+  LnUV  uv pair per loop, for each UV layer in turn
+  LnNM  xyz normal per loop
+
+Usage: python escher_lod.py MAP.esc6 [LEVELS [OUT.esc6]]
+Prints the triangles, error and UV span of each level of each space, and
+writes the map at its coarsest level to OUT.esc6. On escher_synth's floor
+maps, a UV span near seamOffset means UVs were carried across the seam.
+"""
+import heapq
+import math
+import struct
+import sys
+import time
+from array import array
+from escher_binary import copyArray, leBytes
+from escher_map import EscherMap, Remote, Space, FACE_REMOTE, writeEsc6
+from escher_mesh import MeshArrays
+from escher_triangulate import triangulatePolygon
+
+LOD_HEAD = struct.Struct('<4Id')
+
+LEVEL_RATIOS = (0.5, 0.25, 0.125)
+
+# The section tags hold the level in a single digit
+MAX_LEVELS = 9
+
+def levelRatios(numLevels):
+  '''Each level keeping half as many triangles as the one before.'''
+  return tuple(0.5 ** (n + 1) for n in range(numLevels))
+
+def lodForDepth(depth, numLevels):
+  '''The level to draw a space at depth portals deep: full detail for the
+  space the player is in and those seen directly, then one level coarser
+  per portal. Level 0 is the full mesh.'''
+  return max(0, min(depth - 1, numLevels))
+
+def planeQuadric(p0, p1, p2):
+  '''The area weighted quadric of a triangle's plane, as the 10 distinct
+  entries of its symmetric 4x4 matrix followed by the area, or None if it
+  has no area.'''
+  ux, uy, uz = p1[0] - p0[0], p1[1] - p0[1], p1[2] - p0[2]
+  vx, vy, vz = p2[0] - p0[0], p2[1] - p0[1], p2[2] - p0[2]
+  nx, ny, nz = uy*vz - uz*vy, uz*vx - ux*vz, ux*vy - uy*vx
+  length = math.sqrt(nx*nx + ny*ny + nz*nz)
+  if length == 0:
+    return None
+  w = length / 2
+  a, b, c = nx / length, ny / length, nz / length
+  d = -(a*p0[0] + b*p0[1] + c*p0[2])
+  return [w*a*a, w*a*b, w*a*c, w*a*d, w*b*b, w*b*c, w*b*d, w*c*c, w*c*d, w*d*d, w]
+
+def quadricError(q, p):
+  x, y, z = p
+  return (q[0]*x*x + 2*q[1]*x*y + 2*q[2]*x*z + 2*q[3]*x + q[4]*y*y + 2*q[5]*y*z + 2*q[6]*y +
+    q[7]*z*z + 2*q[8]*z + q[9])
+
+def quadricMinimum(q):
+  '''The point of least error of q, or None if it has no single one.'''
+  a, b, c, d, e, f, g, h, i = q[0], q[1], q[2], q[1], q[4], q[5], q[2], q[5], q[7]
+  det = a*(e*i - f*h) - b*(d*i - f*g) + c*(d*h - e*g)
+  if abs(det) < 1e-12:
+    return None
+  r0, r1, r2 = -q[3], -q[6], -q[8]
+  return ((r0*(e*i - f*h) - b*(r1*i - f*r2) + c*(r1*h - e*r2)) / det,
+    (a*(r1*i - f*r2) - r0*(d*i - f*g) + c*(d*r2 - r1*g)) / det,
+    (a*(e*r2 - r1*h) - b*(d*r2 - r1*g) + r0*(d*h - e*g)) / det)
+
+def triNormal(p0, p1, p2):
+  ux, uy, uz = p1[0] - p0[0], p1[1] - p0[1], p1[2] - p0[2]
+  vx, vy, vz = p2[0] - p0[0], p2[1] - p0[1], p2[2] - p0[2]
+  return uy*vz - uz*vy, uz*vx - ux*vz, ux*vy - uy*vx
+
+class LODLevel:
+  '''One level of detail of a space: space is an escher_map.Space holding
+  its mesh, and error its error as described above.'''
+  __slots__ = ('level', 'ratio', 'error', 'space')
+
+  def __init__(self, level, ratio, error, space):
+    self.level = level
+    self.ratio = ratio
+    self.error = error
+    self.space = space
+
+  def sections(self):
+    '''The .escb (tag, count, bytes) sections of this level.'''
+    mesh = self.space.mesh
+    n = str(self.level).encode('ascii')
+    numLoops = len(mesh.loopVerts)
+    return [
+      (b'L' + n + b'HD', 1, LOD_HEAD.pack(mesh.numVerts, mesh.numFaces, numLoops,
+        len(mesh.uvLayers), self.error)),
+      (b'L' + n + b'VT', mesh.numVerts, leBytes(mesh.verts, 'f')),
+      (b'L' + n + b'FT', mesh.numFaces, leBytes(mesh.loopTotals, 'I')),
+      (b'L' + n + b'FK', mesh.numFaces, leBytes(self.space.faceKinds, 'B')),
+      (b'L' + n + b'FI', mesh.numFaces, leBytes(self.space.faceIds, 'i')),
+      (b'L' + n + b'LV', numLoops, leBytes(mesh.loopVerts, 'I')),
+      (b'L' + n + b'UV', numLoops * len(mesh.uvLayers),
+        b''.join(leBytes(uvs, 'f') for uvs in mesh.uvLayers)),
+      (b'L' + n + b'NM', numLoops, leBytes(mesh.loopNormals, 'f')),
+    ]
+
+def lodFromEscb(escbSpace, level):
+  '''Level level of an escher_binary.EscbSpace as an escher_map.Space, or
+  None if the space does not have that level.'''
+  n = str(level).encode('ascii')
+  if b'L' + n + b'HD' not in escbSpace.sections:
+    return None
+  numVerts, numFaces, numLoops, numUVLayers, error = LOD_HEAD.unpack(escbSpace.raw(b'L' + n + b'HD'))
+  loopTotals = copyArray(escbSpace.view(b'L' + n + b'FT', 'I'), 'I')
+  loopStarts = array('i', bytes(4 * numFaces))
+  start = 0
+  for i, total in enumerate(loopTotals):
+    loopStarts[i] = start
+    start += total
+  uvs = escbSpace.view(b'L' + n + b'UV', 'f')
+  mesh = MeshArrays(copyArray(escbSpace.view(b'L' + n + b'VT', 'f'), 'f'), loopStarts, loopTotals,
+    copyArray(escbSpace.view(b'L' + n + b'LV', 'I'), 'I'),
+    [copyArray(uvs[2*numLoops*i:2*numLoops*(i+1)], 'f') for i in range(numUVLayers)],
+    copyArray(escbSpace.view(b'L' + n + b'NM', 'f'), 'f'), None)
+  xfms = escbSpace.remoteTransforms
+  remotes = [Remote(s, xfms[6*i:6*i+3], xfms[6*i+3:6*i+6])
+    for i, s in enumerate(escbSpace.remoteSpaces)]
+  return Space(None, mesh, copyArray(escbSpace.view(b'L' + n + b'FK', 'B'), 'B'),
+    copyArray(escbSpace.view(b'L' + n + b'FI', 'i'), 'i'), remotes)
+
+class Decimator:
+  '''Decimates the material faces of one space step by step; see the
+  module's description.'''
+
+  def __init__(self, space):
+    self.space = space
+    mesh = space.mesh
+    verts = mesh.verts
+    numVerts = mesh.numVerts
+    self.pos = [tuple(verts[3*i:3*i+3]) for i in range(numVerts)]
+    # Triangles as [a, b, c], with the loop each corner came from
+    self.tris = []
+    self.triLoops = []
+    self.triClasses = []
+    self.portalFaces = []
+    self.vertTris = [set() for i in range(numVerts)]
+    locked = set()
+    vertClass = {}
+    vertUVs = {}
+    vertNormals = {}
+    seams = set()
+    uvLayers = mesh.uvLayers
+    normals = mesh.loopNormals
+
+    for iFace, (kind, faceId, start, total) in enumerate(zip(space.faceKinds, space.faceIds,
+        mesh.loopStarts, mesh.loopTotals)):
+      loops = range(start, start + total)
+      corners = [mesh.loopVerts[li] for li in loops]
+      if kind == FACE_REMOTE:
+        self.portalFaces.append(iFace)
+        locked.update(corners)
+        continue
+      for li, vi in zip(loops, corners):
+        if vertClass.setdefault(vi, (kind, faceId)) != (kind, faceId):
+          locked.add(vi)
+        uv = tuple(c for uvs in uvLayers for c in uvs[2*li:2*li+2])
+        if vertUVs.setdefault(vi, uv) != uv:
+          seams.add(vi)
+        normal = tuple(normals[3*li:3*li+3])
+        if vertNormals.setdefault(vi, normal) != normal:
+          vertNormals[vi] = None
+      for tri in triangulatePolygon([self.pos[vi] for vi in corners]):
+        t = len(self.tris)
+        self.tris.append([corners[k] for k in tri])
+        self.triLoops.append([loops[k] for k in tri])
+        self.triClasses.append((kind, faceId))
+        for k in tri:
+          self.vertTris[corners[k]].add(t)
+
+    # Open and non-manifold edges
+    edgeTris = {}
+    for t, tri in enumerate(self.tris):
+      for k in range(3):
+        edge = tuple(sorted((tri[k], tri[k-1])))
+        edgeTris[edge] = edgeTris.get(edge, 0) + 1
+    for edge, count in edgeTris.items():
+      if count != 2:
+        locked.update(edge)
+
+    self.locked = locked | seams
+    self.smooth = {vi for vi, normal in vertNormals.items() if normal is not None}
+    self.live = [True] * len(self.tris)
+    self.numLive = len(self.tris)
+    self.numTris = len(self.tris)
+    self.error = 0.0
+    self.quadrics = [[0.0] * 11 for i in range(numVerts)]
+    for tri in self.tris:
+      q = planeQuadric(*[self.pos[vi] for vi in tri])
+      if q is not None:
+        for vi in tri:
+          qv = self.quadrics[vi]
+          for k in range(11):
+            qv[k] += q[k]
+    self.versions = [0] * numVerts
+    self.heap = []
+    for a, b in edgeTris:
+      self.pushEdge(a, b)
+
+  def neighbours(self, v):
+    return {u for t in self.vertTris[v] for u in self.tris[t]} - {v}
+
+  def target(self, a, b):
+    '''Where collapsing edge ab should put the vertex which remains, and
+    its cost and error, or None if the edge may not be collapsed.'''
+    lockedA = a in self.locked
+    lockedB = b in self.locked
+    if lockedA and lockedB:
+      return None
+    q = [x + y for x, y in zip(self.quadrics[a], self.quadrics[b])]
+    if lockedA:
+      candidates = [self.pos[a]]
+    elif lockedB:
+      candidates = [self.pos[b]]
+    else:
+      pa, pb = self.pos[a], self.pos[b]
+      candidates = [pa, pb, ((pa[0] + pb[0]) / 2, (pa[1] + pb[1]) / 2, (pa[2] + pb[2]) / 2)]
+      best = quadricMinimum(q)
+      if best is not None:
+        candidates.append(best)
+    cost, p = min([(quadricError(q, p), p) for p in candidates], key=lambda c: c[0])
+    cost = max(cost, 0.0)
+    return cost, math.sqrt(cost / q[10]) if q[10] else 0.0, p
+
+  def pushEdge(self, a, b):
+    found = self.target(a, b)
+    if found is not None:
+      cost, error, p = found
+      # Among collapses of equal cost, as on flat floors, prefer those
+      # between vertices of fewer triangles, to keep triangles even
+      valence = len(self.vertTris[a]) + len(self.vertTris[b])
+      heapq.heappush(self.heap, (cost, valence, a, b, self.versions[a], self.versions[b], error, p))
+
+  def keptLoop(self, keep, shared):
+    '''The loop to give the corners the gone vertex leaves to keep: that of
+    keep in the triangles on the collapsed edge, which lie on the same side
+    as the gone vertex of any seam through keep. None if those triangles
+    give keep different UVs, as when the seam runs along the edge.'''
+    uvLayers = self.space.mesh.uvLayers
+    loops = set(self.triLoops[t][self.tris[t].index(keep)] for t in shared)
+    uvs = set(tuple(c for uvs in uvLayers for c in uvs[2*li:2*li+2]) for li in loops)
+    if len(uvs) != 1:
+      return None
+    return min(loops)
+
+  def canCollapse(self, a, b, p):
+    shared = self.vertTris[a] & self.vertTris[b]
+    if self.keptLoop(b if b in self.locked else a, shared) is None:
+      return False
+    # The link condition: a and b may only share the neighbours of the
+    # triangles on their edge
+    opposite = {vi for t in shared for vi in self.tris[t]} - {a, b}
+    if (self.neighbours(a) & self.neighbours(b)) - opposite:
+      return False
+    for v in (a, b):
+      for t in self.vertTris[v] - shared:
+        tri = self.tris[t]
+        before = triNormal(*[self.pos[vi] for vi in tri])
+        after = triNormal(*[p if vi in (a, b) else self.pos[vi] for vi in tri])
+        dot = before[0]*after[0] + before[1]*after[1] + before[2]*after[2]
+        if dot <= 0:
+          return False
+        lengthAfter = math.sqrt(after[0]**2 + after[1]**2 + after[2]**2)
+        lengthBefore = math.sqrt(before[0]**2 + before[1]**2 + before[2]**2)
+        if dot < 0.2 * lengthAfter * lengthBefore:
+          return False
+    return True
+
+  def collapse(self, a, b, p):
+    '''Collapses edge ab, keeping a (or b if b is locked) at p.'''
+    keep, gone = (b, a) if b in self.locked else (a, b)
+    shared = self.vertTris[a] & self.vertTris[b]
+    keepLoop = self.keptLoop(keep, shared)
+    for t in shared:
+      self.live[t] = False
+      self.numLive -= 1
+      for vi in self.tris[t]:
+        self.vertTris[vi].discard(t)
+    for t in self.vertTris[gone]:
+      tri = self.tris[t]
+      k = tri.index(gone)
+      tri[k] = keep
+      self.triLoops[t][k] = keepLoop
+      self.vertTris[keep].add(t)
+    self.vertTris[gone] = set()
+    self.pos[keep] = p
+    self.quadrics[keep] = [x + y for x, y in zip(self.quadrics[a], self.quadrics[b])]
+    self.versions[a] += 1
+    self.versions[b] += 1
+    for n in self.neighbours(keep):
+      self.pushEdge(keep, n)
+
+  def decimate(self, targetTris, maxError=None):
+    '''Collapses edges until at most targetTris triangles are left, no
+    collapse is possible, or the next would have an error over maxError.'''
+    while self.numLive > targetTris and self.heap:
+      entry = heapq.heappop(self.heap)
+      cost, valence, a, b, va, vb, error, p = entry
+      if va != self.versions[a] or vb != self.versions[b]:
+        continue
+      if maxError is not None and error > maxError:
+        heapq.heappush(self.heap, entry)
+        break
+      if not self.canCollapse(a, b, p):
+        continue
+      self.collapse(a, b, p)
+      self.error = max(self.error, error)
+
+  def toSpace(self):
+    '''The decimated space: its remaining triangles, then its portal faces.'''
+    space = self.space
+    mesh = space.mesh
+    remap = {}
+    verts = array(mesh.verts.typecode)
+    loopVerts = array('i')
+    uvLayers = [array(uvs.typecode) for uvs in mesh.uvLayers]
+    loopNormals = array(mesh.loopNormals.typecode)
+    faceKinds = array(space.faceKinds.typecode)
+    faceIds = array('i')
+    loopTotals = array('i')
+
+    def addCorner(vi, li, normal):
+      if vi not in remap:
+        remap[vi] = len(remap)
+        verts.extend(self.pos[vi])
+      loopVerts.append(remap[vi])
+      for uvs, newUVs in zip(mesh.uvLayers, uvLayers):
+        newUVs.extend(uvs[2*li:2*li+2])
+      loopNormals.extend(normal)
+
+    for t, tri in enumerate(self.tris):
+      if not self.live[t]:
+        continue
+      nx, ny, nz = triNormal(*[self.pos[vi] for vi in tri])
+      length = math.sqrt(nx*nx + ny*ny + nz*nz) or 1.0
+      for vi, li in zip(tri, self.triLoops[t]):
+        normal = mesh.loopNormals[3*li:3*li+3] if vi in self.smooth else (nx / length, ny / length, nz / length)
+        addCorner(vi, li, normal)
+      kind, faceId = self.triClasses[t]
+      faceKinds.append(kind)
+      faceIds.append(faceId)
+      loopTotals.append(3)
+    for iFace in self.portalFaces:
+      start, total = mesh.loopStarts[iFace], mesh.loopTotals[iFace]
+      for li in range(start, start + total):
+        addCorner(mesh.loopVerts[li], li, mesh.loopNormals[3*li:3*li+3])
+      faceKinds.append(space.faceKinds[iFace])
+      faceIds.append(space.faceIds[iFace])
+      loopTotals.append(total)
+
+    loopStarts = array('i')
+    start = 0
+    for total in loopTotals:
+      loopStarts.append(start)
+      start += total
+    return Space(space.name, MeshArrays(verts, loopStarts, loopTotals, loopVerts, uvLayers,
+      loopNormals, None), faceKinds, faceIds, space.remotes, space.spawns)
+
+def uvSpan(space):
+  '''The widest any face of space spans in u or v in any UV layer.'''
+  mesh = space.mesh
+  widest = 0.0
+  for uvs in mesh.uvLayers:
+    for start, total in zip(mesh.loopStarts, mesh.loopTotals):
+      us, vs = uvs[2*start:2*(start+total):2], uvs[2*start+1:2*(start+total):2]
+      widest = max(widest, max(us) - min(us), max(vs) - min(vs))
+  return widest
+
+def buildLODs(space, ratios=LEVEL_RATIOS, maxError=None):
+  '''A LODLevel for each of ratios, the fraction of the space's material
+  triangles to keep, coarsest last. Stops at the first level which could
+  not be decimated further than the one before, so there may be fewer
+  levels than ratios.'''
+  if len(ratios) > MAX_LEVELS:
+    raise ValueError('at most %d levels of detail can be stored, not %d' % (MAX_LEVELS, len(ratios)))
+  decimator = Decimator(space)
+  levels = []
+  for level, ratio in enumerate(ratios, 1):
+    numLive = decimator.numLive
+    decimator.decimate(int(decimator.numTris * ratio), maxError)
+    if decimator.numLive == numLive:
+      break
+    levels.append(LODLevel(level, ratio, decimator.error, decimator.toSpace()))
+  return levels
+
+if __name__ == '__main__':
+  from escher_reader import readEsc6
+  if len(sys.argv) not in (2, 3, 4):
+    sys.exit(__doc__.split('Usage: ')[1])
+  with open(sys.argv[1], 'rb') as f:
+    escherMap = readEsc6(f)
+  ratios = levelRatios(int(sys.argv[2])) if len(sys.argv) > 2 else LEVEL_RATIOS
+  coarsest = EscherMap()
+  for material in escherMap.materials:
+    coarsest.addMaterial(material)
+  t0 = time.perf_counter()
+  for iSpace, space in enumerate(escherMap.spaces):
+    levels = buildLODs(space, ratios)
+    print('space %d: uv span %.3g, %s' % (iSpace, uvSpan(space), ', '.join(
+      'level %d %d faces error %.3g uv span %.3g' % (level.level, level.space.numFaces, level.error,
+      uvSpan(level.space)) for level in levels) or 'cannot be decimated'))
+    coarsest.addSpace(levels[-1].space if levels else space)
+  print('%.2fs' % (time.perf_counter() - t0))
+  if len(sys.argv) == 4:
+    with open(sys.argv[3], 'w') as out:
+      writeEsc6(coarsest, out)
@@ -0,0 +1,192 @@
+# Copyright 2014 Don Viszneki
+# In-memory Escher map model and .esc6 writer.
+
+"""
+escherExport builds one EscherMap from the Blender scene and then hands it
+to writeEsc6(). Nothing in here imports bpy, so maps can be built, written
+and benchmarked under plain CPython.
+
+All coordinates in the model are already in Escher's coordinate system,
+i.e. Blender's (x, y, z) has become (-x, z, y).
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from escher_mesh import formatVerts, formatFaces
+
+# Values of Space.faceKinds
+FACE_MAT    = 0
+FACE_REMOTE = 1
+
+faceKindNames = ('mat', 'remote')
+
+class IndexTable:
+  '''An ordered list of unique names with a hashed name -> index lookup.'''
+  __slots__ = ('names', 'indices')
+
+  def __init__(self, names=()):
+    self.names = []
+    self.indices = {}
+    for name in names:
+      self.add(name)
+
+  def add(self, name):
+    if name in self.indices:
+      raise KeyError('Duplicate name "%s"' % name)
+    self.indices[name] = len(self.names)
+    self.names.append(name)
+    return self.indices[name]
+
+  def index(self, name):
+    return self.indices[name]
+
+  def __contains__(self, name):
+    return name in self.indices
+
+  def __getitem__(self, i):
+    return self.names[i]
+
+  def __iter__(self):
+    return iter(self.names)
+
+  def __len__(self):
+    return len(self.names)
+
+class Material:
+  '''textures is a list of (mapType, fileName) pairs.'''
+  __slots__ = ('name', 'textures')
+
+  def __init__(self, name, textures=()):
+    self.name = name
+    self.textures = list(textures)
+
+class Remote:
+  '''space is the index of the remote space, or -1 for none.'''
+  __slots__ = ('space', 'translation', 'orientation')
+
+  def __init__(self, space, translation, orientation):
+    self.space = space
+    self.translation = tuple(translation)
+    self.orientation = tuple(orientation)
+
+class Spawn:
+  '''path is a flat xyz array('d'), or None if the spawner has no path.'''
+  __slots__ = ('type', 'translation', 'orientation', 'path')
+
+  def __init__(self, type, translation, orientation, path=None):
+    self.type = type
+    self.translation = tuple(translation)
+    self.orientation = tuple(orientation)
+    self.path = path
+
+class Space:
+  '''mesh is an escher_mesh.MeshArrays. Each face is either drawn with a
+  material or is a portal to a remote: faceKinds holds FACE_MAT or
+  FACE_REMOTE per face and faceIds the material or remote index.
+  sourceFaces, if not None, holds the index of the face each face was made
+  from, e.g. by escher_triangulate.'''
+  __slots__ = ('name', 'remotes', 'spawns', 'mesh', 'faceKinds', 'faceIds', 'sourceFaces')
+
+  def __init__(self, name, mesh, faceKinds, faceIds, remotes=(), spawns=(), sourceFaces=None):
+    self.name = name
+    self.mesh = mesh
+    self.faceKinds = faceKinds
+    self.faceIds = faceIds
+    self.remotes = list(remotes)
+    self.spawns = list(spawns)
+    self.sourceFaces = sourceFaces
+
+  @property
+  def numVerts(self):
+    return self.mesh.numVerts
+
+  @property
+  def numFaces(self):
+    return self.mesh.numFaces
+
+  def faceClasses(self):
+    '''The "mat N"/"remote N" string of each face.'''
+    return ['%s %d' % (faceKindNames[k], i) for k, i in zip(self.faceKinds, self.faceIds)]
+
+class EscherMap:
+  '''materialNames and spaceNames index materials and spaces by name.'''
+  __slots__ = ('materials', 'spaces', 'materialNames', 'spaceNames')
+
+  def __init__(self):
+    self.materials = []
+    self.spaces = []
+    self.materialNames = IndexTable()
+    self.spaceNames = IndexTable()
+
+  def addMaterial(self, material):
+    self.materialNames.add(material.name)
+    self.materials.append(material)
+    return len(self.materials) - 1
+
+  def addSpace(self, space):
+    '''Spaces read back from .esc6 files have no names; they can be None.'''
+    if space.name is not None:
+      self.spaceNames.add(space.name)
+    self.spaces.append(space)
+    return len(self.spaces) - 1
+
+def vec3toStr(v):
+  return '%s %s %s' % (repr(v[0]), repr(v[1]), repr(v[2]))
+
+def formatSpaceHead(space, iSpace):
+  '''Returns the "space", "remote" and "spawn" commands of a space.'''
+  lines = ['space %d numverts %d numfaces %d numremotes %d numspawns %d\n' %
+    (iSpace, space.numVerts, space.numFaces, len(space.remotes), len(space.spawns))]
+  for iRemote, remote in enumerate(space.remotes):
+    lines.append('remote %d space %d translation %s orientation %s\n' %
+      (iRemote, remote.space, vec3toStr(remote.translation), vec3toStr(remote.orientation)))
+  for iSpawn, spawn in enumerate(space.spawns):
+    pathParam = ''
+    if spawn.path is not None:
+      pathParam = ' path' + ''.join(' ' + repr(c) for c in spawn.path)
+    lines.append('spawn %d translation %s orientation %s params %s%s\n' %
+      (iSpawn, vec3toStr(spawn.translation), vec3toStr(spawn.orientation), spawn.type, pathParam))
+  return ''.join(lines)
+
+def formatSpace(space, iSpace):
+  '''Returns the complete .esc6 block of a space: its "space", "remote",
+  "spawn", "vert" and "face" commands.'''
+  return (formatSpaceHead(space, iSpace) + formatVerts(space.mesh) +
+    formatFaces(space.mesh, space.faceClasses(), space.sourceFaces))
+
+def formatSpaces(escherMap, indices=None, workers=1):
+  '''Returns the .esc6 blocks of the spaces listed in indices (by default
+  all of them), in that order.
+
+  With workers > 1 the spaces are formatted by that many processes; 0 means
+  one per CPU. If a process pool can't be used, the spaces are formatted
+  in this process instead.'''
+  if indices is None:
+    indices = range(len(escherMap.spaces))
+  spaces = [escherMap.spaces[i] for i in indices]
+  if workers == 0:
+    workers = os.cpu_count() or 1
+  workers = min(workers, len(spaces))
+  if workers > 1:
+    try:
+      with ProcessPoolExecutor(workers) as pool:
+        chunksize = max(1, len(spaces) // (4 * workers))
+        return list(pool.map(formatSpace, spaces, indices, chunksize=chunksize))
+    except (OSError, BrokenProcessPool) as e:
+      print('escher export: formatting spaces serially, process pool failed: %s' % e)
+  return list(map(formatSpace, spaces, indices))
+
+def writeEsc6(escherMap, out, spaceBlocks=None):
+  '''Writes escherMap in .esc6 format to the text file object out.
+  spaceBlocks optionally holds each space's already formatted block.'''
+  out.write('escher version 6\n')
+  out.write('nummaterials %d\n' % len(escherMap.materials))
+  for imat, mat in enumerate(escherMap.materials):
+    out.write('material %d "%s" numtex %d\n' % (imat, mat.name, len(mat.textures)))
+    for texMapType, textureFileName in mat.textures:
+      out.write('texture %s %s\n' % (texMapType, textureFileName))
+  out.write('numspaces %d\n' % len(escherMap.spaces))
+  if spaceBlocks is None:
+    spaceBlocks = formatSpaces(escherMap)
+  for block in spaceBlocks:
+    out.write(block)
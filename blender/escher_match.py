@@ -0,0 +1,462 @@
+# Copyright 2014 Don Viszneki
+# Pairs each portal with its counterpart in the space it leads to.
+
+"""
+A portal face of space A leads through remote r to space B, which the
+game draws at r's transform T. For the seam to vanish, B must have a
+portal face Q with T Q on top of the portal face P of A, so the
+counterpart of P is the portal face of B nearest T^-1 P.
+
+matchPortals() hashes the portal vertices of every space into cells as
+wide as the search radius. Each portal face of a remote is moved into
+its target space by the inverse transform, and its corners vote for the
+faces of the portal vertices found within the radius of them; the face
+most of its corners reach is its counterpart. A face whose corners find
+nothing, as when the orientation is well off, is paired with the nearest
+portal face of B leading back to A with as many corners, trying each way
+round its corners.
+
+The residual of a face is the furthest any corner of either face is from
+the nearest corner of the other. For each remote whose faces are further
+than the tolerance from their counterparts, the transform which
+best lays its counterparts on its faces is fitted by least squares,
+using Horn's quaternion method, and given as the translation and Euler
+orientation the .esc6 remote line takes.
+
+Each match also records:
+  the residual of the remote of B the counterparts belong to, if it
+    leads back to A, which should be the inverse of T
+  how far from T^-1 P the game's loader puts a player crossing P: its
+    untransform is only the inverse of T when at most one angle of the
+    orientation is not 0
+
+Usage: python escher_match.py MAP.esc6 [RADIUS [TOLERANCE]]
+Prints every remote whose portals do not match within TOLERANCE.
+"""
+import math
+import sys
+import time
+from escher_lint import Problem, WARNING
+from escher_map import FACE_REMOTE
+from escher_collision import unitNormal
+from escher_portals import IDENTITY, remoteTransform, rigidTransform, transformPoint
+
+DEFAULT_RADIUS = 0.5
+DEFAULT_TOLERANCE = 1e-4
+
+def rigidInverse(m):
+  '''The inverse of a rotation and translation.'''
+  r = [m[4*j+i] for i in range(3) for j in range(3)]
+  t = [-(r[3*i] * m[3] + r[3*i+1] * m[7] + r[3*i+2] * m[11]) for i in range(3)]
+  return (r[0], r[1], r[2], t[0], r[3], r[4], r[5], t[1], r[6], r[7], r[8], t[2], 0.0, 0.0, 0.0, 1.0)
+
+def loaderUntransform(remote):
+  '''The untransform the loader builds for remote, which a player is
+  moved by on crossing its portal: translate() then each rotate(), each
+  multiplying on the left, so Rz(-z) Ry(-y) Rx(-x) times the translation
+  back.'''
+  m = rigidTransform((0.0, 0.0, 0.0), tuple(-a for a in remote.orientation))
+  t = [-(m[4*i] * remote.translation[0] + m[4*i+1] * remote.translation[1] +
+    m[4*i+2] * remote.translation[2]) for i in range(3)]
+  return m[:3] + (t[0],) + m[4:7] + (t[1],) + m[8:11] + (t[2],) + m[12:]
+
+def eulerAngles(m):
+  '''The orientation remoteTransform() turns into the rotation of m,
+  which is Rz(z) Ry(y) Rx(x).'''
+  sy = -m[8]
+  y = math.asin(max(-1.0, min(1.0, sy)))
+  if abs(sy) < 1 - 1e-9:
+    return math.atan2(m[9], m[10]), y, math.atan2(m[4], m[0])
+  # Gimbal lock: only x - z or x + z is known, so z is taken as 0
+  return math.atan2(-m[6], m[5]), y, 0.0
+
+def jacobiEigen(a):
+  '''The eigenvalues and eigenvectors, as columns, of the symmetric n x n
+  matrix a, given as a list of rows.'''
+  n = len(a)
+  a = [list(row) for row in a]
+  v = [[float(i == j) for j in range(n)] for i in range(n)]
+  for sweep in range(50):
+    off = sum(a[i][j] * a[i][j] for i in range(n) for j in range(i + 1, n))
+    if off < 1e-30:
+      break
+    for p in range(n):
+      for q in range(p + 1, n):
+        if abs(a[p][q]) < 1e-300:
+          continue
+        theta = (a[q][q] - a[p][p]) / (2 * a[p][q])
+        t = math.copysign(1.0, theta) / (abs(theta) + math.sqrt(theta * theta + 1))
+        c = 1 / math.sqrt(t * t + 1)
+        s = t * c
+        for k in range(n):
+          akp, akq = a[k][p], a[k][q]
+          a[k][p], a[k][q] = c * akp - s * akq, s * akp + c * akq
+        for k in range(n):
+          apk, aqk = a[p][k], a[q][k]
+          a[p][k], a[q][k] = c * apk - s * aqk, s * apk + c * aqk
+        for k in range(n):
+          vkp, vkq = v[k][p], v[k][q]
+          v[k][p], v[k][q] = c * vkp - s * vkq, s * vkp + c * vkq
+  return [a[i][i] for i in range(n)], v
+
+def fitRigid(pairs):
+  '''The rotation and translation m minimising the sum of |m q - p|^2 over
+  the (q, p) pairs, and the root mean square of |m q - p|.'''
+  n = len(pairs)
+  qc = [sum(q[k] for q, p in pairs) / n for k in range(3)]
+  pc = [sum(p[k] for q, p in pairs) / n for k in range(3)]
+  s = [[0.0] * 3 for i in range(3)]
+  for q, p in pairs:
+    for i in range(3):
+      for j in range(3):
+        s[i][j] += (q[i] - qc[i]) * (p[j] - pc[j])
+  (xx, xy, xz), (yx, yy, yz), (zx, zy, zz) = s
+  values, vectors = jacobiEigen([
+    [xx + yy + zz, yz - zy, zx - xz, xy - yx],
+    [yz - zy, xx - yy - zz, xy + yx, zx + xz],
+    [zx - xz, xy + yx, yy - xx - zz, yz + zy],
+    [xy - yx, zx + xz, yz + zy, zz - xx - yy],
+  ])
+  best = max(range(4), key=lambda i: values[i])
+  w, x, y, z = (vectors[i][best] for i in range(4))
+  r = (w*w + x*x - y*y - z*z, 2 * (x*y - w*z), 2 * (x*z + w*y),
+    2 * (x*y + w*z), w*w - x*x + y*y - z*z, 2 * (y*z - w*x),
+    2 * (x*z - w*y), 2 * (y*z + w*x), w*w - x*x - y*y + z*z)
+  t = [pc[i] - (r[3*i] * qc[0] + r[3*i+1] * qc[1] + r[3*i+2] * qc[2]) for i in range(3)]
+  m = (r[0], r[1], r[2], t[0], r[3], r[4], r[5], t[1], r[6], r[7], r[8], t[2], 0.0, 0.0, 0.0, 1.0)
+  error = sum(distance2(transformPoint(m, q), p) for q, p in pairs)
+  return m, math.sqrt(error / n)
+
+def distance2(a, b):
+  return (a[0] - b[0])**2 + (a[1] - b[1])**2 + (a[2] - b[2])**2
+
+def rotationAngle(a, b):
+  '''The angle of the rotation between the rotations of a and b.'''
+  trace = sum(a[4*k+i] * b[4*k+i] for i in range(3) for k in range(3))
+  return math.acos(max(-1.0, min(1.0, (trace - 1) / 2)))
+
+def nearest(p, points):
+  return min(range(len(points)), key=lambda i: distance2(p, points[i]))
+
+def faceResidual(points, counterpart):
+  '''How far the furthest corner of either face is from the nearest corner
+  of the other.'''
+  d2 = [[distance2(p, q) for q in counterpart] for p in points]
+  return math.sqrt(max(max(min(row) for row in d2), max(min(column) for column in zip(*d2))))
+
+class PortalIndex:
+  '''The portal faces of one space, and their vertices hashed into cells
+  twice radius wide, so that all within radius of a point are in the 8
+  cells nearest it.'''
+  __slots__ = ('space', 'faces', 'points', 'centroids', 'vertexFaces', 'cells', 'radius', 'byCorners')
+
+  def __init__(self, space, radius):
+    mesh = space.mesh
+    verts = mesh.verts
+    self.space = space
+    self.radius = radius
+    self.faces = [iFace for iFace, kind in enumerate(space.faceKinds) if kind == FACE_REMOTE]
+    self.points = {}
+    self.centroids = {}
+    self.vertexFaces = {}
+    self.cells = {}
+    self.byCorners = {}
+    for iFace in self.faces:
+      start = mesh.loopStarts[iFace]
+      corners = mesh.loopVerts[start:start+mesh.loopTotals[iFace]]
+      points = [tuple(verts[3*vi:3*vi+3]) for vi in corners]
+      self.points[iFace] = points
+      self.centroids[iFace] = tuple(sum(p[k] for p in points) / len(points) for k in range(3))
+      for vi, p in zip(corners, points):
+        if vi not in self.vertexFaces:
+          self.vertexFaces[vi] = []
+          self.cells.setdefault(self.cell(p), []).append((vi, p))
+        self.vertexFaces[vi].append(iFace)
+
+  def cell(self, p):
+    w = 2 * self.radius
+    return (int(math.floor(p[0] / w)), int(math.floor(p[1] / w)), int(math.floor(p[2] / w)))
+
+  def near(self, p):
+    '''The (vertex, squared distance) of each portal vertex within the radius
+    of p.'''
+    w = 2 * self.radius
+    # The cell p is in, and on each axis the neighbour on the side of its nearer half
+    span = []
+    for c in p:
+      f = c / w
+      i = int(math.floor(f))
+      span.append((i, i + 1 if f - i >= 0.5 else i - 1))
+    r2 = self.radius * self.radius
+    found = []
+    cells = self.cells
+    for x in span[0]:
+      for y in span[1]:
+        for z in span[2]:
+          for vi, q in cells.get((x, y, z), ()):
+            d2 = distance2(p, q)
+            if d2 <= r2:
+              found.append((vi, d2))
+    return found
+
+  def vote(self, points):
+    '''The face most of points have a vertex of within the radius, the
+    nearer breaking ties, or None.'''
+    votes = {}
+    for p in points:
+      best = {}
+      for vi, d2 in self.near(p):
+        for iFace in self.vertexFaces[vi]:
+          if d2 < best.get(iFace, d2 + 1):
+            best[iFace] = d2
+      for iFace, d2 in best.items():
+        count, total = votes.get(iFace, (0, 0.0))
+        votes[iFace] = (count + 1, total + d2)
+    if not votes:
+      return None
+    return max(votes, key=lambda iFace: (votes[iFace][0], -votes[iFace][1]))
+
+  def withCorners(self, numCorners, iSpace):
+    '''The portal faces with numCorners corners which lead to space
+    iSpace, and all of those with numCorners corners.'''
+    key = numCorners, iSpace
+    if key not in self.byCorners:
+      remotes = self.space.remotes
+      faceIds = self.space.faceIds
+      faces = [iFace for iFace in self.faces if len(self.points[iFace]) == numCorners]
+      back = [iFace for iFace in faces
+        if 0 <= faceIds[iFace] < len(remotes) and remotes[faceIds[iFace]].space == iSpace]
+      self.byCorners[key] = back, faces
+    return self.byCorners[key]
+
+class FaceMatch:
+  '''A portal face, the face of the target space found to be its
+  counterpart or None, and their residual.'''
+  __slots__ = ('face', 'counterpart', 'residual')
+
+  def __init__(self, face, counterpart, residual):
+    self.face = face
+    self.counterpart = counterpart
+    self.residual = residual
+
+class PortalMatch:
+  '''How well the portal faces of one remote match their counterparts.
+  residual is the largest residual of a face, or None if no face has a
+  counterpart. fitted is the best transform (translation, orientation),
+  fittedResidual the root mean square distance of corners under it, if
+  the faces do not match.
+  backRemote is the remote of the target space the counterparts lead
+  through, if it leads back, and backResidual how far its transform puts
+  the corners of the faces from where the inverse puts them. crossingError is how far the
+  loader's untransform puts a corner from where crossing should.'''
+  __slots__ = ('space', 'remote', 'target', 'faces', 'residual', 'fitted', 'fittedResidual',
+    'backRemote', 'backResidual', 'crossingError')
+
+  def __init__(self, space, remote, target):
+    self.space = space
+    self.remote = remote
+    self.target = target
+    self.faces = []
+    self.residual = None
+    self.fitted = None
+    self.fittedResidual = None
+    self.backRemote = None
+    self.backResidual = None
+    self.crossingError = 0.0
+
+  def matches(self, tolerance=DEFAULT_TOLERANCE):
+    return (self.residual is not None and self.residual <= tolerance and
+      all(f.counterpart is not None for f in self.faces) and
+      (self.backResidual is None or self.backResidual <= tolerance) and
+      self.crossingError <= tolerance)
+
+def cornerShape(points):
+  '''The distance of each corner from the centroid and the length of the
+  edge after it, which a rigid transform keeps.'''
+  n = len(points)
+  c = tuple(sum(p[k] for p in points) / n for k in range(3))
+  return [(math.sqrt(distance2(p, c)), math.sqrt(distance2(p, points[(i + 1) % n])))
+    for i, p in enumerate(points)]
+
+def alignCorners(points, counterpart, current, tolerance):
+  '''(q, p) pairs of the corners of counterpart and points, with
+  counterpart taken each way round and from each corner. Of the ways
+  whose corners have the most nearly the same shape, within tolerance,
+  the one whose rigid fit has the rotation nearest that of current.'''
+  n = len(points)
+  shape = cornerShape(points)
+  ways = []
+  for order in (counterpart, counterpart[::-1]):
+    orderShape = cornerShape(order)
+    for shift in range(n):
+      error = max(max(abs(a[0] - b[0]), abs(a[1] - b[1]))
+        for a, b in zip(shape, orderShape[shift:] + orderShape[:shift]))
+      ways.append((error, [(order[(i + shift) % n], points[i]) for i in range(n)]))
+  least = min(error for error, pairs in ways)
+  ways = [pairs for error, pairs in ways if error <= least + tolerance]
+  if len(ways) == 1:
+    return ways[0]
+  return min(ways, key=lambda pairs: rotationAngle(frameRotation(pairs), current))
+
+def frame(points):
+  '''Axes along the first edge of points, across it and along their
+  normal, as the columns of a 3 x 3 matrix, or None if they have no area.'''
+  n = unitNormal(points)
+  u = [points[1][k] - points[0][k] for k in range(3)]
+  length = math.sqrt(u[0]*u[0] + u[1]*u[1] + u[2]*u[2])
+  if n is None or length == 0:
+    return None
+  u = [c / length for c in u]
+  v = (n[1] * u[2] - n[2] * u[1], n[2] * u[0] - n[0] * u[2], n[0] * u[1] - n[1] * u[0])
+  return [u[0], v[0], n[0], u[1], v[1], n[1], u[2], v[2], n[2]]
+
+def frameRotation(pairs):
+  '''The rotation taking the frame of the q of the (q, p) pairs to that of
+  the p, as a 4 x 4 matrix; the identity if either has no area.'''
+  fq = frame([q for q, p in pairs])
+  fp = frame([p for q, p in pairs])
+  if fq is None or fp is None:
+    return IDENTITY
+  r = [sum(fp[3*i+k] * fq[3*j+k] for k in range(3)) for i in range(3) for j in range(3)]
+  return (r[0], r[1], r[2], 0.0, r[3], r[4], r[5], 0.0, r[6], r[7], r[8], 0.0, 0.0, 0.0, 0.0, 1.0)
+
+def matchRemote(escherMap, indices, iSpace, iRemote, faces, tolerance=DEFAULT_TOLERANCE):
+  '''The PortalMatch of the portal faces of one remote of space iSpace.'''
+  remote = escherMap.spaces[iSpace].remotes[iRemote]
+  match = PortalMatch(iSpace, iRemote, remote.space)
+  if not 0 <= remote.space < len(indices):
+    return match
+  source = indices[iSpace]
+  target = indices[remote.space]
+  transform = remoteTransform(remote)
+  inverse = rigidInverse(transform)
+  # With at most one angle the untransform is the inverse
+  untransform = loaderUntransform(remote) if sum(a != 0 for a in remote.orientation) > 1 else None
+  moves = []
+  used = set()
+  for iFace in faces:
+    points = source.points[iFace]
+    moved = [transformPoint(inverse, p) for p in points]
+    if untransform is not None:
+      match.crossingError = max([match.crossingError] +
+        [math.sqrt(distance2(transformPoint(untransform, p), q)) for p, q in zip(points, moved)])
+    counterpart = target.vote(moved)
+    if counterpart is None:
+      counterpart = nearestCounterpart(target, iSpace, moved, used)
+    if counterpart is None:
+      match.faces.append(FaceMatch(iFace, None, None))
+      continue
+    used.add(counterpart)
+    match.faces.append(FaceMatch(iFace, counterpart, faceResidual(moved, target.points[counterpart])))
+    moves.append((match.faces[-1], points, moved))
+  residuals = [f.residual for f in match.faces if f.residual is not None]
+  if residuals:
+    match.residual = max(residuals)
+  if len(residuals) < len(faces) or match.residual > tolerance:
+    pairs = []
+    for f, points, moved in moves:
+      qs = target.points[f.counterpart]
+      if f.residual <= target.radius:
+        pairs.extend((qs[nearest(q, qs)], p) for q, p in zip(moved, points))
+      elif len(qs) == len(points):
+        pairs.extend(alignCorners(points, qs, transform, tolerance))
+    if len(pairs) >= 3:
+      fitted, match.fittedResidual = fitRigid(pairs)
+      match.fitted = (fitted[3], fitted[7], fitted[11]), eulerAngles(fitted)
+  backIds = set(target.space.faceIds[f.counterpart] for f in match.faces if f.counterpart is not None)
+  if len(backIds) == 1:
+    backId = backIds.pop()
+    remotes = target.space.remotes
+    if 0 <= backId < len(remotes) and remotes[backId].space == iSpace:
+      match.backRemote = backId
+      back = remoteTransform(remotes[backId])
+      match.backResidual = math.sqrt(max(distance2(transformPoint(back, p), q)
+        for f, points, moved in moves for p, q in zip(points, moved)))
+  return match
+
+def nearestCounterpart(target, iSpace, moved, used):
+  '''The unused portal face of target with as many corners as moved, and
+  leading back to iSpace if any does, whose centroid is nearest that of
+  moved.'''
+  back, faces = target.withCorners(len(moved), iSpace)
+  candidates = [iFace for iFace in back if iFace not in used]
+  if not candidates:
+    candidates = [iFace for iFace in faces if iFace not in used]
+  if not candidates:
+    return None
+  c = tuple(sum(p[k] for p in moved) / len(moved) for k in range(3))
+  return min(candidates, key=lambda iFace: distance2(c, target.centroids[iFace]))
+
+def matchPortals(escherMap, radius=DEFAULT_RADIUS, tolerance=DEFAULT_TOLERANCE):
+  '''The PortalMatch of every remote with portal faces, space by space.
+  Corners are searched for within radius of where they should be.'''
+  indices = [PortalIndex(space, radius) for space in escherMap.spaces]
+  matches = []
+  for iSpace, space in enumerate(escherMap.spaces):
+    byRemote = {}
+    for iFace in indices[iSpace].faces:
+      byRemote.setdefault(space.faceIds[iFace], []).append(iFace)
+    for iRemote in sorted(byRemote):
+      if 0 <= iRemote < len(space.remotes):
+        matches.append(matchRemote(escherMap, indices, iSpace, iRemote, byRemote[iRemote],
+          tolerance))
+  return matches
+
+def formatMatch(match):
+  '''Lines describing match.'''
+  lines = ['space %d remote %d to space %d: %d portal faces, residual %s' % (match.space,
+    match.remote, match.target, len(match.faces),
+    'none paired' if match.residual is None else '%.6g' % match.residual)]
+  for f in match.faces:
+    if f.counterpart is None:
+      lines.append('  face %d: no counterpart' % f.face)
+    else:
+      lines.append('  face %d: face %d, residual %.6g' % (f.face, f.counterpart, f.residual))
+  if match.fitted is not None:
+    lines.append('  best fit: translation %.6f %.6f %.6f orientation %.6f %.6f %.6f, residual %.6g' %
+      (match.fitted[0] + match.fitted[1] + (match.fittedResidual,)))
+  if match.backRemote is not None:
+    lines.append('  back through remote %d, residual %.6g' % (match.backRemote, match.backResidual))
+  if match.crossingError:
+    lines.append("  crossing error of the loader's untransform %.6g" % match.crossingError)
+  return lines
+
+def matchProblems(matches, tolerance=DEFAULT_TOLERANCE):
+  '''escher_lint warnings for the matches which do not match within
+  tolerance.'''
+  problems = []
+  for match in matches:
+    # Remotes to spaces the map does not have are escher_lint's to report
+    if match.matches(tolerance) or not match.faces:
+      continue
+    if match.residual is None:
+      message = 'portal faces have no counterpart in space %d' % match.target
+    elif match.residual > tolerance or any(f.counterpart is None for f in match.faces):
+      message = 'portal faces are %.6g from their counterparts in space %d' % (match.residual, match.target)
+      if match.fitted is not None:
+        message += '; best fit translation %.6f %.6f %.6f orientation %.6f %.6f %.6f' % (
+          match.fitted[0] + match.fitted[1])
+    elif match.backResidual is not None and match.backResidual > tolerance:
+      message = 'remote %d of space %d back is %.6g from the inverse' % (match.backRemote,
+        match.target, match.backResidual)
+    else:
+      message = "the game's untransform moves players crossing %.6g off" % match.crossingError
+    problems.append(Problem(WARNING, match.space, None, match.remote, message))
+  return problems
+
+if __name__ == '__main__':
+  from escher_reader import readEsc6
+  if not 2 <= len(sys.argv) <= 4:
+    sys.exit(__doc__.split('Usage: ')[1])
+  with open(sys.argv[1], 'rb') as f:
+    escherMap = readEsc6(f)
+  radius = float(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_RADIUS
+  tolerance = float(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_TOLERANCE
+  t0 = time.perf_counter()
+  matches = matchPortals(escherMap, radius, tolerance)
+  seconds = time.perf_counter() - t0
+  mismatched = [match for match in matches if not match.matches(tolerance)]
+  for match in mismatched:
+    print('\n'.join(formatMatch(match)))
+  print('%d of %d remotes match, %d portal faces (%.3fs)' % (len(matches) - len(mismatched),
+    len(matches), sum(len(match.faces) for match in matches), seconds))
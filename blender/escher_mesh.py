@@ -0,0 +1,127 @@
+# Copyright 2014 Don Viszneki
+# Bulk mesh extraction for the Escher map exporter.
+
+"""
+Pulls everything escherExport needs out of a mesh with one foreach_get()
+per attribute instead of one Python attribute lookup per vertex and loop,
+and formats whole "vert" and "face" blocks at once.
+
+This module does not import bpy. Anything with Blender's mesh layout works:
+vertices, loops, polygons and uv_layers[n].data collections which support
+len() and foreach_get(attr, seq), so plain Python stand-ins can be used to
+run it outside of Blender.
+"""
+from array import array
+from itertools import chain
+from operator import neg
+
+def foreachGet(collection, attr, typecode, width=1):
+  '''Read attr of every item in collection into a flat array.'''
+  buf = array(typecode, bytes(array(typecode).itemsize * len(collection) * width))
+  collection.foreach_get(attr, buf)
+  return buf
+
+def swizzle(co):
+  '''Blender (x, y, z) -> Escher (-x, z, y), for flat xyz arrays.'''
+  out = array(co.typecode, bytes(co.itemsize * len(co)))
+  out[0::3] = array(co.typecode, map(neg, co[0::3]))
+  out[1::3] = co[2::3]
+  out[2::3] = co[1::3]
+  return out
+
+class MeshArrays:
+  '''Flat copies of a mesh's geometry, already in Escher's coordinate system.
+
+  verts           xyz per vertex
+  loopStarts      first loop of each face
+  loopTotals      number of loops (corners) of each face
+  loopVerts       vertex index of each loop
+  uvLayers        one array of negated uv pairs per loop, per UV layer
+  loopNormals     xyz per loop: vertex normal if the face is smooth,
+                  otherwise face normal
+  materialIndices material slot index of each face, or None if the mesh
+                  did not come from Blender'''
+
+  __slots__ = ('verts', 'loopStarts', 'loopTotals', 'loopVerts', 'uvLayers',
+      'loopNormals', 'materialIndices')
+
+  def __init__(self, verts, loopStarts, loopTotals, loopVerts, uvLayers,
+      loopNormals, materialIndices):
+    self.verts = verts
+    self.loopStarts = loopStarts
+    self.loopTotals = loopTotals
+    self.loopVerts = loopVerts
+    self.uvLayers = uvLayers
+    self.loopNormals = loopNormals
+    self.materialIndices = materialIndices
+
+  @property
+  def numVerts(self):
+    return len(self.verts) // 3
+
+  @property
+  def numFaces(self):
+    return len(self.loopTotals)
+
+def extractMesh(me):
+  '''Bulk-copy a mesh into a MeshArrays.'''
+  verts = swizzle(foreachGet(me.vertices, 'co', 'f', 3))
+  loopStarts = foreachGet(me.polygons, 'loop_start', 'i')
+  loopTotals = foreachGet(me.polygons, 'loop_total', 'i')
+  materialIndices = foreachGet(me.polygons, 'material_index', 'i')
+  loopVerts = foreachGet(me.loops, 'vertex_index', 'i')
+
+  uvLayers = []
+  for uvlayer in me.uv_layers:
+    uvs = foreachGet(uvlayer.data, 'uv', 'f', 2)
+    uvLayers.append(array('f', map(neg, uvs)))
+
+  # Smooth faces take their normals from the vertices, flat faces from the face
+  vertNormals = swizzle(foreachGet(me.vertices, 'normal', 'f', 3))
+  faceNormals = swizzle(foreachGet(me.polygons, 'normal', 'f', 3))
+  smooth = foreachGet(me.polygons, 'use_smooth', 'b')
+  loopNormals = array('f', bytes(4 * 3 * len(loopVerts)))
+  for ipg, (start, total) in enumerate(zip(loopStarts, loopTotals)):
+    if smooth[ipg]:
+      for li in range(start, start + total):
+        vi = loopVerts[li] * 3
+        loopNormals[li*3:li*3+3] = vertNormals[vi:vi+3]
+    else:
+      n = faceNormals[ipg*3:ipg*3+3]
+      for li in range(start, start + total):
+        loopNormals[li*3:li*3+3] = n
+
+  return MeshArrays(verts, loopStarts, loopTotals, loopVerts, uvLayers,
+      loopNormals, materialIndices)
+
+def formatVerts(mesh):
+  '''Returns the "vert" block of a space.'''
+  verts = mesh.verts
+  return ''.join(map('vert %d %f %f %f\n'.__mod__,
+    zip(range(mesh.numVerts), verts[0::3], verts[1::3], verts[2::3])))
+
+def formatFaces(mesh, faceClasses, sourceFaces=None):
+  '''Returns the "face" block of a space. faceClasses holds the class string
+  ("mat N" or "remote N") of each face. If sourceFaces is given, each face
+  ends with "source N", N being the face it was made from.'''
+  normals = mesh.loopNormals
+  uvCols = []
+  for uvs in mesh.uvLayers:
+    uvCols += [uvs[0::2], uvs[1::2]]
+  corners = list(zip(mesh.loopVerts, *uvCols,
+      normals[0::3], normals[1::3], normals[2::3]))
+  cornerFmt = ' %d' + ' %f %f' * len(mesh.uvLayers) + ' %f %f %f'
+  endFmt = '\n' if sourceFaces is None else ' source %d\n'
+
+  formats = {}
+  lines = []
+  for ipg, (start, total, faceClass) in enumerate(
+      zip(mesh.loopStarts, mesh.loopTotals, faceClasses)):
+    fmt = formats.get(total)
+    if fmt is None:
+      fmt = formats[total] = 'face %d %s vdata %d' + cornerFmt * total + endFmt
+    args = (ipg, faceClass, total) + tuple(chain.from_iterable(corners[start:start+total]))
+    if sourceFaces is not None:
+      args += (sourceFaces[ipg],)
+    lines.append(fmt % args)
+  return ''.join(lines)
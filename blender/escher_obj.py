@@ -0,0 +1,408 @@
+# Copyright 2014 Don Viszneki
+# Converts Wavefront OBJ scenes to .esc6 maps without Blender.
+
+"""
+Builds the same EscherMap as export-escher.py from an OBJ file, its MTL
+files and a JSON sidecar, and writes it with the same writer, so maps
+can be made on machines without Blender.
+
+The OBJ is read as Blender would see it after importing it:
+
+  objects     each "o" line starts an object ("g" lines do, in files
+              without any "o"); objects named EscherPSO_NAME become
+              space NAME, with any "_MESHNAME" Blender's OBJ exporter
+              added after an EscherSM_ name dropped. Other objects are
+              skipped. Spaces are ordered by name, as in bpy.data.
+  vertices    a space's vertices are the "v" lines in its object, in
+              order, then any vertex of another object its faces use
+  materials   "usemtl EscherPortalMaterialNNN" faces are portals to
+              remote NNN, other faces use the material of that name.
+              Every material of the MTL files, and any only named by
+              "usemtl", is in the map, ordered by name. map_Kd images
+              are COLOR textures, map_Bump and bump NORMAL, others NONE.
+  UVs         one layer in every space if the file has any "vt"; corners
+              without one take the first "vt", as in Blender
+  normals     "vn" normals where a face has them, else the face normal
+  axes        up is the OBJ's Y axis, as Blender's OBJ exporter writes by
+              default; up='Z' reads Blender's own axes
+
+The sidecar, IN.escher.json for IN.obj, holds what an OBJ cannot: the
+remotes and spawns of each space, in Blender's coordinates, as the
+remote and spawn empties and path meshes would have them.
+
+  {"spaces": {"Hall": {
+     "remotes": [{"space": "Stairs", "location": [0, 4, 0], "rotation": [0, 0, 1.5708]}],
+     "spawns": [{"type": "player", "location": [0, 0, 1], "rotation": [0, 0, 0],
+                 "path": [[0, 0, 1], [0, 4, 1]]}]}},
+   "ignored_materials": ["Scratch"]}
+
+Remotes are numbered in the order they are listed; "space" is "*none*"
+for a remote to no space. ignored_materials are left out of the map, as
+materials with ESCHERIGNORE set are.
+
+Given a scene equal to the one Blender would import, with coordinates,
+UVs and normals written to six decimals or more, the .esc6 matches the
+exporter's byte for byte: values pass through single precision as they
+do in Blender. The OBJ is read a line at a time into flat arrays of
+indices, and each space's mesh is built once the whole file has named
+every material and space. Several files are converted in parallel by
+worker processes.
+
+Usage: python escher_obj.py [--workers N] [--up Y|Z] [--no-lint] IN.obj [IN.obj ...]
+Writes IN.esc6 beside each IN.obj.
+"""
+import argparse
+import json
+import os
+import sys
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from os.path import basename, dirname, exists, join, splitext
+from escher_lint import errors, formatProblem, lintMap
+from escher_map import EscherMap, IndexTable, Material, Remote, Spawn, Space, \
+    FACE_MAT, FACE_REMOTE, writeEsc6
+from escher_mesh import MeshArrays
+from escher_registry import PSO_PREFIX
+from escher_triangulate import newellNormal
+
+PORTAL_MATERIAL_PREFIX = 'EscherPortalMaterial'
+
+# MTL image statements and the texture map types Blender's importer gives them
+textureMapTypes = {'map_Kd': 'COLOR', 'map_Bump': 'NORMAL', 'map_bump': 'NORMAL', 'bump': 'NORMAL',
+  'map_Ka': 'NONE', 'map_Ks': 'NONE', 'map_Ns': 'NONE', 'map_d': 'NONE', 'disp': 'NONE',
+  'refl': 'NONE'}
+
+class ObjError(Exception):
+  def __init__(self, lineNumber, message):
+    Exception.__init__(self, 'line %d: %s' % (lineNumber, message))
+
+def single(values):
+  '''values rounded to single precision, as Blender stores them.'''
+  return tuple(array('f', values))
+
+def blenderName(name):
+  '''Blender orders the datablocks of bpy.data by name, ignoring case.'''
+  return name.lower()
+
+def portalRemoteIndex(matName):
+  s = matName[len(PORTAL_MATERIAL_PREFIX):]
+  return int(s) if len(s) else 0
+
+def psoSpaceName(obName):
+  '''The space an OBJ object makes, or None if it is not a PSO.'''
+  if not obName.startswith(PSO_PREFIX):
+    return None
+  name = obName[len(PSO_PREFIX):]
+  mesh = name.find('_EscherSM_')
+  return name if mesh < 0 else name[:mesh]
+
+def readMtl(filename, materials):
+  '''Adds the textures of each material of an MTL file to materials, a
+  dict of material name to list of (map type, file name).'''
+  textures = None
+  with open(filename, encoding='utf-8', errors='replace') as f:
+    for line in f:
+      words = line.split()
+      if not words:
+        continue
+      if words[0] == 'newmtl':
+        textures = materials.setdefault(line.split(None, 1)[1].strip(), [])
+      elif words[0] in textureMapTypes and textures is not None and len(words) > 1:
+        textures.append((textureMapTypes[words[0]], basename(words[-1].replace('\\', '/'))))
+
+class ObjSpace:
+  '''The faces of one PSO as they are read. Each corner refers to the
+  whole file's v, vt and vn lines, by index from 0, with -1 for none.'''
+
+  def __init__(self, name, firstVert):
+    self.name = name
+    self.firstVert = firstVert
+    self.endVert = firstVert
+    self.cornerVerts = array('i')
+    self.cornerUVs = array('i')
+    self.cornerNormals = array('i')
+    self.faceTotals = array('i')
+    self.faceMaterials = array('i')
+
+  def build(self, reader):
+    '''The escher_map.Space, without remotes or spawns.'''
+    co, uv, nrm = reader.co, reader.uv, reader.nrm
+    up = reader.up
+    local = {}
+    for vi in range(self.firstVert, self.endVert):
+      local[vi] = len(local)
+    for vi in self.cornerVerts:
+      if vi not in local:
+        local[vi] = len(local)
+
+    verts = array('f', bytes(12 * len(local)))
+    for vi, li in local.items():
+      verts[3*li:3*li+3] = array('f', toEscher(co[3*vi:3*vi+3], up))
+
+    loopVerts = array('i', [local[vi] for vi in self.cornerVerts])
+    loopStarts = array('i')
+    start = 0
+    for total in self.faceTotals:
+      loopStarts.append(start)
+      start += total
+
+    # As Blender's OBJ importer does, every object of a file with any "vt"
+    # has a UV layer, and corners without one take the file's first
+    uvLayers = []
+    if len(uv) > 0:
+      uvs = array('f')
+      for ti in self.cornerUVs:
+        ti = max(ti, 0)
+        uvs.extend((-uv[2*ti], -uv[2*ti+1]))
+      uvLayers.append(uvs)
+
+    loopNormals = array('f')
+    for start, total in zip(loopStarts, self.faceTotals):
+      faceNormal = None
+      for li in range(start, start + total):
+        ni = self.cornerNormals[li]
+        if ni >= 0:
+          loopNormals.extend(toEscher(nrm[3*ni:3*ni+3], up))
+        else:
+          if faceNormal is None:
+            faceNormal = unitNormal([verts[3*vi:3*vi+3] for vi in loopVerts[start:start+total]])
+          loopNormals.extend(faceNormal)
+
+    faceKinds = array('b')
+    faceIds = array('i')
+    for iMaterial in self.faceMaterials:
+      matName = reader.usedMaterials[iMaterial]
+      if matName.startswith(PORTAL_MATERIAL_PREFIX):
+        faceKinds.append(FACE_REMOTE)
+        faceIds.append(portalRemoteIndex(matName))
+      else:
+        faceKinds.append(FACE_MAT)
+        faceIds.append(reader.materialNames.index(matName))
+    mesh = MeshArrays(verts, loopStarts, self.faceTotals, loopVerts, uvLayers, loopNormals, None)
+    return Space(self.name, mesh, faceKinds, faceIds)
+
+def toEscher(v, up):
+  '''OBJ xyz to Escher's axes, through Blender's.'''
+  x, y, z = single(v)
+  if up == 'Y':
+    x, y, z = x, -z, y
+  return -x, z, y
+
+def unitNormal(points):
+  nx, ny, nz = newellNormal(points)
+  length = (nx*nx + ny*ny + nz*nz) ** 0.5
+  if length == 0:
+    return 0.0, 0.0, 0.0
+  return nx / length, ny / length, nz / length
+
+class ObjReader:
+  '''Reads one OBJ file into the spaces and materials of a map.'''
+
+  def __init__(self, filename, up='Y'):
+    if up not in ('Y', 'Z'):
+      raise ValueError('up must be Y or Z, not %r' % up)
+    self.filename = filename
+    self.up = up
+    self.co = array('d')
+    self.uv = array('d')
+    self.nrm = array('d')
+    self.materials = {}
+    self.usedMaterials = IndexTable()
+    self.materialNames = None
+
+  def read(self):
+    '''Reads the file, returning the ObjSpace of each PSO in file order.'''
+    objSpaces = []
+    current = None
+    usesO = False
+    material = None
+    numV = 0
+    for lineNumber, line in enumerate(open(self.filename, encoding='utf-8', errors='replace'), 1):
+      words = line.split()
+      if not words or words[0].startswith('#'):
+        continue
+      op = words[0]
+      try:
+        if op == 'v':
+          self.co.extend(map(float, words[1:4]))
+          numV += 1
+          if current is not None and current.endVert == numV - 1:
+            current.endVert = numV
+        elif op == 'vt':
+          self.uv.extend(map(float, (words[1:3] + ['0'])[:2]))
+        elif op == 'vn':
+          self.nrm.extend(map(float, words[1:4]))
+        elif op == 'f':
+          if current is None:
+            continue
+          if material is None:
+            raise ValueError('face has no material')
+          for word in words[1:]:
+            vi, ti, ni = self.corner(word, numV)
+            current.cornerVerts.append(vi)
+            current.cornerUVs.append(ti)
+            current.cornerNormals.append(ni)
+          current.faceTotals.append(len(words) - 1)
+          current.faceMaterials.append(material)
+        elif op == 'usemtl':
+          name = line.split(None, 1)[1].strip()
+          self.materials.setdefault(name, [])
+          if name not in self.usedMaterials:
+            self.usedMaterials.add(name)
+          material = self.usedMaterials.index(name)
+        elif op == 'mtllib':
+          for name in line.split(None, 1)[1].split():
+            path = join(dirname(self.filename), name)
+            if exists(path):
+              readMtl(path, self.materials)
+        elif op == 'o' or op == 'g' and not usesO:
+          usesO = usesO or op == 'o'
+          name = line.split(None, 1)[1].strip() if len(words) > 1 else ''
+          spaceName = psoSpaceName(name)
+          current = None if spaceName is None else ObjSpace(spaceName, numV)
+          if current is not None:
+            objSpaces.append(current)
+      except (ValueError, IndexError) as e:
+        raise ObjError(lineNumber, e)
+    return objSpaces
+
+  def corner(self, word, numV):
+    '''The (v, vt, vn) indices of a face corner such as "1/2/3" or "-1//2".'''
+    fields = word.split('/')
+    vi = self.index(fields[0], numV)
+    ti = self.index(fields[1], len(self.uv) // 2) if len(fields) > 1 and fields[1] else -1
+    ni = self.index(fields[2], len(self.nrm) // 3) if len(fields) > 2 and fields[2] else -1
+    return vi, ti, ni
+
+  @staticmethod
+  def index(field, count):
+    i = int(field)
+    i = i - 1 if i > 0 else count + i
+    if not 0 <= i < count:
+      raise ValueError('index %s out of range' % field)
+    return i
+
+def loadSidecar(filename):
+  if filename is None or not exists(filename):
+    return {}
+  with open(filename) as f:
+    return json.load(f)
+
+def escherVec3(v):
+  x, y, z = single(v)
+  return (-x, z, y)
+
+def escherEuler(v):
+  x, y, z = single(v)
+  return (x, z, y)
+
+def buildRemotesAndSpawns(spaceName, sidecar, spaceNames):
+  '''The remotes and spawns of a space from its sidecar entry, as
+  evaluateChildren() in export-escher.py reads them from the empties.'''
+  entry = sidecar.get('spaces', {}).get(spaceName, {})
+  remotes = []
+  for remote in entry.get('remotes', ()):
+    remoteSpaceName = remote['space']
+    if remoteSpaceName == '*none*':
+      remoteIndex = -1
+    elif remoteSpaceName in spaceNames:
+      remoteIndex = spaceNames.index(remoteSpaceName)
+    else:
+      raise ValueError('space "%s" has a remote to space "%s", which does not exist' %
+        (spaceName, remoteSpaceName))
+    remotes.append(Remote(remoteIndex, escherVec3(remote.get('location', (0, 0, 0))),
+      escherEuler(remote.get('rotation', (0, 0, 0)))))
+  spawns = []
+  for spawn in entry.get('spawns', ()):
+    path = None
+    if spawn.get('path') is not None:
+      path = array('d')
+      for co in spawn['path']:
+        path.extend(escherVec3(co))
+    spawns.append(Spawn(spawn['type'], escherVec3(spawn.get('location', (0, 0, 0))),
+      escherEuler(spawn.get('rotation', (0, 0, 0))), path))
+  return remotes, spawns
+
+def readObjMap(filename, sidecarFilename=None, up='Y'):
+  '''The EscherMap export-escher.py would build from the scene in an OBJ
+  file; sidecarFilename defaults to the one beside it.'''
+  if sidecarFilename is None:
+    sidecarFilename = splitext(filename)[0] + '.escher.json'
+  sidecar = loadSidecar(sidecarFilename)
+  reader = ObjReader(filename, up)
+  objSpaces = reader.read()
+  ignored = set(sidecar.get('ignored_materials', ()))
+
+  escherMap = EscherMap()
+  for name in sorted(reader.materials, key=blenderName):
+    if not name.startswith(PORTAL_MATERIAL_PREFIX) and name not in ignored:
+      escherMap.addMaterial(Material(name, reader.materials[name]))
+  reader.materialNames = escherMap.materialNames
+
+  objSpaces.sort(key=lambda objSpace: blenderName(PSO_PREFIX + objSpace.name))
+  spaceNames = IndexTable(objSpace.name for objSpace in objSpaces)
+  for objSpace in objSpaces:
+    space = objSpace.build(reader)
+    space.remotes, space.spawns = buildRemotesAndSpawns(objSpace.name, sidecar, spaceNames)
+    escherMap.addSpace(space)
+  return escherMap
+
+def convertObj(filename, outFilename=None, up='Y', lint=True):
+  '''Converts one OBJ file to .esc6, returning the lines to report. As
+  with the exporter, a map the check finds errors in is not written.'''
+  if outFilename is None:
+    outFilename = splitext(filename)[0] + '.esc6'
+  escherMap = readObjMap(filename, up=up)
+  report = []
+  if lint:
+    problems = lintMap(escherMap)
+    report += ['%s: %s' % (filename, formatProblem(p, escherMap.spaceNames)) for p in problems]
+    if errors(problems):
+      report.append('%s: not written, %d errors' % (filename, len(errors(problems))))
+      return False, report
+  with open(outFilename, 'w') as out:
+    writeEsc6(escherMap, out)
+  report.append('%s: %d spaces, %d materials -> %s' % (filename, len(escherMap.spaces),
+    len(escherMap.materials), outFilename))
+  return True, report
+
+def convertJob(args):
+  filename, up, lint = args
+  try:
+    return convertObj(filename, up=up, lint=lint)
+  except (ObjError, ValueError, KeyError, OSError) as e:
+    return False, ['%s: %s' % (filename, e)]
+
+def convertObjs(filenames, workers=1, up='Y', lint=True):
+  '''Converts each OBJ file with workers processes (0 for one per CPU),
+  or serially if a process pool can't be used. Returns the (converted,
+  report lines) of each file.'''
+  jobs = [(filename, up, lint) for filename in filenames]
+  if workers == 0:
+    workers = os.cpu_count() or 1
+  workers = min(workers, len(jobs))
+  if workers > 1:
+    try:
+      with ProcessPoolExecutor(workers) as pool:
+        return list(pool.map(convertJob, jobs))
+    except (OSError, BrokenProcessPool) as e:
+      print('escher obj: converting serially, process pool failed: %s' % e)
+  return list(map(convertJob, jobs))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Converts OBJ scenes to .esc6 maps.')
+  parser.add_argument('objs', nargs='+', metavar='IN.obj')
+  parser.add_argument('--workers', type=int, default=0,
+    help='processes converting files; 0 uses one per CPU')
+  parser.add_argument('--up', choices=('Y', 'Z'), default='Y',
+    help="the OBJ's up axis: Y as Blender's OBJ exporter writes by default, Z for Blender's own")
+  parser.add_argument('--no-lint', dest='lint', action='store_false',
+    help='write maps even if escher_lint finds errors in them')
+  args = parser.parse_args()
+  failed = False
+  for converted, report in convertObjs(args.objs, args.workers, args.up, args.lint):
+    for line in report:
+      print(line)
+    failed = failed or not converted
+  sys.exit(1 if failed else 0)
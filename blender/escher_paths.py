@@ -0,0 +1,260 @@
+# Copyright 2014 Don Viszneki
+# Spawner paths resampled at uniform arc length, with length tables.
+
+"""
+The game builds the vec3[] path of EntitySpikey, EntityDragonfly and
+EntityBendingBar from the vertices of a spawner's path polygon, and an
+entity walking it has to find which segment it is on. shapePath() can
+smooth a path with a Catmull-Rom spline and resample it at a uniform arc
+length spacing; a closed path gets its first point again at its end, so
+the game's walk goes all the way round.
+
+A PathTable holds a path's points and the cumulative length at each
+point. With uniform spacing, the segment at a distance is found in O(1)
+from the spacing, correcting for the chords being a little shorter than
+the arcs they were sampled on; otherwise it is a binary search.
+
+The tables of a space's spawner paths are stored in .escb and .escz as
+these optional sections:
+
+  PTIX  per path: spawn index, first entry in PTLN, number of points,
+        closed (u32 x 4)
+  PTST  per path: mean segment length if it was resampled uniformly, else
+        0, and total length (f64 x 2)
+  PTLN  cumulative length at each point of each path (f64)
+
+The points themselves are the path of the spawn.
+
+Usage: python escher_paths.py MAP.esc6 [SPACING [smooth] [closed]]
+Shapes every spawner path of a map and times lookups in its table.
+"""
+import bisect
+import math
+import random
+import sys
+import time
+from array import array
+from escher_binary import leBytes, unpackSpawns
+
+CATMULL_ROM_SUBDIVISIONS = 8
+
+def pathPoints(path):
+  '''A flat xyz array as a list of points.'''
+  return [tuple(path[i:i+3]) for i in range(0, len(path), 3)]
+
+def distance(a, b):
+  return math.sqrt((b[0] - a[0])**2 + (b[1] - a[1])**2 + (b[2] - a[2])**2)
+
+def isClosed(points):
+  return len(points) > 2 and points[0] == points[-1]
+
+def cumulativeLengths(points):
+  lengths = array('d', [0.0])
+  for a, b in zip(points, points[1:]):
+    lengths.append(lengths[-1] + distance(a, b))
+  return lengths
+
+def catmullRom(points, closed=False, subdivisions=CATMULL_ROM_SUBDIVISIONS):
+  '''The uniform Catmull-Rom spline through points, as a polyline of
+  subdivisions segments per segment of points. A closed spline ends at
+  its first point.'''
+  n = len(points)
+  if n < 3:
+    return list(points)
+  if closed:
+    at = lambda i: points[i % n]
+    numSegments = n
+  else:
+    at = lambda i: points[max(0, min(i, n - 1))]
+    numSegments = n - 1
+  out = []
+  for i in range(numSegments):
+    p0, p1, p2, p3 = at(i - 1), at(i), at(i + 1), at(i + 2)
+    for s in range(subdivisions):
+      t = s / subdivisions
+      t2 = t * t
+      t3 = t2 * t
+      out.append(tuple(0.5 * (2 * p1[k] + (p2[k] - p0[k]) * t +
+        (2 * p0[k] - 5 * p1[k] + 4 * p2[k] - p3[k]) * t2 +
+        (3 * p1[k] - p0[k] - 3 * p2[k] + p3[k]) * t3) for k in range(3)))
+  out.append(points[0] if closed else points[-1])
+  return out
+
+def resample(points, spacing):
+  '''Points spaced evenly along the polyline points, about spacing apart:
+  the length of the polyline divided into a whole number of steps. The
+  ends are kept.'''
+  lengths = cumulativeLengths(points)
+  total = lengths[-1]
+  if total == 0 or len(points) < 2:
+    return list(points)
+  numSteps = max(1, int(round(total / spacing)))
+  step = total / numSteps
+  out = [points[0]]
+  segment = 0
+  for i in range(1, numSteps):
+    d = i * step
+    while lengths[segment + 1] < d:
+      segment += 1
+    a, b = points[segment], points[segment + 1]
+    length = lengths[segment + 1] - lengths[segment]
+    t = (d - lengths[segment]) / length if length else 0.0
+    out.append(tuple(a[k] + (b[k] - a[k]) * t for k in range(3)))
+  out.append(points[-1])
+  return out
+
+def shapePath(path, spacing=0.0, smooth=False, closed=False):
+  '''A spawner's flat xyz path, smoothed if smooth is set, closed back
+  to its first point if closed is set, and resampled if spacing is above
+  0.'''
+  points = pathPoints(path)
+  if closed and len(points) > 2 and not isClosed(points):
+    points.append(points[0])
+  if smooth:
+    loop = isClosed(points)
+    points = catmullRom(points[:-1] if loop else points, loop)
+  if spacing > 0:
+    points = resample(points, spacing)
+  return array('d', [c for p in points for c in p])
+
+class PathTable:
+  '''A path's points, a flat xyz sequence, with the cumulative length at
+  each; step is the mean segment length of a uniformly resampled path,
+  or 0.'''
+  __slots__ = ('points', 'lengths', 'step', 'closed')
+
+  def __init__(self, points, lengths, step=0.0, closed=False):
+    self.points = points
+    self.lengths = lengths
+    self.step = step
+    self.closed = closed
+
+  @classmethod
+  def fromPath(cls, path, uniform=False):
+    points = pathPoints(path)
+    lengths = cumulativeLengths(points)
+    step = lengths[-1] / (len(lengths) - 1) if uniform and len(lengths) > 1 else 0.0
+    return cls(path, lengths, step, isClosed(points))
+
+  @property
+  def length(self):
+    return self.lengths[-1] if len(self.lengths) else 0.0
+
+  def segmentAt(self, d):
+    '''The index of the segment d along the path lies on.'''
+    lengths = self.lengths
+    last = len(lengths) - 2
+    if self.step > 0:
+      i = min(int(d / self.step), last)
+      while i > 0 and lengths[i] > d:
+        i -= 1
+      while i < last and lengths[i + 1] <= d:
+        i += 1
+      return i
+    return max(0, min(bisect.bisect_right(lengths, d) - 1, last))
+
+  def positionAt(self, d):
+    '''The point d along the path, wrapping round a closed path and
+    clamped to the ends of an open one.'''
+    lengths = self.lengths
+    if len(lengths) < 2:
+      return tuple(self.points[0:3])
+    total = lengths[-1]
+    if self.closed and total > 0:
+      d %= total
+    d = max(0.0, min(d, total))
+    i = self.segmentAt(d)
+    length = lengths[i + 1] - lengths[i]
+    t = (d - lengths[i]) / length if length else 0.0
+    p = self.points
+    return tuple(p[3*i+k] + (p[3*i+3+k] - p[3*i+k]) * t for k in range(3))
+
+def positionAtLinear(points, d):
+  '''positionAt() by walking the segments, as the game does.'''
+  for a, b in zip(points, points[1:]):
+    length = distance(a, b)
+    if d <= length:
+      t = d / length if length else 0.0
+      return tuple(a[k] + (b[k] - a[k]) * t for k in range(3))
+    d -= length
+  return points[-1]
+
+class SpacePathTables:
+  '''The PathTable of each spawner with a path in one space, by spawn
+  index.'''
+  __slots__ = ('tables',)
+
+  def __init__(self, tables):
+    self.tables = tables
+
+  def sections(self):
+    '''The .escb (tag, count, bytes) sections of these tables, or none if
+    the space has no paths.'''
+    if not self.tables:
+      return []
+    index = array('I')
+    steps = array('d')
+    lengths = array('d')
+    for iSpawn in sorted(self.tables):
+      table = self.tables[iSpawn]
+      index.extend((iSpawn, len(lengths), len(table.lengths), table.closed))
+      steps.extend((table.step, table.length))
+      lengths.extend(table.lengths)
+    return [
+      (b'PTIX', len(self.tables), leBytes(index, 'I')),
+      (b'PTST', len(self.tables), leBytes(steps, 'd')),
+      (b'PTLN', len(lengths), leBytes(lengths, 'd')),
+    ]
+
+  @classmethod
+  def fromEscb(cls, escbSpace):
+    '''The tables stored in an escher_binary.EscbSpace, or None if the space
+    has none.'''
+    if b'PTIX' not in escbSpace.sections:
+      return None
+    spawns = unpackSpawns(escbSpace.raw(b'SPWN'), escbSpace.numSpawns)
+    index = escbSpace.view(b'PTIX', 'I')
+    steps = escbSpace.view(b'PTST', 'd')
+    lengths = escbSpace.view(b'PTLN', 'd')
+    tables = {}
+    for i in range(len(index) // 4):
+      iSpawn, first, count, closed = index[4*i:4*i+4]
+      tables[iSpawn] = PathTable(spawns[iSpawn].path, lengths[first:first+count], steps[2*i],
+        bool(closed))
+    return cls(tables)
+
+def buildPathTables(space, uniform=False):
+  '''The tables of the spawner paths of space; uniform tells whether they
+  were resampled by shapePath().'''
+  tables = {}
+  for iSpawn, spawn in enumerate(space.spawns):
+    if spawn.path is not None and len(spawn.path) >= 3:
+      tables[iSpawn] = PathTable.fromPath(spawn.path, uniform)
+  return SpacePathTables(tables)
+
+if __name__ == '__main__':
+  from escher_reader import readEsc6
+  if not 2 <= len(sys.argv) <= 5:
+    sys.exit(__doc__.split('Usage: ')[1])
+  with open(sys.argv[1], 'rb') as f:
+    escherMap = readEsc6(f)
+  spacing = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+  rng = random.Random(0)
+  for iSpace, space in enumerate(escherMap.spaces):
+    for iSpawn, spawn in enumerate(space.spawns):
+      if spawn.path is None:
+        continue
+      path = shapePath(spawn.path, spacing, 'smooth' in sys.argv[3:], 'closed' in sys.argv[3:])
+      table = PathTable.fromPath(path, spacing > 0)
+      points = pathPoints(path)
+      queries = [rng.uniform(0, table.length) for i in range(10000)]
+      t0 = time.perf_counter()
+      for d in queries:
+        table.positionAt(d)
+      t1 = time.perf_counter()
+      for d in queries:
+        positionAtLinear(points, d)
+      t2 = time.perf_counter()
+      print('space %d spawn %d: %d -> %d points, length %.3f, lookup %.2f us, walk %.2f us' %
+        (iSpace, iSpawn, len(spawn.path) // 3, len(points), table.length,
+        (t1 - t0) / len(queries) * 1e6, (t2 - t1) / len(queries) * 1e6))
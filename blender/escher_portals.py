@@ -0,0 +1,253 @@
+# Copyright 2014 Don Viszneki
+# Portal graph analysis and potentially visible sets for Escher maps.
+
+"""
+World.drawSpace() recurses through every remote of a space whose portal
+faces pass the stencil test, up to the portal depth, so its cost grows
+exponentially with depth. This module walks the same tree offline, from
+each space, and keeps only the (space, composed transform) pairs which
+portal geometry can see from some point of view:
+
+  A portal face is only seen from in front, and what is seen through it
+  lies behind it. So a portal seen through earlier portals must be
+  partly behind all of their planes, and partly in front of the portal
+  it is seen through. Portals failing either test are pruned along with
+  everything beyond them.
+
+Remotes are composed the way drawSpace() composes them, transform *
+remote.transform, with remote.transform built as the loader builds it.
+Paths arriving at a space at a transform already reached with no tighter
+constraints are merged into the entry already found, and recorded as
+aliases of it.
+
+The sets are stored in .escb as these optional sections of each root
+space, entry 0 being the root space itself:
+
+  PVSE  depth, space, parent entry, remote id per entry (i32 x 4)
+  PVSX  composed transform per entry, row major (f64 x 16)
+  PVSA  parent entry, remote id, entry duplicated per alias (i32 x 3)
+
+Usage: python escher_portals.py MAP.esc6 [DEPTH]
+Compares the size of every space's PVS with the tree drawSpace() walks.
+"""
+import math
+import sys
+from array import array
+from escher_binary import leBytes
+from escher_collision import dot, facePoints, unitNormal
+from escher_map import FACE_REMOTE
+from escher_triangulate import newellNormal
+
+IDENTITY = (1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 1.0)
+
+def matMul(a, b):
+  return tuple(sum(a[4*i+k] * b[4*k+j] for k in range(4)) for i in range(4) for j in range(4))
+
+def rigidTransform(translation, orientation):
+  '''The matrix gl3n builds by rotating about x, y then z by orientation,
+  then translating, each of rotate() and translate() multiplying on the
+  left: the translation times Rz(z) Ry(y) Rx(x), with right handed
+  rotations, written out rather than multiplied.'''
+  sx, cx = math.sin(orientation[0]), math.cos(orientation[0])
+  sy, cy = math.sin(orientation[1]), math.cos(orientation[1])
+  sz, cz = math.sin(orientation[2]), math.cos(orientation[2])
+  return (cz * cy, cz * sy * sx - sz * cx, cz * sy * cx + sz * sx, translation[0],
+    sz * cy, sz * sy * sx + cz * cx, sz * sy * cx - cz * sx, translation[1],
+    -sy, cy * sx, cy * cx, translation[2],
+    0.0, 0.0, 0.0, 1.0)
+
+def remoteTransform(remote):
+  '''The matrix the loader builds for remote.'''
+  return rigidTransform(remote.translation, remote.orientation)
+
+def transformPoint(m, p):
+  return tuple(m[4*i] * p[0] + m[4*i+1] * p[1] + m[4*i+2] * p[2] + m[4*i+3] for i in range(3))
+
+def portalFaces(space):
+  '''The points of the portal faces of space, by remote id.'''
+  portals = {}
+  for iFace, (kind, faceId) in enumerate(zip(space.faceKinds, space.faceIds)):
+    if kind == FACE_REMOTE:
+      portals.setdefault(faceId, []).append(facePoints(space, iFace))
+  return portals
+
+def planeOf(points):
+  '''(n, d) such that n . p = d on the plane of points, n facing the side
+  the polygon is seen from, or None if the polygon is degenerate.'''
+  n = unitNormal(points)
+  if n is None:
+    return None
+  return n, sum(dot(n, p) for p in points) / len(points)
+
+def clipBehind(points, plane, epsilon):
+  '''The part of a convex polygon with n . p <= d + epsilon.'''
+  n, d = plane
+  clipped = []
+  prev = points[-1]
+  prevSide = dot(n, prev) - d
+  for p in points:
+    side = dot(n, p) - d
+    if (side <= epsilon) != (prevSide <= epsilon):
+      t = (epsilon - prevSide) / (side - prevSide)
+      clipped.append(tuple(prev[k] + t * (p[k] - prev[k]) for k in range(3)))
+    if side <= epsilon:
+      clipped.append(p)
+    prev, prevSide = p, side
+  return clipped
+
+def polygonArea(points):
+  nx, ny, nz = newellNormal(points)
+  return math.sqrt(nx*nx + ny*ny + nz*nz) / 2
+
+def roundedKey(values, tolerance):
+  return tuple(int(round(v / tolerance)) for v in values)
+
+class PVSEntry:
+  '''A space reached through the portals from the root space. planes are
+  the portal planes the space is seen behind, and seenThrough the visible
+  parts of the portals it was reached through, both in the root frame.'''
+  __slots__ = ('depth', 'space', 'parent', 'remote', 'transform', 'planes', 'seenThrough')
+
+  def __init__(self, depth, space, parent, remote, transform, planes, seenThrough):
+    self.depth = depth
+    self.space = space
+    self.parent = parent
+    self.remote = remote
+    self.transform = transform
+    self.planes = planes
+    self.seenThrough = seenThrough
+
+class PVS:
+  '''The potentially visible set of one root space: the entries, and the
+  (parent entry, remote id, entry) aliases of merged paths.'''
+  __slots__ = ('entries', 'aliases', 'pruned')
+
+  def __init__(self, entries, aliases, pruned):
+    self.entries = entries
+    self.aliases = aliases
+    self.pruned = pruned
+
+  def sections(self):
+    '''The .escb (tag, count, bytes) sections of this set.'''
+    ids = array('i')
+    transforms = array('d')
+    for entry in self.entries:
+      ids.extend((entry.depth, entry.space, entry.parent, entry.remote))
+      transforms.extend(entry.transform)
+    aliases = array('i', [v for alias in self.aliases for v in alias])
+    return [
+      (b'PVSE', len(self.entries), leBytes(ids, 'i')),
+      (b'PVSX', len(self.entries), leBytes(transforms, 'd')),
+      (b'PVSA', len(self.aliases), leBytes(aliases, 'i')),
+    ]
+
+def visibleParts(faces, entry, epsilon, minArea):
+  '''The parts of portal faces, given in the root frame, which can be seen
+  from the root space through the portals entry was reached through.'''
+  visible = []
+  for points in faces:
+    plane = planeOf(points)
+    if plane is None:
+      continue
+    n, d = plane
+    # Some of the portal we look through must be in front of this one
+    if entry.seenThrough is not None and not any(dot(n, p) > d + epsilon
+        for polygon in entry.seenThrough for p in polygon):
+      continue
+    for behind in entry.planes:
+      points = clipBehind(points, behind, epsilon)
+      if len(points) < 3:
+        break
+    else:
+      if polygonArea(points) > minArea:
+        visible.append(points)
+  return visible
+
+def commonPlane(polygons, epsilon):
+  '''The plane of polygons if they all lie in one, else None.'''
+  planes = [planeOf(points) for points in polygons]
+  n, d = planes[0]
+  if all(dot(n, pn) >= 1 - epsilon and abs(pd - d) <= epsilon for pn, pd in planes[1:]):
+    return n, d
+  return None
+
+def buildPVS(escherMap, root, depth, portals=None, epsilon=1e-6, minArea=1e-9, tolerance=1e-6):
+  '''The PVS of space root, through up to depth portals. portals is the
+  portalFaces() of every space, if already known.'''
+  spaces = escherMap.spaces
+  if portals is None:
+    portals = [portalFaces(space) for space in spaces]
+  def planeKeys(planes):
+    return {roundedKey(n + (d,), tolerance) for n, d in planes}
+  def polygonKeys(polygons):
+    return {roundedKey([c for p in points for c in p], tolerance) for points in polygons}
+
+  entries = [PVSEntry(0, root, -1, -1, IDENTITY, (), None)]
+  found = {(root, roundedKey(IDENTITY, tolerance)): 0}
+  aliases = []
+  pruned = 0
+  level = [0]
+  for d in range(1, depth + 1):
+    nextLevel = []
+    for iEntry in level:
+      entry = entries[iEntry]
+      for remoteId, remote in enumerate(spaces[entry.space].remotes):
+        if not 0 <= remote.space < len(spaces):
+          continue
+        faces = [[transformPoint(entry.transform, p) for p in points]
+          for points in portals[entry.space].get(remoteId, ())]
+        visible = visibleParts(faces, entry, epsilon, minArea)
+        if not visible:
+          pruned += 1
+          continue
+        plane = commonPlane(visible, epsilon)
+        planes = entry.planes + ((plane,) if plane is not None else ())
+        transform = matMul(entry.transform, remoteTransform(remote))
+        key = (remote.space, roundedKey(transform, tolerance))
+        iOther = found.get(key)
+        if iOther is not None:
+          other = entries[iOther]
+          if other.depth == d:
+            # Not expanded yet, so widen it to cover both paths
+            keep = planeKeys(planes)
+            other.planes = tuple(p for p in other.planes if planeKeys([p]) <= keep)
+            other.seenThrough = other.seenThrough + visible
+            aliases.append((iEntry, remoteId, iOther))
+            continue
+          if planeKeys(other.planes) <= planeKeys(planes) and (other.seenThrough is None or
+              polygonKeys(visible) <= polygonKeys(other.seenThrough)):
+            # Already expanded at least as far, from a wider view
+            aliases.append((iEntry, remoteId, iOther))
+            continue
+        found[key] = len(entries)
+        nextLevel.append(len(entries))
+        entries.append(PVSEntry(d, remote.space, iEntry, remoteId, transform, planes, visible))
+    level = nextLevel
+  return PVS(entries, aliases, pruned)
+
+def buildAllPVS(escherMap, depth):
+  '''The PVS of every space of escherMap.'''
+  portals = [portalFaces(space) for space in escherMap.spaces]
+  return [buildPVS(escherMap, root, depth, portals) for root in range(len(escherMap.spaces))]
+
+def drawSpaceVisits(escherMap, root, depth):
+  '''How many spaces drawSpace() visits from root through up to depth
+  portals if every portal passes the stencil test.'''
+  spaces = escherMap.spaces
+  counts = [1] * len(spaces)
+  for d in range(depth):
+    counts = [1 + sum(counts[r.space] for r in space.remotes if 0 <= r.space < len(spaces))
+      for space in spaces]
+  return counts[root]
+
+if __name__ == '__main__':
+  from escher_reader import readEsc6
+  if len(sys.argv) not in (2, 3):
+    sys.exit(__doc__.split('Usage: ')[1])
+  with open(sys.argv[1], 'rb') as f:
+    escherMap = readEsc6(f)
+  depth = int(sys.argv[2]) if len(sys.argv) == 3 else 6
+  print('space  drawSpace visits  PVS entries  aliases  pruned portals')
+  for root, pvs in enumerate(buildAllPVS(escherMap, depth)):
+    print('%5d %17d %12d %8d %15d' % (root, drawSpaceVisits(escherMap, root, depth),
+      len(pvs.entries), len(pvs.aliases), pvs.pruned))
@@ -0,0 +1,161 @@
+# Copyright 2014 Don Viszneki
+# Phase timings and counters for the Escher map exporter.
+
+"""
+An ExportProfile collects the wall time of each phase of an export, the
+time spent on each space, and counters such as the number of faces and
+bytes written. It can also run the hot phases under cProfile.
+
+Code being profiled takes a profile argument and wraps its phases in
+"with profile.phase(name):". When profiling is off it is given
+NULL_PROFILE, whose phase() hands back the same do-nothing context
+manager every time, and whose count() does nothing; phases are only
+marked around loops, never inside them.
+"""
+import cProfile
+import json
+import pstats
+import time
+from contextlib import contextmanager
+from os.path import splitext
+from escher_map import formatSpaceHead
+from escher_mesh import formatFaces, formatVerts
+
+class NullPhase:
+  def __enter__(self):
+    pass
+
+  def __exit__(self, *exc):
+    return False
+
+class NullProfile:
+  '''Stands in for an ExportProfile when profiling is off.'''
+  enabled = False
+  _null = NullPhase()
+
+  def phase(self, name, space=None, hot=False):
+    return self._null
+
+  def count(self, name, n=1):
+    pass
+
+  def countMap(self, escherMap):
+    pass
+
+  def note(self, text):
+    pass
+
+NULL_PROFILE = NullProfile()
+
+class ExportProfile:
+  '''phases and spaces map names to seconds, counters names to counts.
+  With useCProfile, phases marked hot also run under cProfile.'''
+  enabled = True
+
+  def __init__(self, useCProfile=False):
+    self.phases = {}
+    self.spaces = {}
+    self.counters = {}
+    self.notes = []
+    self.cProfile = cProfile.Profile() if useCProfile else None
+    self.start = time.perf_counter()
+    self.seconds = None
+
+  @contextmanager
+  def phase(self, name, space=None, hot=False):
+    '''Times the with block as part of phase name and, if space is given,
+    of that space.'''
+    profiler = self.cProfile if hot else None
+    if profiler is not None:
+      profiler.enable()
+    t0 = time.perf_counter()
+    try:
+      yield
+    finally:
+      seconds = time.perf_counter() - t0
+      if profiler is not None:
+        profiler.disable()
+      self.phases[name] = self.phases.get(name, 0.0) + seconds
+      if space is not None:
+        self.spaces[space] = self.spaces.get(space, 0.0) + seconds
+
+  def count(self, name, n=1):
+    self.counters[name] = self.counters.get(name, 0) + n
+
+  def countMap(self, escherMap):
+    '''Counts the spaces, verts, faces, loops, UV layers, remotes, spawns
+    and materials of escherMap.'''
+    spaces = escherMap.spaces
+    self.count('spaces', len(spaces))
+    self.count('verts', sum(space.numVerts for space in spaces))
+    self.count('faces', sum(space.numFaces for space in spaces))
+    self.count('loops', sum(len(space.mesh.loopVerts) for space in spaces))
+    self.count('uv layers', sum(len(space.mesh.uvLayers) for space in spaces))
+    self.count('remotes', sum(len(space.remotes) for space in spaces))
+    self.count('spawns', sum(len(space.spawns) for space in spaces))
+    self.count('materials', len(escherMap.materials))
+
+  def note(self, text):
+    '''Records something the reader of the profile should know, such as
+    a breakdown left out.'''
+    self.notes.append(text)
+
+  def finish(self):
+    self.seconds = time.perf_counter() - self.start
+
+  def slowestSpaces(self, n=10):
+    return sorted(self.spaces.items(), key=lambda item: -item[1])[:n]
+
+  def summary(self):
+    '''One line for operator.report().'''
+    parts = ['Exported in %.2fs' % (self.seconds or 0)]
+    parts.append(', '.join('%d %s' % (self.counters[c], c)
+      for c in ('spaces', 'verts', 'faces') if c in self.counters))
+    if self.phases:
+      name, seconds = max(self.phases.items(), key=lambda item: item[1])
+      parts.append('slowest phase %s (%.2fs)' % (name, seconds))
+    slowest = self.slowestSpaces(1)
+    if slowest:
+      parts.append('slowest space %s (%.2fs)' % slowest[0])
+    return '; '.join(parts)
+
+  def toDict(self, numSlowest=10):
+    result = {
+      'seconds': self.seconds,
+      'phases': self.phases,
+      'counters': self.counters,
+      'slowestSpaces': [{'space': name, 'seconds': seconds}
+        for name, seconds in self.slowestSpaces(numSlowest)],
+    }
+    if self.notes:
+      result['notes'] = self.notes
+    if self.cProfile is not None:
+      stats = pstats.Stats(self.cProfile)
+      top = sorted(stats.stats.items(), key=lambda item: -item[1][3])[:20]
+      result['cProfile'] = [{'function': '%s:%d(%s)' % func, 'calls': nc,
+        'totalSeconds': tt, 'cumulativeSeconds': ct} for func, (cc, nc, tt, ct, callers) in top]
+    return result
+
+  def write(self, filename):
+    '''Writes the profile as JSON to filename and, if cProfile was used,
+    its full statistics to filename's base name + ".prof".'''
+    with open(filename, 'w') as f:
+      json.dump(self.toDict(), f, indent=2)
+    if self.cProfile is not None:
+      self.cProfile.dump_stats(splitext(filename)[0] + '.prof')
+
+def profiledSpaceBlocks(escherMap, profile, indices=None):
+  '''Like escher_map.formatSpaces() with one worker, but timing the vert
+  and face blocks of each space separately.'''
+  blocks = []
+  for iSpace in range(len(escherMap.spaces)) if indices is None else indices:
+    space = escherMap.spaces[iSpace]
+    name = space.name if space.name is not None else str(iSpace)
+    with profile.phase('format remotes and spawns', name):
+      head = formatSpaceHead(space, iSpace)
+    with profile.phase('format verts', name, hot=True):
+      verts = formatVerts(space.mesh)
+    with profile.phase('format faces', name, hot=True):
+      faces = formatFaces(space.mesh, space.faceClasses(), space.sourceFaces)
+    blocks.append(head + verts + faces)
+  return blocks
@@ -0,0 +1,256 @@
+# Copyright 2014 Don Viszneki
+# Quantized vertex attributes for .escb and .escz maps.
+
+"""
+Positions, UVs and normals make up most of a map. Quantized, a space
+stores instead:
+
+  positions  each axis as an unsigned integer of 1 to 32 bits on a grid
+             spanning the space's bounding box
+  UVs        each component as a u16 on a grid spanning the range of that
+             component in its UV layer
+  normals    octahedral encoded, as two i16
+
+The vertices of portal faces are stored exactly as well, so that the
+portals of neighbouring spaces still line up.
+
+A Quantization quantizes spaces as they are written and records the
+largest error in each space: the distance of a vertex from where it
+should be, the angle between a normal and the normal it should be, and
+the difference in a UV component.
+
+In .escb and .escz the VERT, LUV and LNRM sections of a quantized space
+are replaced by:
+
+  QPOS  QUANT_POS: grid origin xyz, grid step xyz, bits, number of exact
+        vertices
+  QVRT  grid coordinates xyz per vertex (u16 up to 16 bits, else u32)
+  QEXV  index of each exact vertex (u32)
+  QEXP  xyz of each exact vertex (real)
+  QUVR  origin u, origin v, step u, step v per UV layer (f64)
+  QUV   uv pair per loop, for each UV layer in turn (u16)
+  QNRM  octahedral xy per loop (i16)
+
+Usage: python escher_quantize.py MAP.esc6 [BITS]
+Prints the errors and sizes of the map quantized to BITS (default 16)
+bits per position axis.
+"""
+import math
+import struct
+import sys
+from array import array
+from collections import namedtuple
+from escher_map import FACE_REMOTE
+
+QUANT_POS = struct.Struct('<6dII')
+
+UV_BITS = 16
+NORMAL_SCALE = 32767
+
+SpaceErrors = namedtuple('SpaceErrors', 'space position angle uv numExact')
+
+def positionTypecode(bits):
+  return 'H' if bits <= 16 else 'I'
+
+def grid(values, bits):
+  '''The origin and step of a grid of 2**bits points spanning values.'''
+  lo = min(values) if len(values) else 0.0
+  hi = max(values) if len(values) else 0.0
+  return lo, (hi - lo) / ((1 << bits) - 1)
+
+def quantizeAxis(values, origin, step, typecode):
+  if step == 0:
+    return array(typecode, bytes(array(typecode).itemsize * len(values)))
+  return array(typecode, [int(round((v - origin) / step)) for v in values])
+
+def octEncode(x, y, z):
+  '''The octahedral encoding of a normal as two i16.'''
+  s = abs(x) + abs(y) + abs(z)
+  if s == 0:
+    return 0, 0
+  x /= s
+  y /= s
+  if z < 0:
+    x, y = (1 - abs(y)) * math.copysign(1, x), (1 - abs(x)) * math.copysign(1, y)
+  return int(round(x * NORMAL_SCALE)), int(round(y * NORMAL_SCALE))
+
+def octDecode(a, b):
+  x = a / NORMAL_SCALE
+  y = b / NORMAL_SCALE
+  z = 1 - abs(x) - abs(y)
+  if z < 0:
+    x, y = (1 - abs(y)) * math.copysign(1, x), (1 - abs(x)) * math.copysign(1, y)
+  length = math.sqrt(x*x + y*y + z*z)
+  return x / length, y / length, z / length
+
+def portalVerts(space):
+  '''Indices of the vertices of the portal faces of space, ascending.'''
+  mesh = space.mesh
+  found = set()
+  for kind, start, total in zip(space.faceKinds, mesh.loopStarts, mesh.loopTotals):
+    if kind == FACE_REMOTE:
+      found.update(mesh.loopVerts[start:start+total])
+  return sorted(found)
+
+class QuantizedSpace:
+  '''The quantized attributes of one space. positions holds the grid
+  coordinates xyz per vertex; uvs and normals follow the loop order of
+  the arrays they were made from.'''
+  __slots__ = ('bits', 'origin', 'step', 'positions', 'exactVerts', 'exactCo', 'uvRanges',
+    'uvs', 'normals')
+
+  def __init__(self, bits, origin, step, positions, exactVerts, exactCo, uvRanges, uvs, normals):
+    self.bits = bits
+    self.origin = origin
+    self.step = step
+    self.positions = positions
+    self.exactVerts = exactVerts
+    self.exactCo = exactCo
+    self.uvRanges = uvRanges
+    self.uvs = uvs
+    self.normals = normals
+
+  def verts(self, typecode='d'):
+    '''The dequantized xyz of every vertex, exact ones included.'''
+    return dequantizeVerts(self.positions, self.origin, self.step, self.exactVerts, self.exactCo,
+      typecode)
+
+  def uvLayers(self, typecode='d'):
+    return dequantizeUVs(self.uvs, self.uvRanges, typecode)
+
+  def loopNormals(self, typecode='d'):
+    return dequantizeNormals(self.normals, typecode)
+
+def dequantizeVerts(positions, origin, step, exactVerts, exactCo, typecode='d'):
+  verts = array(typecode, bytes(array(typecode).itemsize * len(positions)))
+  for axis in range(3):
+    o = origin[axis]
+    s = step[axis]
+    verts[axis::3] = array(typecode, [o + q * s for q in positions[axis::3]])
+  for i, vi in enumerate(exactVerts):
+    verts[3*vi:3*vi+3] = array(typecode, exactCo[3*i:3*i+3])
+  return verts
+
+def dequantizeUVs(uvs, uvRanges, typecode='d'):
+  '''One array of uv pairs per UV layer.'''
+  layers = []
+  n = len(uvs) // len(uvRanges) if uvRanges else 0
+  for iLayer, (ou, ov, su, sv) in enumerate(uvRanges):
+    q = uvs[iLayer*n:(iLayer+1)*n]
+    layer = array(typecode, bytes(array(typecode).itemsize * n))
+    layer[0::2] = array(typecode, [ou + c * su for c in q[0::2]])
+    layer[1::2] = array(typecode, [ov + c * sv for c in q[1::2]])
+    layers.append(layer)
+  return layers
+
+def dequantizeNormals(normals, typecode='d'):
+  out = array(typecode)
+  for i in range(0, len(normals), 2):
+    out.extend(octDecode(normals[i], normals[i+1]))
+  return out
+
+class Quantization:
+  '''Quantizes spaces to bits per position axis, recording the errors of
+  each in errors.'''
+
+  def __init__(self, bits=16):
+    if not 1 <= bits <= 32:
+      raise ValueError('positions must be quantized to 1 to 32 bits, not %d' % bits)
+    self.bits = bits
+    self.errors = []
+
+  def quantize(self, space, uvLayers=None, loopNormals=None, real='d'):
+    '''Quantizes space. uvLayers and loopNormals default to those of its
+    mesh, and may be given reordered as they will be stored. Exact
+    vertices are kept as real.'''
+    mesh = space.mesh
+    verts = mesh.verts
+    uvLayers = mesh.uvLayers if uvLayers is None else uvLayers
+    loopNormals = mesh.loopNormals if loopNormals is None else loopNormals
+    typecode = positionTypecode(self.bits)
+
+    grids = [grid(verts[axis::3], self.bits) for axis in range(3)]
+    positions = array(typecode, bytes(array(typecode).itemsize * len(verts)))
+    for axis, (origin, step) in enumerate(grids):
+      positions[axis::3] = quantizeAxis(verts[axis::3], origin, step, typecode)
+    exactVerts = array('I', portalVerts(space))
+    exactCo = array(real, [c for vi in exactVerts for c in verts[3*vi:3*vi+3]])
+
+    uvRanges = []
+    uvs = array('H')
+    for layer in uvLayers:
+      ou, su = grid(layer[0::2], UV_BITS)
+      ov, sv = grid(layer[1::2], UV_BITS)
+      uvRanges.append((ou, ov, su, sv))
+      q = array('H', bytes(2 * len(layer)))
+      q[0::2] = quantizeAxis(layer[0::2], ou, su, 'H')
+      q[1::2] = quantizeAxis(layer[1::2], ov, sv, 'H')
+      uvs.extend(q)
+
+    normals = array('h')
+    for i in range(0, len(loopNormals), 3):
+      normals.extend(octEncode(loopNormals[i], loopNormals[i+1], loopNormals[i+2]))
+
+    q = QuantizedSpace(self.bits, tuple(g[0] for g in grids), tuple(g[1] for g in grids),
+      positions, exactVerts, exactCo, uvRanges, uvs, normals)
+    self.errors.append(spaceErrors(len(self.errors) if space.name is None else space.name,
+      q, verts, uvLayers, loopNormals, real))
+    return q
+
+  def worst(self):
+    '''The largest position, angle and uv errors of any space.'''
+    return (max([e.position for e in self.errors] or [0.0]), max([e.angle for e in self.errors] or [0.0]),
+      max([e.uv for e in self.errors] or [0.0]))
+
+  def summary(self):
+    position, angle, uv = self.worst()
+    return ('Quantized %d spaces to %d bits: largest errors %.3g in position, %.3g degrees '
+      'in normals, %.3g in UVs' % (len(self.errors), self.bits, position, angle, uv))
+
+def spaceErrors(name, q, verts, uvLayers, loopNormals, real='d'):
+  '''The largest errors of the quantized space q, made from verts,
+  uvLayers and loopNormals, as read back with real precision.'''
+  decoded = q.verts(real)
+  position = 0.0
+  for i in range(0, len(verts), 3):
+    d = math.sqrt((decoded[i] - verts[i])**2 + (decoded[i+1] - verts[i+1])**2 +
+      (decoded[i+2] - verts[i+2])**2)
+    if d > position:
+      position = d
+
+  uv = 0.0
+  for layer, decodedLayer in zip(uvLayers, q.uvLayers(real)):
+    for a, b in zip(layer, decodedLayer):
+      if abs(a - b) > uv:
+        uv = abs(a - b)
+
+  angle = 0.0
+  decodedNormals = q.loopNormals(real)
+  for i in range(0, len(loopNormals), 3):
+    x, y, z = loopNormals[i:i+3]
+    length = math.sqrt(x*x + y*y + z*z)
+    if length == 0:
+      continue
+    c = (x * decodedNormals[i] + y * decodedNormals[i+1] + z * decodedNormals[i+2]) / length
+    a = math.degrees(math.acos(max(-1.0, min(1.0, c))))
+    if a > angle:
+      angle = a
+  return SpaceErrors(name, position, angle, uv, len(q.exactVerts))
+
+if __name__ == '__main__':
+  import io
+  from escher_binary import writeEscb
+  from escher_reader import readEsc6
+  if len(sys.argv) not in (2, 3):
+    sys.exit(__doc__.split('Usage: ')[1])
+  with open(sys.argv[1], 'rb') as f:
+    escherMap = readEsc6(f)
+  quantization = Quantization(int(sys.argv[2]) if len(sys.argv) == 3 else 16)
+  plain = io.BytesIO()
+  writeEscb(escherMap, plain, realSize=4)
+  quantized = io.BytesIO()
+  writeEscb(escherMap, quantized, realSize=4, quantization=quantization)
+  for e in quantization.errors:
+    print('space %s: %.3g position, %.3g degrees, %.3g uv, %d exact vertices' % e)
+  print(quantization.summary())
+  print('.escb with f32: %d bytes, quantized: %d bytes' % (len(plain.getvalue()), len(quantized.getvalue())))
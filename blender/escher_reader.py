@@ -0,0 +1,330 @@
+# Copyright 2014 Don Viszneki
+# Streaming .esc6 reader and validator.
+
+"""
+readRecords() walks a .esc6 file with the same state machine as the game's
+loader (ParserMode in src/ants/escher.d) and yields one typed record per
+line, so memory use does not grow with the size of the map. It checks
+every count and index, including that the last space is not cut short by
+the end of the file, and every error carries the line number it was found
+on. That makes it cheap to check exported maps without starting the game.
+
+Files must be opened in binary mode; that is noticeably faster than text
+mode for large maps.
+
+Usage: python escher_reader.py MAP.esc6 [MAP.esc6 ...]
+Exits with status 1 if any map is invalid.
+"""
+import sys
+from array import array
+from collections import namedtuple
+from escher_mesh import MeshArrays
+from escher_map import EscherMap, Material, Remote, Spawn, Space, faceKindNames
+
+MaterialRecord = namedtuple('MaterialRecord', 'lineNo id name numTextures')
+TextureRecord  = namedtuple('TextureRecord', 'lineNo mapType fileName')
+SpaceRecord    = namedtuple('SpaceRecord', 'lineNo id numVerts numFaces numRemotes numSpawns')
+RemoteRecord   = namedtuple('RemoteRecord', 'lineNo id space translation orientation')
+SpawnRecord    = namedtuple('SpawnRecord', 'lineNo id type translation orientation path')
+VertRecord     = namedtuple('VertRecord', 'lineNo id co')
+# indices, uvs and normals are flat lists; uvs holds numUVLayers pairs per corner.
+# source is the face this one was made from, or None
+FaceRecord     = namedtuple('FaceRecord', 'lineNo id kind target indices uvs normals source')
+
+textureMapTypes = ('COLOR', 'NORMAL')
+spawnTypes = ('player', 'spikey', 'dragonfly', 'bendingbar')
+
+class MapError(ValueError):
+  def __init__(self, lineNo, msg):
+    ValueError.__init__(self, 'line %d: %s' % (lineNo, msg))
+    self.lineNo = lineNo
+
+# The states of readRecords(), named as in escher.d
+(expectNumMaterials, expectMaterial, expectTexture, expectNumSpaces, expectSpace,
+  expectRemote, expectSpawn, expectVert, expectFace) = range(9)
+
+expected = ('nummaterials', 'material', 'texture', 'numspaces', 'space', 'remote',
+  'spawn', 'vert', 'face')
+expectedCommands = tuple(e.encode('ascii') for e in expected)
+
+def readRecords(f, strict=True):
+  '''Yields the records of the .esc6 file object f, which must be opened
+  in binary mode. Raises MapError on the first problem found. Without
+  strict, faces and remotes referring to materials, remotes or spaces which
+  do not exist are let through, for escher_lint to report.'''
+  lineNo = 0
+
+  def enforce(cond, msg):
+    if not cond:
+      raise MapError(lineNo, msg)
+
+  def number(conv, word, what):
+    try:
+      return conv(word)
+    except ValueError:
+      raise MapError(lineNo, 'bad %s "%s"' % (what, word.decode('utf-8', 'replace')))
+
+  def vec3(words, i, what):
+    enforce(len(words) >= i + 3, 'expected 3 numbers after %s' % what)
+    return (number(float, words[i], what), number(float, words[i+1], what),
+      number(float, words[i+2], what))
+
+  mode = expectNumMaterials
+  numMaterials = numTextures = numSpaces = 0
+  materialID = spaceID = -1
+  numTexturesRead = 0
+  space = None
+  count = 0
+  numUVLayers = None
+  hasSource = False
+
+  for lineNo, line in enumerate(f, 1):
+    if lineNo == 1:
+      enforce(line.rstrip(b'\r\n') == b'escher version 6', 'first line of map must be: escher version 6')
+      continue
+    words = line.split()
+    if not words:
+      continue
+    enforce(words[0] == expectedCommands[mode], 'expected %s' % expected[mode])
+
+    if mode == expectFace:
+      enforce(len(words) >= 6 and words[4] == b'vdata', 'expected vdata')
+      enforce(number(int, words[1], 'face id') == count, 'faces disorganized')
+      kind = words[2].decode('ascii', 'replace')
+      enforce(kind in faceKindNames, 'expected either "mat" or "remote"')
+      target = number(int, words[3], kind + ' index')
+      if strict:
+        if kind == 'mat':
+          enforce(0 <= target < numMaterials, 'material %d does not exist' % target)
+        else:
+          enforce(0 <= target < space.numRemotes, 'remote %d does not exist' % target)
+      source = None
+      if words[-2] == b'source':
+        source = number(int, words[-1], 'source face')
+        enforce(source >= 0, 'bad source face %d' % source)
+        del words[-2:]
+      if count == 0:
+        hasSource = source is not None
+      enforce(hasSource == (source is not None), 'either all or none of a space\'s faces must have a source')
+      n = number(int, words[5], 'vertex count')
+      enforce(n >= 3, 'face has fewer than 3 vertices')
+      enforce((len(words) - 6) % n == 0, 'vertex data does not divide into %d vertices' % n)
+      stride = (len(words) - 6) // n
+      enforce(stride >= 4 and stride % 2 == 0, 'malformed vertex data')
+      if count == 0:
+        numUVLayers = (stride - 4) // 2
+      enforce(stride == 4 + 2 * numUVLayers, 'expected %d UV layers' % numUVLayers)
+      try:
+        indices = list(map(int, words[6::stride]))
+        data = list(map(float, words[6:]))
+      except ValueError:
+        raise MapError(lineNo, 'bad vertex data')
+      if min(indices) < 0 or max(indices) >= space.numVerts:
+        enforce(False, 'vertex index %d out of range' %
+          next(vi for vi in indices if not 0 <= vi < space.numVerts))
+      uvs = [x for i in range(0, len(data), stride) for x in data[i+1:i+stride-3]]
+      normals = [x for i in range(stride-3, len(data), stride) for x in data[i:i+3]]
+      yield FaceRecord(lineNo, count, kind, target, indices, uvs, normals, source)
+      count += 1
+      if count == space.numFaces:
+        mode = expectSpace
+
+    elif mode == expectVert:
+      enforce(len(words) == 5, 'expected vertex id and 3 coordinates')
+      enforce(number(int, words[1], 'vert id') == count, 'verts disorganized')
+      yield VertRecord(lineNo, count, vec3(words, 2, 'vert'))
+      count += 1
+      if count == space.numVerts:
+        count = 0
+        mode = expectFace if space.numFaces else expectSpace
+
+    elif mode == expectSpace:
+      enforce(len(words) >= 10 and words[2] == b'numverts' and words[4] == b'numfaces' and
+        words[6] == b'numremotes' and words[8] == b'numspawns',
+        'expected: space ID numverts N numfaces N numremotes N numspawns N')
+      spaceID += 1
+      enforce(spaceID < numSpaces, 'more spaces than numspaces %d' % numSpaces)
+      enforce(number(int, words[1], 'space id') == spaceID, 'spaces disorganized')
+      space = SpaceRecord(lineNo, spaceID, *[number(int, words[i], words[i-1].decode()) for i in (3, 5, 7, 9)])
+      yield space
+      count = 0
+      if space.numRemotes:
+        mode = expectRemote
+      elif space.numSpawns:
+        mode = expectSpawn
+      elif space.numVerts:
+        mode = expectVert
+      elif space.numFaces:
+        mode = expectFace
+      else:
+        mode = expectSpace
+
+    elif mode == expectRemote:
+      enforce(len(words) >= 4 and words[2] == b'space', 'expected space while parsing remote')
+      enforce(number(int, words[1], 'remote id') == count, 'remotes disorganized')
+      remoteSpace = number(int, words[3], 'remote space')
+      enforce(not strict or -1 <= remoteSpace < numSpaces, 'remote space %d does not exist' % remoteSpace)
+      translation = orientation = (0.0, 0.0, 0.0)
+      # The game ignores the rest of the line for remotes to no space
+      if remoteSpace >= 0 or len(words) > 4:
+        enforce(len(words) >= 5 and words[4] == b'translation', 'expected translation')
+        translation = vec3(words, 5, 'translation')
+        if len(words) > 8:
+          enforce(words[8] == b'orientation', 'expected orientation')
+          orientation = vec3(words, 9, 'orientation')
+      yield RemoteRecord(lineNo, count, remoteSpace, translation, orientation)
+      count += 1
+      if count == space.numRemotes:
+        count = 0
+        if space.numSpawns:
+          mode = expectSpawn
+        elif space.numVerts:
+          mode = expectVert
+        elif space.numFaces:
+          mode = expectFace
+        else:
+          mode = expectSpace
+
+    elif mode == expectSpawn:
+      enforce(len(words) >= 12 and words[2] == b'translation' and words[6] == b'orientation' and
+        words[10] == b'params', 'expected: spawn ID translation X Y Z orientation X Y Z params TYPE')
+      enforce(number(int, words[1], 'spawn id') == count, 'spawns disorganized')
+      spawnType = words[11].decode('utf-8')
+      enforce(spawnType in spawnTypes, 'unknown spawn type %s' % spawnType)
+      path = None
+      if len(words) > 12:
+        enforce(words[12] == b'path', 'expected path')
+        enforce((len(words) - 13) % 3 == 0, 'malformed path')
+        path = [number(float, w, 'path coordinate') for w in words[13:]]
+      yield SpawnRecord(lineNo, count, spawnType, vec3(words, 3, 'translation'),
+        vec3(words, 7, 'orientation'), path)
+      count += 1
+      if count == space.numSpawns:
+        count = 0
+        if space.numVerts:
+          mode = expectVert
+        elif space.numFaces:
+          mode = expectFace
+        else:
+          mode = expectSpace
+
+    elif mode == expectMaterial:
+      # The game splits this line on whitespace, so names may not contain any
+      enforce(len(words) == 5 and words[3] == b'numtex', 'expected: material ID "NAME" numtex N')
+      materialID += 1
+      enforce(number(int, words[1], 'material id') == materialID, 'materials disorganized')
+      name = words[2].strip(b'"')
+      numTextures = number(int, words[4], 'numtex')
+      numTexturesRead = 0
+      yield MaterialRecord(lineNo, materialID, name.decode('utf-8'), numTextures)
+      if numTextures:
+        mode = expectTexture
+      elif materialID + 1 == numMaterials:
+        mode = expectNumSpaces
+
+    elif mode == expectTexture:
+      enforce(len(words) == 3, 'expected: texture TYPE FILE')
+      mapType = words[1].decode('utf-8')
+      enforce(mapType in textureMapTypes, 'unknown texture application %s' % mapType)
+      yield TextureRecord(lineNo, mapType, words[2].decode('utf-8'))
+      numTexturesRead += 1
+      if numTexturesRead == numTextures:
+        mode = expectNumSpaces if materialID + 1 == numMaterials else expectMaterial
+
+    elif mode == expectNumMaterials:
+      enforce(len(words) == 2, 'expected: nummaterials N')
+      numMaterials = number(int, words[1], 'nummaterials')
+      mode = expectMaterial if numMaterials else expectNumSpaces
+
+    elif mode == expectNumSpaces:
+      enforce(len(words) == 2, 'expected: numspaces N')
+      numSpaces = number(int, words[1], 'numspaces')
+      mode = expectSpace
+
+  # Make sure no record type, usually the last space's faces, was underdelivered
+  if lineNo == 0:
+    raise MapError(0, 'empty map')
+  if mode != expectSpace or spaceID + 1 != numSpaces:
+    if space is not None and mode in (expectRemote, expectSpawn, expectVert, expectFace):
+      raise MapError(lineNo, 'map ends early: space %d has %d of %d %ss' %
+        (space.id, count, getattr(space, 'num%ss' % expected[mode].capitalize()), expected[mode]))
+    raise MapError(lineNo, 'map ends early: expected %s' % expected[mode])
+
+def readSpaces(f, materials=None, strict=True):
+  '''Yields each space of the .esc6 file object f as an escher_map.Space,
+  so that only one space is held in memory at a time. If materials is a
+  list, the map's materials are appended to it.'''
+  mesh = space = None
+  for rec in readRecords(f, strict):
+    t = type(rec)
+    if t is FaceRecord:
+      mesh.loopStarts.append(len(mesh.loopVerts))
+      mesh.loopTotals.append(len(rec.indices))
+      mesh.loopVerts.extend(rec.indices)
+      if len(rec.uvs) and not mesh.uvLayers:
+        mesh.uvLayers = [array('d') for i in range(len(rec.uvs) // (2 * len(rec.indices)))]
+      numUVLayers = len(mesh.uvLayers)
+      for iLayer, uvs in enumerate(mesh.uvLayers):
+        for i in range(2 * iLayer, len(rec.uvs), 2 * numUVLayers):
+          uvs.extend(rec.uvs[i:i+2])
+      mesh.loopNormals.extend(rec.normals)
+      space.faceKinds.append(faceKindNames.index(rec.kind))
+      space.faceIds.append(rec.target)
+      if rec.source is not None:
+        if space.sourceFaces is None:
+          space.sourceFaces = array('i')
+        space.sourceFaces.append(rec.source)
+    elif t is VertRecord:
+      mesh.verts.extend(rec.co)
+    elif t is SpaceRecord:
+      if space is not None:
+        yield space
+      mesh = MeshArrays(array('d'), array('i'), array('i'), array('i'), [], array('d'), None)
+      space = Space(None, mesh, array('b'), array('i'))
+    elif t is RemoteRecord:
+      space.remotes.append(Remote(rec.space, rec.translation, rec.orientation))
+    elif t is SpawnRecord:
+      path = array('d', rec.path) if rec.path is not None else None
+      space.spawns.append(Spawn(rec.type, rec.translation, rec.orientation, path))
+    elif t is MaterialRecord:
+      if materials is not None:
+        materials.append(Material(rec.name))
+    elif t is TextureRecord:
+      if materials is not None:
+        materials[-1].textures.append((rec.mapType, rec.fileName))
+  if space is not None:
+    yield space
+
+def readEsc6(f, strict=True):
+  '''Reads the whole .esc6 file object f, opened in binary mode, into an
+  EscherMap. Reals are read into array('d'), so writing the map back out
+  reproduces the file exactly.'''
+  escherMap = EscherMap()
+  materials = []
+  for space in readSpaces(f, materials, strict):
+    escherMap.addSpace(space)
+  for material in materials:
+    escherMap.addMaterial(material)
+  return escherMap
+
+def validate(filename):
+  '''Checks a .esc6 file. Returns a short summary, or raises MapError.'''
+  numSpaces = numFaces = 0
+  with open(filename, 'rb') as f:
+    for rec in readRecords(f):
+      if type(rec) is SpaceRecord:
+        numSpaces += 1
+        numFaces += rec.numFaces
+  return '%d spaces, %d faces' % (numSpaces, numFaces)
+
+if __name__ == '__main__':
+  if len(sys.argv) < 2:
+    sys.exit(__doc__.split('Usage: ')[1])
+  failed = False
+  for filename in sys.argv[1:]:
+    try:
+      print('%s: ok, %s' % (filename, validate(filename)))
+    except (MapError, OSError) as e:
+      print('%s: %s' % (filename, e))
+      failed = True
+  sys.exit(1 if failed else 0)
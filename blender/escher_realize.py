@@ -0,0 +1,77 @@
+# Copyright 2014 Don Viszneki
+# Remote graph walks for realizing many remotes at once in Escher Tools.
+
+"""
+The Blender side of Escher Tools realizes a remote by putting an SSO of
+the remote space where the remote's empty is. realizeTree() plans that
+for a whole neighbourhood at once: it walks the remote graph breadth
+first from a root space, composing each remote's matrix with the matrix
+of the path leading to it, and returns one node per SSO to create.
+
+A graph maps each space name to its remotes as (portal index, remote
+space name, matrix) tuples, matrices being row major 16-tuples relative
+to the space's PSO. Paths which arrive at a space at a transform already
+reached, including the root space at identity, are walked only once.
+
+Usage: python escher_realize.py MAP.esc6 ROOTSPACE DEPTH [MAXOBJECTS]
+Plans the realization of a map's remotes, spaces being named by index.
+"""
+import sys
+from escher_portals import IDENTITY, matMul, remoteTransform, roundedKey
+
+class RealizeNode:
+  '''One SSO to create: space seen through portal remote of the node at
+  index parent (-1 for the root space), at transform relative to the root
+  space's PSO.'''
+  __slots__ = ('space', 'transform', 'depth', 'parent', 'remote')
+
+  def __init__(self, space, transform, depth, parent, remote):
+    self.space = space
+    self.transform = transform
+    self.depth = depth
+    self.parent = parent
+    self.remote = remote
+
+def realizeTree(graph, root, depth, maxObjects=None, tolerance=1e-6):
+  '''Returns the nodes reachable from space root through up to depth
+  remotes, nearest first, and whether maxObjects cut the walk short.
+  Remotes to spaces missing from graph are skipped.'''
+  seen = {(root, roundedKey(IDENTITY, tolerance))}
+  nodes = []
+  level = [(-1, root, IDENTITY)]
+  for d in range(1, depth + 1):
+    nextLevel = []
+    for iParent, space, transform in level:
+      for portalIndex, remoteSpace, matrix in graph.get(space, ()):
+        if remoteSpace not in graph:
+          continue
+        composed = matMul(transform, matrix)
+        key = (remoteSpace, roundedKey(composed, tolerance))
+        if key in seen:
+          continue
+        if maxObjects is not None and len(nodes) >= maxObjects:
+          return nodes, True
+        seen.add(key)
+        nextLevel.append((len(nodes), remoteSpace, composed))
+        nodes.append(RealizeNode(remoteSpace, composed, d, iParent, portalIndex))
+    level = nextLevel
+  return nodes, False
+
+def graphFromMap(escherMap):
+  '''The remote graph of an escher_map.EscherMap, naming spaces by index.'''
+  return {iSpace: [(iRemote, remote.space, remoteTransform(remote))
+    for iRemote, remote in enumerate(space.remotes) if remote.space >= 0]
+    for iSpace, space in enumerate(escherMap.spaces)}
+
+if __name__ == '__main__':
+  from escher_reader import readEsc6
+  if len(sys.argv) not in (4, 5):
+    sys.exit(__doc__.split('Usage: ')[1])
+  with open(sys.argv[1], 'rb') as f:
+    escherMap = readEsc6(f)
+  maxObjects = int(sys.argv[4]) if len(sys.argv) == 5 else None
+  nodes, truncated = realizeTree(graphFromMap(escherMap), int(sys.argv[2]), int(sys.argv[3]), maxObjects)
+  for d in range(1, int(sys.argv[3]) + 1):
+    print('depth %d: %d SSOs' % (d, sum(node.depth == d for node in nodes)))
+  if truncated:
+    print('stopped at %d SSOs' % len(nodes))
@@ -0,0 +1,166 @@
+# Copyright 2014 Don Viszneki
+# An index of the Escher spaces in a .blend file, for Escher Tools.
+
+"""
+Escher Tools operators used to scan every object in the file to find a
+space's PSO, an object's remotes or its free portal indices, and Blender
+2.7x's Object.children is itself a scan of every object. A SpaceRegistry
+does one scan and keeps each space's PSO and SSOs, each object's
+children, and the remote empties and portal indices under each object,
+so operators can look them up directly. Escher Tools marks it stale from
+Blender's update, undo and load handlers, and it rebuilds itself the
+next time it is used.
+
+It knows nothing of bpy: objects only need name, type, parent and hide
+attributes and a get() for custom properties.
+"""
+
+PSO_PREFIX = 'EscherPSO_'
+SSO_PREFIX = 'EscherSSO_'
+
+def isRemoteEmpty(ob):
+  return ob.type == 'EMPTY' and ob.get('escher_remote_space_name') is not None
+
+def ssoSpaceName(name):
+  '''The space an SSO named name shows; Blender may have added a
+  ".001" style suffix to the name.'''
+  name = name[len(SSO_PREFIX):]
+  base, dot, suffix = name.rpartition('.')
+  return base if dot and suffix.isdigit() else name
+
+class SpaceEntry:
+  '''pso is None if only SSOs name the space.'''
+  __slots__ = ('name', 'pso', 'ssos')
+
+  def __init__(self, name):
+    self.name = name
+    self.pso = None
+    self.ssos = []
+
+class RemoteEntry:
+  '''The remote empties parented to one object. portalIndices maps each
+  portal index they use to its remote; badRemotes lists remotes whose
+  portal index is missing, not an int, or used twice.'''
+  __slots__ = ('remotes', 'portalIndices', 'badRemotes')
+
+  def __init__(self):
+    self.remotes = []
+    self.portalIndices = {}
+    self.badRemotes = []
+
+class SpaceRegistry:
+  def __init__(self):
+    self.spaces = {}
+    self.children = {}
+    self.remotes = {}
+    self.stale = True
+    self.numObjects = None
+
+  def invalidate(self):
+    self.stale = True
+
+  def update(self, objects):
+    '''Rebuilds the registry from objects (e.g. bpy.data.objects) if it is
+    stale or the number of objects changed. Returns self.'''
+    if self.stale or len(objects) != self.numObjects:
+      self.rebuild(objects)
+    return self
+
+  def entry(self, name):
+    entry = self.spaces.get(name)
+    if entry is None:
+      entry = self.spaces[name] = SpaceEntry(name)
+    return entry
+
+  def rebuild(self, objects):
+    self.spaces = {}
+    self.children = {}
+    self.remotes = {}
+    for ob in objects:
+      if ob.name.startswith(PSO_PREFIX):
+        self.entry(ob.name[len(PSO_PREFIX):]).pso = ob
+      elif ob.name.startswith(SSO_PREFIX):
+        self.entry(ssoSpaceName(ob.name)).ssos.append(ob)
+      if ob.parent is None:
+        continue
+      self.children.setdefault(ob.parent.name, []).append(ob)
+      if isRemoteEmpty(ob):
+        entry = self.remotes.get(ob.parent.name)
+        if entry is None:
+          entry = self.remotes[ob.parent.name] = RemoteEntry()
+        entry.remotes.append(ob)
+        n = ob.get('escher_portal_index')
+        if type(n) is not int or n in entry.portalIndices:
+          entry.badRemotes.append(ob)
+        else:
+          entry.portalIndices[n] = ob
+    self.numObjects = len(objects)
+    self.stale = False
+
+  def psoNames(self):
+    return sorted(entry.pso.name for entry in self.spaces.values() if entry.pso is not None)
+
+  def pso(self, spaceName):
+    entry = self.spaces.get(spaceName)
+    return entry.pso if entry is not None else None
+
+  def childrenOf(self, ob):
+    return self.children.get(ob.name, ())
+
+  def remotesOf(self, ob):
+    entry = self.remotes.get(ob.name)
+    return entry.remotes if entry is not None else []
+
+  def unusedPortalIndex(self, ob):
+    '''The lowest portal index not used by the remote empties of ob.'''
+    entry = self.remotes.get(ob.name)
+    if entry is None:
+      return 0
+    for remote in entry.badRemotes:
+      n = remote.get('escher_portal_index')
+      if n is None:
+        raise KeyError("Escher Remote Object should have an 'escher_portal_index' property!")
+      if type(n) is not int:
+        raise TypeError("Escher Remote Object property 'escher_portal_index' is not an int!")
+      raise KeyError("Found duplicate 'escher_portal_index' property among PSO's Remote Objects!")
+    n = 0
+    while n in entry.portalIndices:
+      n += 1
+    return n
+
+  def remoteGraph(self, matrix):
+    '''The remotes of every PSO, for escher_realize.realizeTree(). matrix
+    is called on each remote empty to get its row major matrix.'''
+    return {name: [(eo.get('escher_portal_index', -1), eo['escher_remote_space_name'], matrix(eo))
+      for eo in self.remotesOf(entry.pso)]
+      for name, entry in self.spaces.items() if entry.pso is not None}
+
+  def graphObjects(self, ob, seen=None):
+    '''ob and all of its descendants, leaving out any whose name is in the
+    set seen, and adding the rest to it.'''
+    if seen is None:
+      seen = set()
+    stack = [ob]
+    found = []
+    while stack:
+      o = stack.pop()
+      if o.name in seen:
+        continue
+      seen.add(o.name)
+      found.append(o)
+      stack.extend(self.childrenOf(o))
+    return found
+
+  def focusChanges(self, sceneObjects, pso):
+    '''The (object, hide) changes which leave pso and its descendants the
+    only objects showing of the meshes of the scene and their descendants.
+    Objects already in the wanted state are left out.'''
+    shown = {o.name for o in self.graphObjects(pso)}
+    changes = []
+    seen = set()
+    for root in [pso] + [ob for ob in sceneObjects if ob.type == 'MESH']:
+      for o in self.graphObjects(root, seen):
+        hide = o.name not in shown
+        if o.hide != hide:
+          changes.append((o, hide))
+    return changes
@@ -0,0 +1,238 @@
+# Copyright 2014 Don Viszneki
+# Synthetic Escher maps for testing and benchmarking.
+
+"""
+Generates valid maps of any size without Blender:
+
+  tunnel  an endless tunnel: a ring of tube segments, each joined to the
+          next and the previous by a portal at either end
+  grid    rows x cols box rooms, each joined to its four neighbours by
+          portals in its walls, wrapping around at the edges
+  ngon    flat meshes of dense n-gons, with portals to random spaces
+  floor   flat floors of quads of one material, whose UVs jump at a seam
+          across the middle, as at the edge of a texture atlas island
+
+Every generator also takes the number of materials, UV layers and spawns
+per space. Face and vertex counts follow from the size parameters; the
+generated map's counts are printed by the command line.
+
+Usage: python escher_synth.py tunnel|grid|ngon|floor OUT.esc6 [NAME=VALUE ...]
+NAME is any keyword argument of the generator, e.g. numSpaces=100.
+"""
+import math
+import random
+import sys
+from array import array
+from escher_mesh import MeshArrays
+from escher_map import EscherMap, Material, Remote, Spawn, Space, FACE_MAT, FACE_REMOTE, writeEsc6
+from escher_triangulate import newellNormal
+
+class MeshBuilder:
+  '''Accumulates the vertices and faces of one space.'''
+
+  def __init__(self, numUVLayers):
+    self.verts = array('d')
+    self.loopStarts = array('i')
+    self.loopTotals = array('i')
+    self.loopVerts = array('i')
+    self.uvLayers = [array('d') for i in range(numUVLayers)]
+    self.loopNormals = array('d')
+    self.faceKinds = array('b')
+    self.faceIds = array('i')
+
+  def addVert(self, co):
+    self.verts.extend(co)
+    return len(self.verts) // 3 - 1
+
+  def addFace(self, indices, kind, faceId, uOffset=0.0):
+    '''Adds a flat shaded face, with uOffset added to its u coordinates.
+    Its normal points the way it winds counterclockwise, which is the
+    side it is seen from.'''
+    points = [self.verts[3*vi:3*vi+3] for vi in indices]
+    nx, ny, nz = newellNormal(points)
+    length = math.sqrt(nx*nx + ny*ny + nz*nz) or 1.0
+    self.loopStarts.append(len(self.loopVerts))
+    self.loopTotals.append(len(indices))
+    self.loopVerts.extend(indices)
+    for p in points:
+      for layer, uvs in enumerate(self.uvLayers):
+        u = -(p[0] + p[1]) / (layer + 1)
+        uvs.extend((u + uOffset if uOffset else u, -(p[2] + p[1]) / (layer + 1)))
+      self.loopNormals.extend((nx / length, ny / length, nz / length))
+    self.faceKinds.append(kind)
+    self.faceIds.append(faceId)
+
+  def space(self, name, remotes, spawns):
+    mesh = MeshArrays(self.verts, self.loopStarts, self.loopTotals, self.loopVerts,
+      self.uvLayers, self.loopNormals, None)
+    return Space(name, mesh, self.faceKinds, self.faceIds, remotes, spawns)
+
+def addMaterials(escherMap, numMaterials):
+  for i in range(numMaterials):
+    textures = [('COLOR', 'synth%d.png' % i)] if i % 2 else []
+    escherMap.addMaterial(Material('SynthMat%d' % i, textures))
+
+def makeSpawns(iSpace, numSpawns, center, extent, rng):
+  '''A player in space 0, and spikeys on short paths everywhere else.'''
+  spawns = []
+  for i in range(numSpawns):
+    p = tuple(c + rng.uniform(-e, e) for c, e in zip(center, extent))
+    if iSpace == 0 and i == 0:
+      spawns.append(Spawn('player', p, (0.0, 0.0, 0.0)))
+      continue
+    path = array('d')
+    for j in range(4):
+      path.extend(c + rng.uniform(-e, e) for c, e in zip(center, extent))
+    spawns.append(Spawn('spikey', p, (0.0, rng.uniform(-math.pi, math.pi), 0.0), path))
+  return spawns
+
+def tunnelMap(numSpaces=16, sides=12, rings=8, length=8.0, radius=2.0, numMaterials=2,
+    numUVLayers=1, numSpawns=1, seed=0):
+  '''numSpaces tube segments of rings x sides wall quads, each capped by a
+  portal to the previous segment at z = 0 and to the next at z = length.'''
+  rng = random.Random(seed)
+  escherMap = EscherMap()
+  addMaterials(escherMap, numMaterials)
+  for iSpace in range(numSpaces):
+    mb = MeshBuilder(numUVLayers)
+    ring = [[mb.addVert((radius * math.cos(2 * math.pi * i / sides),
+      radius * math.sin(2 * math.pi * i / sides), length * r / rings)) for i in range(sides)]
+      for r in range(rings + 1)]
+    for r in range(rings):
+      for i in range(sides):
+        j = (i + 1) % sides
+        mb.addFace([ring[r][i], ring[r+1][i], ring[r+1][j], ring[r][j]], FACE_MAT, r % numMaterials)
+    mb.addFace(ring[0], FACE_REMOTE, 0)
+    mb.addFace(ring[rings][::-1], FACE_REMOTE, 1)
+    remotes = [
+      Remote((iSpace - 1) % numSpaces, (0.0, 0.0, -length), (0.0, 0.0, 0.0)),
+      Remote((iSpace + 1) % numSpaces, (0.0, 0.0, length), (0.0, 0.0, 0.0)),
+    ]
+    spawns = makeSpawns(iSpace, numSpawns, (0, 0, length / 2), (radius / 2, radius / 2, length / 2), rng)
+    escherMap.addSpace(mb.space('Tunnel%d' % iSpace, remotes, spawns))
+  return escherMap
+
+def gridMap(rows=8, cols=8, size=8.0, height=4.0, subdivisions=4, numMaterials=2,
+    numUVLayers=1, numSpawns=1, seed=0):
+  '''rows x cols box rooms with floors and ceilings of subdivisions x
+  subdivisions quads. Each wall is a portal to the neighbouring room.'''
+  rng = random.Random(seed)
+  escherMap = EscherMap()
+  addMaterials(escherMap, numMaterials)
+  for row in range(rows):
+    for col in range(cols):
+      iSpace = row * cols + col
+      mb = MeshBuilder(numUVLayers)
+      step = size / subdivisions
+      for y, flip in ((0.0, False), (height, True)):
+        grid = [[mb.addVert((i * step, y, j * step)) for j in range(subdivisions + 1)]
+          for i in range(subdivisions + 1)]
+        for i in range(subdivisions):
+          for j in range(subdivisions):
+            quad = [grid[i][j], grid[i][j+1], grid[i+1][j+1], grid[i+1][j]]
+            mb.addFace(quad[::-1] if flip else quad, FACE_MAT, (i + j) % numMaterials)
+      corners = [mb.addVert((x, y, z)) for x in (0.0, size) for y in (0.0, height) for z in (0.0, size)]
+      # Corner index bits are x, y, z; walls face into the room
+      for remoteId, wall in enumerate(((5, 7, 6, 4), (2, 3, 1, 0), (3, 7, 5, 1), (4, 6, 2, 0))):
+        mb.addFace([corners[c] for c in wall], FACE_REMOTE, remoteId)
+      remotes = [
+        Remote(row * cols + (col + 1) % cols, (size, 0.0, 0.0), (0.0, 0.0, 0.0)),
+        Remote(row * cols + (col - 1) % cols, (-size, 0.0, 0.0), (0.0, 0.0, 0.0)),
+        Remote((row + 1) % rows * cols + col, (0.0, 0.0, size), (0.0, 0.0, 0.0)),
+        Remote((row - 1) % rows * cols + col, (0.0, 0.0, -size), (0.0, 0.0, 0.0)),
+      ]
+      spawns = makeSpawns(iSpace, numSpawns, (size / 2, height / 2, size / 2),
+        (size / 2, height / 4, size / 2), rng)
+      escherMap.addSpace(mb.space('Room%d_%d' % (row, col), remotes, spawns))
+  return escherMap
+
+def ngonMap(numSpaces=4, numFaces=10000, sides=8, numRemotes=4, numMaterials=8,
+    numUVLayers=1, numSpawns=4, seed=0):
+  '''numSpaces flat meshes of numFaces faces with sides corners each (rounded
+  down to an even number, at least 4), laid out in rows of strips which
+  share their edges. The last numRemotes faces are portals to random spaces.'''
+  rng = random.Random(seed)
+  numRemotes = min(numRemotes, numFaces)
+  escherMap = EscherMap()
+  addMaterials(escherMap, numMaterials)
+  cellsPerFace = max(1, (sides - 2) // 2)
+  facesPerRow = max(1, int(math.sqrt(numFaces / cellsPerFace)))
+  for iSpace in range(numSpaces):
+    mb = MeshBuilder(numUVLayers)
+    numRows = -(-numFaces // facesPerRow)
+    width = facesPerRow * cellsPerFace
+    grid = [[mb.addVert((float(i), 0.0, float(j))) for j in range(width + 1)] for i in range(numRows + 1)]
+    for iFace in range(numFaces):
+      i, j0 = divmod(iFace, facesPerRow)
+      j0 *= cellsPerFace
+      # Along one side of the strip and back along the other
+      indices = [grid[i][j] for j in range(j0, j0 + cellsPerFace + 1)]
+      indices += [grid[i+1][j] for j in range(j0 + cellsPerFace, j0 - 1, -1)]
+      remoteId = iFace - (numFaces - numRemotes)
+      if remoteId >= 0:
+        mb.addFace(indices, FACE_REMOTE, remoteId)
+      else:
+        mb.addFace(indices, FACE_MAT, rng.randrange(numMaterials))
+    remotes = [Remote(rng.randrange(numSpaces), tuple(rng.uniform(-10, 10) for k in range(3)),
+      tuple(rng.uniform(-math.pi, math.pi) for k in range(3))) for r in range(numRemotes)]
+    spawns = makeSpawns(iSpace, numSpawns, (numRows / 2, 1.0, width / 2), (numRows / 2, 0.5, width / 2), rng)
+    escherMap.addSpace(mb.space('Ngon%d' % iSpace, remotes, spawns))
+  return escherMap
+
+def floorMap(numSpaces=1, size=10, seamAt=5, seamOffset=100.0, numMaterials=1,
+    numUVLayers=1, numSpawns=1, seed=0):
+  '''numSpaces floors of size x size unit quads, all of material 0. The
+  quads from x = seamAt on have seamOffset added to their u coordinates,
+  so the vertices at x = seamAt are on a UV seam.'''
+  rng = random.Random(seed)
+  escherMap = EscherMap()
+  addMaterials(escherMap, numMaterials)
+  for iSpace in range(numSpaces):
+    mb = MeshBuilder(numUVLayers)
+    grid = [[mb.addVert((float(i), 0.0, float(j))) for j in range(size + 1)] for i in range(size + 1)]
+    for i in range(size):
+      for j in range(size):
+        mb.addFace([grid[i][j], grid[i][j+1], grid[i+1][j+1], grid[i+1][j]], FACE_MAT, 0,
+          seamOffset if i >= seamAt else 0.0)
+    spawns = makeSpawns(iSpace, numSpawns, (size / 2, 1.0, size / 2), (size / 2, 0.5, size / 2), rng)
+    escherMap.addSpace(mb.space('Floor%d' % iSpace, [], spawns))
+  return escherMap
+
+generators = {'tunnel': tunnelMap, 'grid': gridMap, 'ngon': ngonMap, 'floor': floorMap}
+
+def parseParams(generator, args):
+  '''Keyword arguments for generator from NAME=VALUE strings, each value
+  converted to the type of the parameter's default.'''
+  defaults = dict(zip(generator.__code__.co_varnames[:generator.__code__.co_argcount],
+    generator.__defaults__))
+  params = {}
+  for arg in args:
+    name, sep, value = arg.partition('=')
+    if not sep or name not in defaults:
+      raise ValueError('%s takes %s' % (generator.__name__, ', '.join(sorted(defaults))))
+    params[name] = type(defaults[name])(value)
+  return params
+
+def mapCounts(escherMap):
+  spaces = escherMap.spaces
+  return {
+    'spaces': len(spaces),
+    'verts': sum(space.numVerts for space in spaces),
+    'faces': sum(space.numFaces for space in spaces),
+    'loops': sum(len(space.mesh.loopVerts) for space in spaces),
+    'remotes': sum(len(space.remotes) for space in spaces),
+    'spawns': sum(len(space.spawns) for space in spaces),
+    'materials': len(escherMap.materials),
+  }
+
+if __name__ == '__main__':
+  if len(sys.argv) < 3 or sys.argv[1] not in generators:
+    sys.exit(__doc__.split('Usage: ')[1])
+  try:
+    params = parseParams(generators[sys.argv[1]], sys.argv[3:])
+  except ValueError as e:
+    sys.exit(str(e))
+  escherMap = generators[sys.argv[1]](**params)
+  with open(sys.argv[2], 'w') as out:
+    writeEsc6(escherMap, out)
+  print(', '.join('%d %s' % (n, what) for what, n in mapCounts(escherMap).items()))
@@ -0,0 +1,81 @@
+# Copyright 2014 Don Viszneki
+# Times the polls behind the Escher Tools panel on edit meshes of growing size.
+
+"""
+Blender calls the poll() of every operator in the Escher Tools panel each
+time it redraws the panel. This builds grid meshes of each number of
+faces, enters edit mode with half of the faces selected, and times one
+panel's worth of polls, next to the old Portalize poll, which built a
+list of the selected faces. The time per redraw of the panel should not
+grow with the number of faces.
+
+Must be run by Blender:
+Usage: blender --background --factory-startup --python escher_tools_bench.py -- [FACES ...]
+"""
+import bmesh
+import bpy
+import imp
+import sys
+import time
+from os.path import dirname, join
+
+DEFAULT_FACES = (100, 10000, 250000)
+
+def scanPoll(cx):
+  '''Portalize's poll before it counted selected faces with total_face_sel.'''
+  if cx.mode == 'EDIT_MESH' and cx.object and cx.object.type == 'MESH' and cx.object.select:
+    bm = bmesh.from_edit_mesh(cx.object.data)
+    return len(list(filter(lambda fa: fa.select, bm.faces))) > 0
+  return False
+
+def panelPolls(tools):
+  '''The poll of each Escher Tools operator, as the panel's redraw calls them.'''
+  polls = []
+  for name in dir(tools):
+    cls = getattr(tools, name)
+    if isinstance(cls, type) and issubclass(cls, bpy.types.Operator) and 'poll' in cls.__dict__:
+      polls.append(cls.poll)
+  return polls
+
+def makeGridObject(numFaces):
+  side = max(1, int(numFaces ** 0.5))
+  bm = bmesh.new()
+  bmesh.ops.create_grid(bm, x_segments=side, y_segments=side, size=1.0)
+  for i, fa in enumerate(bm.faces):
+    fa.select = i % 2 == 0
+  me = bpy.data.meshes.new('BenchMesh')
+  bm.to_mesh(me)
+  bm.free()
+  ob = bpy.data.objects.new('BenchObject', me)
+  bpy.context.scene.objects.link(ob)
+  bpy.context.scene.objects.active = ob
+  ob.select = True
+  return ob
+
+def timeCalls(fns, cx, repeat):
+  t0 = time.perf_counter()
+  for i in range(repeat):
+    for fn in fns:
+      fn(cx)
+  return (time.perf_counter() - t0) / repeat
+
+def benchFaces(tools, numFaces, repeat=200):
+  ob = makeGridObject(numFaces)
+  bpy.ops.object.mode_set(mode='EDIT')
+  cx = bpy.context
+  result = (len(ob.data.polygons), timeCalls(panelPolls(tools), cx, repeat),
+    timeCalls([scanPoll], cx, max(1, repeat // 20)))
+  bpy.ops.object.mode_set(mode='OBJECT')
+  bpy.context.scene.objects.unlink(ob)
+  me = ob.data
+  bpy.data.objects.remove(ob)
+  bpy.data.meshes.remove(me)
+  return result
+
+if __name__ == '__main__':
+  args = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else []
+  tools = imp.load_source('escher_tools', join(dirname(__file__), 'escher-tools.py'))
+  print('%10s %16s %16s' % ('faces', 'panel polls', 'old scan poll'))
+  for numFaces in [int(arg) for arg in args] or DEFAULT_FACES:
+    faces, polls, scan = benchFaces(tools, numFaces)
+    print('%10d %13.1f us %13.1f us' % (faces, polls * 1e6, scan * 1e6))
@@ -0,0 +1,120 @@
+# Copyright 2014 Don Viszneki
+# Export-time triangulation of Escher spaces (TODO item 8).
+
+"""
+Replaces every face of a space with triangles, so the game never has to
+triangulate at load time. Convex and concave faces alike are split by ear
+clipping in the plane of the face. Each triangle keeps the UVs and normals
+of the corners it came from, the material or remote of its face, and the
+index of that face, which is written out as "source N" after the vertex
+data of each face. The game's loader ignores it.
+"""
+from array import array
+
+def newellNormal(points):
+  '''Normal of a (possibly non-planar) polygon given as a list of xyz.'''
+  nx = ny = nz = 0.0
+  for i in range(len(points)):
+    x0, y0, z0 = points[i - 1]
+    x1, y1, z1 = points[i]
+    nx += (y0 - y1) * (z0 + z1)
+    ny += (z0 - z1) * (x0 + x1)
+    nz += (x0 - x1) * (y0 + y1)
+  return nx, ny, nz
+
+def projectPolygon(points):
+  '''Drops the axis the polygon faces most, returning 2D points which wind
+  counterclockwise if the polygon winds counterclockwise about its normal.'''
+  nx, ny, nz = newellNormal(points)
+  ax, ay, az = abs(nx), abs(ny), abs(nz)
+  if az >= ax and az >= ay:
+    return [(p[0], p[1]) for p in points] if nz >= 0 else [(p[1], p[0]) for p in points]
+  if ay >= ax:
+    return [(p[2], p[0]) for p in points] if ny >= 0 else [(p[0], p[2]) for p in points]
+  return [(p[1], p[2]) for p in points] if nx >= 0 else [(p[2], p[1]) for p in points]
+
+def cross2(a, b, c):
+  return (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])
+
+def pointInTriangle(p, a, b, c):
+  return cross2(a, b, p) >= 0 and cross2(b, c, p) >= 0 and cross2(c, a, p) >= 0
+
+def triangulatePolygon(points):
+  '''Ear clips a polygon given as a list of xyz points. Returns a list of
+  (i, j, k) corner index triples which keep the polygon's winding.'''
+  n = len(points)
+  if n == 3:
+    return [(0, 1, 2)]
+  pts = projectPolygon(points)
+  remaining = list(range(n))
+  tris = []
+  while len(remaining) > 3:
+    m = len(remaining)
+    ear = None
+    for i in range(m):
+      a, b, c = remaining[i - 1], remaining[i], remaining[(i + 1) % m]
+      pa, pb, pc = pts[a], pts[b], pts[c]
+      if cross2(pa, pb, pc) <= 0:
+        continue  # reflex or degenerate corner
+      if any(pointInTriangle(pts[r], pa, pb, pc) for r in remaining if r not in (a, b, c)):
+        continue
+      ear = i
+      break
+    if ear is None:
+      # Self-intersecting or degenerate: clip the most convex corner and go on
+      ear = max(range(m), key=lambda i: cross2(pts[remaining[i - 1]], pts[remaining[i]],
+        pts[remaining[(i + 1) % m]]))
+    tris.append((remaining[ear - 1], remaining[ear], remaining[(ear + 1) % m]))
+    del remaining[ear]
+  tris.append(tuple(remaining))
+  return tris
+
+def triangulateSpace(space):
+  '''Triangulates space in place. space.sourceFaces is set to the index of
+  the original face of every triangle.'''
+  mesh = space.mesh
+  verts = mesh.verts
+  loopVerts = array('i')
+  uvLayers = [array(uvs.typecode) for uvs in mesh.uvLayers]
+  loopNormals = array(mesh.loopNormals.typecode)
+  faceKinds = array(space.faceKinds.typecode)
+  faceIds = array(space.faceIds.typecode)
+  sourceFaces = array('i')
+  oldSources = space.sourceFaces
+  materialIndices = array('i') if mesh.materialIndices is not None else None
+
+  for iFace, (start, total) in enumerate(zip(mesh.loopStarts, mesh.loopTotals)):
+    loops = range(start, start + total)
+    if total == 3:
+      tris = [(0, 1, 2)]
+    else:
+      points = [verts[3*mesh.loopVerts[li]:3*mesh.loopVerts[li]+3] for li in loops]
+      tris = triangulatePolygon(points)
+    for tri in tris:
+      for corner in tri:
+        li = loops[corner]
+        loopVerts.append(mesh.loopVerts[li])
+        for uvs, newUVs in zip(mesh.uvLayers, uvLayers):
+          newUVs.extend(uvs[2*li:2*li+2])
+        loopNormals.extend(mesh.loopNormals[3*li:3*li+3])
+      faceKinds.append(space.faceKinds[iFace])
+      faceIds.append(space.faceIds[iFace])
+      sourceFaces.append(oldSources[iFace] if oldSources is not None else iFace)
+      if materialIndices is not None:
+        materialIndices.append(mesh.materialIndices[iFace])
+
+  numTris = len(sourceFaces)
+  mesh.loopStarts = array('i', range(0, 3 * numTris, 3))
+  mesh.loopTotals = array('i', [3]) * numTris
+  mesh.loopVerts = loopVerts
+  mesh.uvLayers = uvLayers
+  mesh.loopNormals = loopNormals
+  mesh.materialIndices = materialIndices
+  space.faceKinds = faceKinds
+  space.faceIds = faceIds
+  space.sourceFaces = sourceFaces
+
+def triangulateMap(escherMap):
+  '''Triangulates every space of escherMap in place.'''
+  for space in escherMap.spaces:
+    triangulateSpace(space)
@@ -20,10 +20,35 @@ Copyright 2013 Don Viszneki <don@codebad.com> all rights reserved.
 
 """
 import bpy
+import multiprocessing
+import sys
 from bpy_extras.io_utils import ExportHelper
 from bpy.props import StringProperty
+from array import array
 from collections import OrderedDict
-from os.path import basename
+from os.path import basename, dirname, getsize, splitext
+
+# The bpy-independent parts of the exporter live in escher_*.py beside this file
+if dirname(__file__) not in sys.path:
+  sys.path.append(dirname(__file__))
+from escher_mesh import extractMesh, foreachGet
+from escher_map import EscherMap, IndexTable, Material, Remote, Spawn, Space, \
+    FACE_MAT, FACE_REMOTE, formatSpaces, writeEsc6
+from escher_binary import writeEscb
+from escher_chunks import writeEscz
+from escher_quantize import Quantization
+from escher_cache import SpaceCache, cachedSpaceBlocks
+from escher_triangulate import triangulateMap
+from escher_collision import buildPlaneTable
+from escher_gpu import buildGPUBuffers
+from escher_portals import buildPVS, portalFaces
+from escher_bvh import buildBVH
+from escher_cull import buildRemoteBounds
+from escher_lod import buildLODs, levelRatios
+from escher_paths import buildPathTables, shapePath
+from escher_profile import ExportProfile, NULL_PROFILE, profiledSpaceBlocks
+from escher_lint import errors, formatProblem, lintMap, lintRemoteObjects
+from escher_match import matchPortals, matchProblems
 
 def getDiffuseColorString(mat):
     c = mat.diffuse_color
@@ -101,43 +126,11 @@ def objectIsRemote(o):
 def objectIsSpawn(o):
   return o.type == 'EMPTY' and not o.name.startswith('EscherRemote') and o.escherSpawn
 
-def vec3toStr(v):
-  return '%s %s %s' % (repr(-v.x), repr(v.z), repr(v.y))
+def escherVec3(v):
+  return (-v.x, v.z, v.y)
 
-def euler2str(v):
-  return '%s %s %s' % (repr(v.x), repr(v.z), repr(v.y))
-
-class SuperMap:
-  def __init__(self):
-    self.keys = []
-    self.values = {}
-  def __getitem__(self, k): 
-    if type(k) is str:
-      return self.values[k]
-    else:
-      return self.values[self.keys[k]]
-  def __setitem__(self, k, v): 
-    if type(k) is not str:
-      raise TypeError('Invalid key type')
-    self.keys.append(k)
-    self.values[k] = v 
-  def __iter__(self):
-    return SuperMapIterator(self)
-  def __len__(self):
-    return len(self.keys)
-  def str2int(self, k):
-    return self.keys.index(k)
-
-class SuperMapIterator:
-  def __init__(self, supermap):
-    self.supermap = supermap
-    self.n = 0 
-  def __next__(self):
-    n = self.n
-    if n >= len(self.supermap):
-      raise StopIteration()
-    self.n += 1
-    return self.supermap[n]
+def escherEuler(v):
+  return (v.x, v.z, v.y)
 
 def texSlot2texMapType(s):
   # TODO TODO TODO TODO TODO
@@ -147,107 +140,299 @@ def texSlot2texMapType(s):
     return 'NORMAL'
   return 'NONE'
 
-def escherExport(operator, materials, objects, scene, filename):
-  mats = SuperMap()
-  for mat in materials:
-    if not mat.name.startswith('EscherPortalMaterial') and not mat.ESCHERIGNORE:
-      mats[mat.name] = mat
-
-  PSOs = SuperMap()
-  # TODO enumerate scene.objects instead? might be faster
-  for ob in objects:
-    obClass = classifyObName(ob.name)
-    if obClass == 'PSO':
-      if ob.type != 'MESH':
-        raise Exception('PSO type is not MESH')
-      PSOs[unqualifyObName(ob.name)] = ob
-
-  out = open(filename, 'w')
-  out.write('escher version 6\n')
-  out.write('nummaterials %d\n' % len(mats))
-
-  for imat, mat in enumerate(mats):
-    try:
-      texSlots = list(filter(lambda t:t is not None, mat.texture_slots))
-      out.write('material %d "%s" numtex %d\n' % (imat, mat.name, len(texSlots)))
-      for iTexSlot, texSlot in enumerate(texSlots):
-        texMapType = texSlot2texMapType(texSlot)
-        textureFilePath = mat.texture_slots[iTexSlot].texture.image.filepath
-        out.write('texture %s %s\n' % (texMapType, basename(textureFilePath)))
-    except:
-      print('escher export: Could not process material "%s"' % mat.name)
-      operator.report({'WARNING'}, 'Could not process material "%s"' % mat.name)
-      raise
-
-  out.write('numspaces %d\n' % len(PSOs))
-  for iPSO, PSO in enumerate(PSOs):
-    me = PSO.data
-    remotes = list(filter(objectIsRemote, PSO.children))
-    spawns = list(filter(objectIsSpawn, PSO.children))
-    # Write "space" command
-    out.write('space %d numverts %d numfaces %d numremotes %d numspawns %d\n' %
-      (iPSO, len(me.vertices), len(me.polygons), len(remotes), len(spawns)))
-    # Write "remote" commands
-    for iRemote, remote in enumerate(remotes):
-      remoteSpaceName = remote['escher_remote_space_name']
-      if remoteSpaceName == '*none*':
-        remoteIndex = -1
-      else:
-        remoteIndex = PSOs.str2int(remoteSpaceName)
-      translation = vec3toStr(remote.location)
-      orientation = euler2str(remote.rotation_euler)
-      out.write('remote %d space %d translation %s orientation %s\n' % (iRemote, remoteIndex, translation, orientation))
-    # Write "spawn" commands
-    for iSpawn, spawn in enumerate(spawns):
-      spawnType = spawn.escherSpawn
-      translation = vec3toStr(spawn.location)
-      orientation = euler2str(spawn.rotation_euler)
-      # Does this spawner have a path for its entity to follow?
-      spawnerPaths = list(filter(lambda ob:isPathName(ob.name), spawn.children))
-      spawnerPathParam = ''
-      if len(spawnerPaths) > 1:
-        raise Exception('multiple paths per spawner not supported!')
-      elif len(spawnerPaths) == 1:
+def buildMap(operator, materials, objects, scene, profile=NULL_PROFILE, pathSpacing=0.0,
+    smoothPaths=False, closePaths=False):
+  '''Collects everything escherExport writes into an EscherMap.
+  This is the only part of the export which touches Blender data.
+  Spawner paths are shaped as evaluatePaths() describes.'''
+  escherMap = EscherMap()
+  with profile.phase('material scan'):
+    for mat in materials:
+      if not mat.name.startswith('EscherPortalMaterial') and not mat.ESCHERIGNORE:
         try:
-          # Grab path mesh
-          pathMe = getMeshFromObject(scene, spawnerPaths[0], 'PREVIEW')
-          if len(pathMe.polygons) != 1:
-            raise Exception('spawner path has %d faces, only 1 is supported' % len(pathMe).polgons)
-          spawnerPathParam = ' path'
-          for v in pathMe.polygons[0].vertices:
-            spawnerPathParam += ' ' + vec3toStr(pathMe.vertices[v].co)
-        finally:
-          bpy.data.meshes.remove(pathMe)
-      out.write('spawn %d translation %s orientation %s params %s%s\n' %
-        (iSpawn, translation, orientation, spawnType, spawnerPathParam))
-    # Write "vert" commands
-    for vi, v in enumerate(me.vertices):
-      out.write('vert %d %f %f %f\n' %
-        (vi, -v.co.x, v.co.z, v.co.y))
-    # Write "face" commands
-    for ipg, pg, in enumerate(me.polygons):
-      matName = PSO.material_slots[pg.material_index].material.name
-      if isPortalMaterialName(matName):
-        faceClass = 'remote %d' % portalMaterialName2remoteIndex(matName)
-      else:
-        faceClass = 'mat %d' % mats.str2int(matName)
-      out.write('face %d %s vdata %d' % (ipg, faceClass, pg.loop_total))
-      for li in pg.loop_indices:
-        vi = me.loops[li].vertex_index
-        # Write vertex index
-        out.write(' %d' % vi)
-        # Write vertex UVs
-        for uvlayer in me.uv_layers:
-          uv = -uvlayer.data[li].uv
-          out.write(' %f %f' % (uv.x, uv.y))
-        # Write normals
-        if pg.use_smooth:
-          normal = me.vertices[vi].normal
-        else:
-          normal = pg.normal
-        out.write(' %f %f %f' % (-normal.x, normal.z, normal.y))
-      out.write('\n')
-  out.close()
+          texSlots = list(filter(lambda t:t is not None, mat.texture_slots))
+          textures = []
+          for iTexSlot, texSlot in enumerate(texSlots):
+            texMapType = texSlot2texMapType(texSlot)
+            textureFilePath = mat.texture_slots[iTexSlot].texture.image.filepath
+            textures.append((texMapType, basename(textureFilePath)))
+          escherMap.addMaterial(Material(mat.name, textures))
+        except:
+          print('escher export: Could not process material "%s"' % mat.name)
+          operator.report({'WARNING'}, 'Could not process material "%s"' % mat.name)
+          raise
+
+  PSOs = []
+  with profile.phase('PSO classification'):
+    # TODO enumerate scene.objects instead? might be faster
+    for ob in objects:
+      obClass = classifyObName(ob.name)
+      if obClass == 'PSO':
+        if ob.type != 'MESH':
+          raise Exception('PSO type is not MESH')
+        PSOs.append(ob)
+    # Remotes may refer to spaces which come later, so index them all first
+    spaceNames = IndexTable(unqualifyObName(PSO.name) for PSO in PSOs)
+  with profile.phase('path evaluation'):
+    paths = evaluatePaths(PSOs, scene, pathSpacing, smoothPaths, closePaths)
+
+  for PSO in PSOs:
+    spaceName = unqualifyObName(PSO.name)
+    with profile.phase('remote and spawn evaluation', spaceName):
+      remotes, spawns = evaluateChildren(PSO, spaceNames, paths)
+    with profile.phase('space extraction', spaceName, hot=True):
+      mesh, faceKinds, faceIds = extractSpaceMesh(PSO, escherMap)
+    escherMap.addSpace(Space(spaceName, mesh, faceKinds, faceIds, remotes, spawns))
+  return escherMap
+
+def spawnerPath(spawn):
+  '''The path object of a spawner, or None if it has none.'''
+  spawnerPaths = list(filter(lambda ob:isPathName(ob.name), spawn.children))
+  if len(spawnerPaths) > 1:
+    raise Exception('multiple paths per spawner not supported!')
+  return spawnerPaths[0] if spawnerPaths else None
+
+def evaluatePaths(PSOs, scene, spacing=0.0, smooth=False, closed=False):
+  '''Evaluates the path of every spawner of the PSOs in one batch, each
+  path object once. Returns each path object's flat xyz path by name,
+  shaped by escher_paths.shapePath() if spacing, smooth or closed is set.'''
+  paths = {}
+  meshes = []
+  try:
+    for PSO in PSOs:
+      for spawn in filter(objectIsSpawn, PSO.children):
+        pathOb = spawnerPath(spawn)
+        if pathOb is None or pathOb.name in paths:
+          continue
+        pathMe = getMeshFromObject(scene, pathOb, 'PREVIEW')
+        meshes.append(pathMe)
+        if len(pathMe.polygons) != 1:
+          raise Exception('spawner path has %d faces, only 1 is supported' % len(pathMe.polygons))
+        co = foreachGet(pathMe.vertices, 'co', 'f', 3)
+        path = array('d')
+        for v in pathMe.polygons[0].vertices:
+          path.extend((-co[3*v], co[3*v+2], co[3*v+1]))
+        if spacing > 0 or smooth or closed:
+          path = shapePath(path, spacing, smooth, closed)
+        paths[pathOb.name] = path
+  finally:
+    for me in meshes:
+      bpy.data.meshes.remove(me)
+  return paths
+
+def evaluateChildren(PSO, spaceNames, paths):
+  '''Returns the remotes and spawns of a PSO. paths holds the paths
+  evaluatePaths() found.'''
+  remotes = []
+  for remote in filter(objectIsRemote, PSO.children):
+    remoteSpaceName = remote['escher_remote_space_name']
+    if remoteSpaceName == '*none*':
+      remoteIndex = -1
+    else:
+      remoteIndex = spaceNames.index(remoteSpaceName)
+    remotes.append(Remote(remoteIndex, escherVec3(remote.location), escherEuler(remote.rotation_euler)))
+
+  spawns = []
+  for spawn in filter(objectIsSpawn, PSO.children):
+    # Does this spawner have a path for its entity to follow?
+    pathOb = spawnerPath(spawn)
+    path = None if pathOb is None else paths[pathOb.name]
+    spawns.append(Spawn(spawn.escherSpawn, escherVec3(spawn.location), escherEuler(spawn.rotation_euler), path))
+  return remotes, spawns
+
+def extractSpaceMesh(PSO, escherMap):
+  '''Returns the mesh arrays of a PSO and the kind and material or remote
+  index of each of its faces.'''
+  # Resolve each material slot in use to a material or remote index once,
+  # rather than once per face
+  mesh = extractMesh(PSO.data)
+  slotClasses = {}
+  for mai in set(mesh.materialIndices):
+    matName = PSO.material_slots[mai].material.name
+    if isPortalMaterialName(matName):
+      slotClasses[mai] = (FACE_REMOTE, portalMaterialName2remoteIndex(matName))
+    else:
+      slotClasses[mai] = (FACE_MAT, escherMap.materialNames.index(matName))
+  faceKinds = array('b', (slotClasses[mai][0] for mai in mesh.materialIndices))
+  faceIds = array('i', (slotClasses[mai][1] for mai in mesh.materialIndices))
+  return mesh, faceKinds, faceIds
+
+def lintRemoteEmpties(objects):
+  '''Lints the remote empties of every PSO, as evaluateChildren() reads them.'''
+  PSOs = [ob for ob in objects if classifyObName(ob.name) == 'PSO']
+  spaceNames = set(unqualifyObName(PSO.name) for PSO in PSOs)
+  problems = []
+  for PSO in PSOs:
+    remotes = [(remote.name, remote.get('escher_portal_index'), remote.get('escher_remote_space_name'))
+      for remote in filter(objectIsRemote, PSO.children)]
+    problems.extend(lintRemoteObjects(unqualifyObName(PSO.name), remotes, spaceNames))
+  return problems
+
+def reportLint(operator, problems, lintBlocks, spaceNames=None):
+  '''Prints every problem and reports how many there are. Returns False if
+  the export should stop.'''
+  for problem in problems:
+    print('escher export: ' + formatProblem(problem, spaceNames))
+  numErrors = len(errors(problems))
+  if numErrors and lintBlocks:
+    operator.report({'ERROR'}, 'Export stopped by %d map errors, the first being %s' %
+      (numErrors, formatProblem(errors(problems)[0], spaceNames)))
+    return False
+  if problems:
+    operator.report({'WARNING'}, 'Map has %d errors and %d warnings; see the console' %
+      (numErrors, len(problems) - numErrors))
+  return True
+
+def escherExport(operator, materials, objects, scene, filename, binary=False, useCache=False, workers=1,
+    triangulate=False, collisionTables=False, gpuBuffers=False, pvsDepth=0,
+    bvh=False, profile=False, useCProfile=False, lint=False, lintBlocks=False, chunked=False,
+    quantizeBits=0, lodLevels=0, pathSpacing=0.0, smoothPaths=False, closePaths=False,
+    pathTables=False, remoteBounds=False):
+  '''Writes the map to filename, and also to a .escb file of the same name
+  if binary is set, and to a .escz file of compressed spaces if chunked
+  is set. With useCache, unchanged spaces are copied from the
+  cache directory filename + ".cache" instead of being formatted again.
+  Spaces are formatted by workers processes (0 for one per CPU). With
+  triangulate, every face is split into triangles first.
+
+  The remaining options add optional per-space sections to the .escb and
+  .escz:
+  collisionTables adds planar collision tables, gpuBuffers adds vertex and
+  index buffers with draw ranges ready to upload, a pvsDepth above 0 adds
+  the spaces visible through up to that many portals, and bvh adds
+  bounding volume hierarchies over the collision triangles. lodLevels adds
+  up to that many decimated levels of detail of each space, each with half
+  the triangles of the one before. A quantizeBits
+  above 0 stores positions quantized to that many bits per axis, and UVs
+  and normals in 16 bits, reporting the largest errors in each space.
+  pathTables adds the cumulative length tables of spawner paths, and
+  remoteBounds the merged portal polygons, planes and bounding volumes of
+  each remote.
+
+  Spawner paths are smoothed with smoothPaths, closed into loops with
+  closePaths, and resampled every pathSpacing along their length if it
+  is above 0.
+
+  With profile, the time taken by each phase and space and the sizes of
+  the map are written to a .profile.json file of the same name, and
+  summed up in a report. useCProfile also runs the hot loops under
+  cProfile, saving the statistics to a .profile.prof file.
+
+  With lint, the remote empties and then the map are checked with
+  escher_lint first, and portals which do not line up with their
+  counterparts are found by escher_match. If lintBlocks is also set,
+  errors stop the export.
+  Returns whether the map was written.'''
+  prof = ExportProfile(useCProfile) if profile else NULL_PROFILE
+  if lint:
+    with prof.phase('lint'):
+      problems = lintRemoteEmpties(objects)
+    if not reportLint(operator, problems, lintBlocks):
+      return False
+  escherMap = buildMap(operator, materials, objects, scene, prof, pathSpacing, smoothPaths, closePaths)
+  if lint:
+    with prof.phase('lint'):
+      problems = lintMap(escherMap) + matchProblems(matchPortals(escherMap))
+    if not reportLint(operator, problems, lintBlocks, escherMap.spaceNames):
+      return False
+  if triangulate:
+    with prof.phase('triangulation', hot=True):
+      triangulateMap(escherMap)
+  prof.countMap(escherMap)
+  if workers != 1:
+    # Where worker processes are spawned rather than forked, they must run
+    # Blender's Python and not another Blender
+    multiprocessing.set_executable(bpy.app.binary_path_python)
+  if prof.enabled and workers == 1 and not useCache:
+    spaceBlocks = profiledSpaceBlocks(escherMap, prof)
+  elif useCache:
+    spaceBlocks, rebuilt = cachedSpaceBlocks(escherMap, SpaceCache(filename + '.cache'), workers, prof)
+    names = ', '.join(escherMap.spaces[i].name for i in rebuilt)
+    print('escher export: rebuilt %d of %d spaces: %s' % (len(rebuilt), len(escherMap.spaces), names))
+    operator.report({'INFO'}, 'Rebuilt %d of %d spaces%s' %
+      (len(rebuilt), len(escherMap.spaces), ': ' + names if names else ''))
+  else:
+    with prof.phase('space formatting', hot=True):
+      spaceBlocks = formatSpaces(escherMap, workers=workers)
+  if prof.enabled and workers != 1:
+    prof.note('No per-space vert and face timings: spaces were formatted by %s worker processes' %
+      (workers if workers else 'all available'))
+  with prof.phase('esc6 writing'):
+    with open(filename, 'w') as out:
+      writeEsc6(escherMap, out, spaceBlocks)
+  if binary or chunked:
+    sectionMakers = []
+    if collisionTables:
+      sectionMakers.append(lambda iSpace, space: buildPlaneTable(space).sections())
+    if gpuBuffers:
+      sectionMakers.append(lambda iSpace, space: buildGPUBuffers(space).sections())
+    if pvsDepth > 0:
+      portals = [portalFaces(space) for space in escherMap.spaces]
+      sectionMakers.append(lambda iSpace, space:
+        buildPVS(escherMap, iSpace, pvsDepth, portals).sections())
+    if bvh:
+      sectionMakers.append(lambda iSpace, space: buildBVH(space).sections())
+    if lodLevels > 0:
+      ratios = levelRatios(lodLevels)
+      def lodSections(iSpace, space):
+        levels = buildLODs(space, ratios)
+        if levels:
+          print('escher export: space %s levels of detail: %s' % (space.name, ', '.join(
+            '%d faces with error %.3g' % (level.space.numFaces, level.error) for level in levels)))
+        if len(levels) < len(ratios):
+          print('escher export: space %s could not be decimated past level %d of %d' %
+            (space.name, len(levels), len(ratios)))
+        return [section for level in levels for section in level.sections()]
+      sectionMakers.append(lodSections)
+    if pathTables:
+      sectionMakers.append(lambda iSpace, space: buildPathTables(space, pathSpacing > 0).sections())
+    if remoteBounds:
+      sectionMakers.append(lambda iSpace, space: buildRemoteBounds(space).sections())
+    # Written to both files, the sections are only built once
+    madeSections = {}
+    def extraSections(iSpace, space):
+      sections = madeSections.pop(iSpace, None)
+      if sections is None:
+        sections = [section for make in sectionMakers for section in make(iSpace, space)]
+        if binary and chunked:
+          madeSections[iSpace] = sections
+      return sections
+  # Each file is quantized as it is written, so each has its own errors
+  quantizations = []
+  if binary:
+    quantization = Quantization(quantizeBits) if quantizeBits > 0 else None
+    with prof.phase('escb writing', hot=True):
+      with open(splitext(filename)[0] + '.escb', 'wb') as out:
+        writeEscb(escherMap, out, extraSections=extraSections, quantization=quantization)
+    quantizations.append(('.escb', quantization))
+  if chunked:
+    quantization = Quantization(quantizeBits) if quantizeBits > 0 else None
+    with prof.phase('escz writing', hot=True):
+      with open(splitext(filename)[0] + '.escz', 'wb') as out:
+        writeEscz(escherMap, out, extraSections=extraSections, quantization=quantization)
+    quantizations.append(('.escz', quantization))
+  for extension, quantization in quantizations:
+    if quantization is None:
+      continue
+    for e in quantization.errors:
+      print('escher export: %s space %s quantized with errors %.3g in position, %.3g degrees in '
+        'normals, %.3g in UVs; %d portal vertices kept exact' % ((extension,) + tuple(e)))
+    print('escher export: %s %s' % (extension, quantization.summary()))
+    operator.report({'INFO'}, '%s: %s' % (extension, quantization.summary()))
+
+  if prof.enabled:
+    prof.finish()
+    prof.count('esc6 bytes', getsize(filename))
+    if binary:
+      prof.count('escb bytes', getsize(splitext(filename)[0] + '.escb'))
+    if chunked:
+      prof.count('escz bytes', getsize(splitext(filename)[0] + '.escz'))
+    prof.write(splitext(filename)[0] + '.profile.json')
+    for name, seconds in prof.slowestSpaces():
+      print('escher export: %8.3fs in space %s' % (seconds, name))
+    print('escher export: ' + prof.summary())
+    operator.report({'INFO'}, prof.summary())
+  return True
 
 class ExportEscher(bpy.types.Operator, ExportHelper):
   bl_idname       = "export.esc";
@@ -262,10 +447,120 @@ class ExportEscher(bpy.types.Operator, ExportHelper):
       description="Output file path", 
       maxlen=1024, default="")
 
+  write_binary = bpy.props.BoolProperty(
+      name="Write Binary Map",
+      description="Also write a memory-mappable .escb map next to the .esc6",
+      default=False)
+
+  write_chunked = bpy.props.BoolProperty(
+      name="Write Chunked Map",
+      description="Also write a .escz map with each space compressed on its own, for loading spaces on demand",
+      default=False)
+
+  quantize_bits = bpy.props.IntProperty(
+      name="Quantize Positions",
+      description="Store positions in the binary and chunked maps in this many bits per axis, "
+          "and UVs and normals in 16 bits; portal vertices stay exact. 0 stores them unquantized",
+      default=0, min=0, max=32)
+
+  use_cache = bpy.props.BoolProperty(
+      name="Use Export Cache",
+      description="Only reformat spaces which changed since the last export",
+      default=False)
+
+  workers = bpy.props.IntProperty(
+      name="Export Workers",
+      description="Number of processes formatting spaces; 0 uses one per CPU, 1 formats them in Blender",
+      default=1, min=0)
+
+  triangulate = bpy.props.BoolProperty(
+      name="Triangulate",
+      description="Split every face into triangles, so the game doesn't have to",
+      default=False)
+
+  collision_tables = bpy.props.BoolProperty(
+      name="Collision Tables",
+      description="Store each space's collision faces grouped by plane in the binary map",
+      default=False)
+
+  gpu_buffers = bpy.props.BoolProperty(
+      name="GPU Buffers",
+      description="Store each space's welded vertex and index buffers and draw batches in the binary map",
+      default=False)
+
+  pvs_depth = bpy.props.IntProperty(
+      name="PVS Depth",
+      description="Store the spaces visible through up to this many portals in the binary map; 0 stores none",
+      default=0, min=0)
+
+  bvh = bpy.props.BoolProperty(
+      name="Collision BVH",
+      description="Store a bounding volume hierarchy over each space's collision triangles in the binary map",
+      default=False)
+
+  lod_levels = bpy.props.IntProperty(
+      name="Levels of Detail",
+      description="Store this many decimated meshes of each space in the binary map, "
+          "each with half the triangles of the one before, for spaces seen through portals",
+      default=0, min=0, max=9)
+
+  path_spacing = bpy.props.FloatProperty(
+      name="Path Spacing",
+      description="Resample spawner paths to points this far apart along their length; 0 keeps their vertices",
+      default=0.0, min=0.0)
+
+  smooth_paths = bpy.props.BoolProperty(
+      name="Smooth Paths",
+      description="Pass spawner paths through a Catmull-Rom spline",
+      default=False)
+
+  close_paths = bpy.props.BoolProperty(
+      name="Close Paths",
+      description="Join the end of each spawner path back to its start",
+      default=False)
+
+  path_tables = bpy.props.BoolProperty(
+      name="Path Length Tables",
+      description="Store the length along each spawner path at each of its points in the binary map",
+      default=False)
+
+  remote_bounds = bpy.props.BoolProperty(
+      name="Portal Bounds",
+      description="Store the merged portal polygons, planes and bounding volumes of each remote in the binary map",
+      default=False)
+
+  profile = bpy.props.BoolProperty(
+      name="Profile Export",
+      description="Time each phase of the export and write the timings and counts to a .profile.json file",
+      default=False)
+
+  profile_python = bpy.props.BoolProperty(
+      name="Profile Python Calls",
+      description="Also run the slowest phases under cProfile, writing a .profile.prof file",
+      default=False)
+
+  lint = bpy.props.BoolProperty(
+      name="Check Map",
+      description="Check remotes, portal faces, reachability of spaces and that portals line up before writing",
+      default=True)
+
+  lint_blocks = bpy.props.BoolProperty(
+      name="Stop on Errors",
+      description="Do not write a map in which the check found errors the game's loader would reject",
+      default=False)
+
   def execute(self, context):
     print('exporting esc6 to filename "%s"' % self.properties.filepath)
-    escherExport(self, bpy.data.materials, bpy.data.objects, bpy.context.scene, self.properties.filepath)
-    return {'FINISHED'};
+    written = escherExport(self, bpy.data.materials, bpy.data.objects, bpy.context.scene,
+      self.properties.filepath, binary=self.write_binary, useCache=self.use_cache,
+      workers=self.workers, triangulate=self.triangulate, collisionTables=self.collision_tables,
+      gpuBuffers=self.gpu_buffers, pvsDepth=self.pvs_depth, bvh=self.bvh,
+      profile=self.profile or self.profile_python, useCProfile=self.profile_python,
+      lint=self.lint, lintBlocks=self.lint_blocks, chunked=self.write_chunked,
+      quantizeBits=self.quantize_bits, lodLevels=self.lod_levels, pathSpacing=self.path_spacing,
+      smoothPaths=self.smooth_paths, closePaths=self.close_paths, pathTables=self.path_tables,
+      remoteBounds=self.remote_bounds)
+    return {'FINISHED'} if written else {'CANCELLED'}
 
 def menu_func(self, context):
   self.layout.operator(ExportEscher.bl_idname, text="Escher Map (.esc6)")